@@ -1,13 +1,18 @@
 import numpy as np
 import os 
+import sys
 import glob
 import time
 import subprocess
-import astropy.units as u
-from astropy.time import Time
 import sigproc as fb
 import click
 
+# Shared pipeline modules (eg, run_metrics) are one level up
+cur_dir = os.path.realpath(__file__)
+srcdir = cur_dir.rsplit('/', 2)[0]
+sys.path.append(srcdir)
+import run_metrics as rmet
+
 #########################
 ##  DADA HEADER CLASS  ##
 #########################
@@ -302,7 +307,9 @@ def write_dada_header(outfile, fcenter_MHz, bw_MHz, tsamp_us,
     # Set the total bandwidth in MHz
     hdr.bw = bw_MHz
 
-    # UTC Start Time
+    # UTC Start Time (astropy is slow to import and 
+    # this is the only place we need it)
+    from astropy.time import Time
     tstart = Time(mjd_start, format='mjd')
     #tstr = str(tstart.datetime64)
     tstr = tstart.isot
@@ -447,7 +454,8 @@ def cs2dada(basename, indir, outdir):
     return
 
 
-def cs2dada_multipass(basename, indir, outdir, mem_lim_gb=32.0):
+def cs2dada_multipass(basename, indir, outdir, mem_lim_gb=32.0, 
+                      chunk_mb=0):
     """
     Get CS baseband files of the form:
 
@@ -459,6 +467,10 @@ def cs2dada_multipass(basename, indir, outdir, mem_lim_gb=32.0):
         basename.dada
 
     in the directory "outdir"
+
+    Data are read in chunks of chunk_mb MB (summed over 
+    all files).  If chunk_mb <= 0, use the largest chunk 
+    that fits in mem_lim_gb
     """
     t0 = time.time()
     # Get files 
@@ -492,6 +504,10 @@ def cs2dada_multipass(basename, indir, outdir, mem_lim_gb=32.0):
 
     # Figure out the number of samples per file per chunk
     Nsamp_per_chunk = int( 0.5 * 0.75 * 10**9 * mem_lim_gb / (2 * (nbits//8) * nchan) )
+    if chunk_mb > 0:
+        Nsamp_per_chunk = min( Nsamp_per_chunk, 
+                          int( 10**6 * chunk_mb / (2 * (nbits//8) * nchan) ) )
+    Nsamp_per_chunk = max(Nsamp_per_chunk, 1)
 
     # How many steps to read all the data?
     nsteps = int( np.ceil( Nt_total / Nsamp_per_chunk ) )
@@ -567,7 +583,7 @@ def run_digifil(infile, outfile, dm, nchan, nthread=1, inc_ddm=True):
 
     # Run command
     t0 = time.time()
-    subprocess.run(cmd, shell=True)
+    rmet.run_cmd(cmd, "digifil", outfile=outfile)
     t1 = time.time()
 
     # print time
@@ -633,7 +649,8 @@ def cs2fil(basename, cs_dir, dada_dir, fil_dir, dm, nchan,
 
 
 def cs2fil_multipass(basename, cs_dir, dada_dir, fil_dir, dm, nchan, 
-                     mem_lim_gb=16.0, nthread=1, inc_ddm=False):
+                     mem_lim_gb=16.0, nthread=1, inc_ddm=False, 
+                     chunk_mb=0):
     """
     Take cs files of form {basename}*.cs in directory cs_dir 
     and convert them into a single DADA file {basename}.dada 
@@ -643,11 +660,15 @@ def cs2fil_multipass(basename, cs_dir, dada_dir, fil_dir, dm, nchan,
     filterbank at DM "dm" with a total of nchan channels.
     Use nthread threads for digifil and remove incohrent 
     dispersive delay if inc_ddm=True 
+
+    The cs files are read chunk_mb MB at a time (if 
+    chunk_mb <= 0, as much as fits in mem_lim_gb)
     """
     t0 = time.time()
     # Read in and convert data to DADA file
-    cs2dada_multipass(basename, cs_dir, dada_dir, 
-                      mem_lim_gb=mem_lim_gb)
+    with rmet.stage("dada_conversion", basename=basename):
+        cs2dada_multipass(basename, cs_dir, dada_dir, 
+                          mem_lim_gb=mem_lim_gb, chunk_mb=chunk_mb)
     
     t1 = time.time()
 
@@ -687,8 +708,13 @@ def cs2fil_multipass(basename, cs_dir, dada_dir, fil_dir, dm, nchan,
               help="Max memory to use during DADA conversion (GB)")
 @click.option("--nthread", type=int, default=1,  
               help="Number of threads for digifil processing")
+@click.option("--chunk_mb", type=float, default=0, 
+              help="Read size for DADA conversion in MB (def: fit in mem_lim)")
+@click.option("--metrics", type=str, default=None, 
+              help="Write per stage resource use to this JSON file")
 def cs2fil_multi(basename, cs_dir, dada_dir, fil_dir, dm, nchan, 
-                 mem_lim=16.0, nthread=1, inc_ddm=False):
+                 mem_lim=16.0, nthread=1, inc_ddm=False, chunk_mb=0, 
+                 metrics=None):
     """
     Convert multiple chunks of complex sampled voltage data 
     to coherently de-dispersed channelized filterbanks.
@@ -728,7 +754,10 @@ def cs2fil_multi(basename, cs_dir, dada_dir, fil_dir, dm, nchan,
         print("Processing %s..." %cbase)
         cs2fil_multipass(cbase, cs_dir, dada_dir, fil_dir, dm, nchan, 
                          mem_lim_gb=mem_lim, nthread=nthread, 
-                         inc_ddm=inc_ddm)
+                         inc_ddm=inc_ddm, chunk_mb=chunk_mb)
+
+    if metrics is not None:
+        rmet.dump_records(metrics)
     
     return
     
@@ -0,0 +1,462 @@
+import os
+import sys
+import glob
+import time
+import json
+import shlex
+import subprocess
+import numpy as np
+from argparse import ArgumentParser
+import bb_proc
+import host_probe as hp
+
+#srcdir = '/src/bb_proc'
+cur_dir = os.path.realpath(__file__)
+srcdir  = cur_dir.rsplit('/', 1)[0]
+
+# Read the cs file headers with the bb2fil sigproc reader
+sys.path.append("%s/bb2fil" %srcdir)
+import sigproc as fb
+
+# Only used for plan_dm_trials (dedisp's filterbank module 
+# would get the bb2fil sigproc imported above)
+sys.path.append("%s/bbsearch" %srcdir)
+import dedisp
+
+
+###########################
+##  MANIFEST AND JOBS    ##
+###########################
+
+class BB_JOB:
+    def __init__(self, num, csdir, bname, outdir, priority=0, opts=[]):
+        self.num = num
+        self.csdir = csdir
+        self.bname = bname
+        self.outdir = outdir
+        self.priority = priority
+        self.opts = opts
+
+        # Resource needs (filled in by estimate_needs)
+        self.ncpu = 1
+        self.mem_gb = 0.0
+        self.disk_gb = 0.0
+        self.diskdir = outdir
+
+        # Run info
+        self.proc = None
+        self.logfile = None
+        self.fs_id = None
+        self.tstart = 0.0
+        self.tstop = 0.0
+        self.status = "pending"
+        self.retcode = None
+
+    def __str__(self):
+        str = "BB_JOB(%s, pri=%d, cpu=%d, mem=%.1fGB, disk=%.1fGB)" %(\
+                self.bname, self.priority, self.ncpu,
+                self.mem_gb, self.disk_gb)
+        return str
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def read_manifest(manifest, common_opts=""):
+    """
+    Read list of observations from the manifest file.
+    Each (non-comment) line gives:
+
+        csdir basename outdir [priority] [bb_proc options]
+
+    Higher priority jobs are started first (def: 0).  Any
+    options are added to the common options (common_opts)
+    for that job only.
+    """
+    joblist = []
+    with open(manifest, 'r') as fin:
+        for line in fin:
+            cols = shlex.split(line, comments=True)
+            if len(cols) == 0:
+                continue
+            elif len(cols) < 3:
+                print("Skipping bad manifest line: %s" %line.strip())
+                continue
+            else: pass
+
+            csdir, bname, outdir = cols[:3]
+            extra = cols[3:]
+
+            priority = 0
+            if len(extra):
+                try:
+                    priority = int(extra[0])
+                    extra = extra[1:]
+                except ValueError:
+                    pass
+
+            opts = shlex.split(common_opts) + extra
+            job = BB_JOB(len(joblist), csdir, bname, outdir,
+                         priority=priority, opts=opts)
+            joblist.append(job)
+
+    return joblist
+
+
+def cs_data_info(csdir, bname):
+    """
+    Get the number of subbands, the number of complex
+    samples per subband, and the bytes per complex sample
+    from the {bname}*.cs headers
+    """
+    csfiles = glob.glob("%s/%s*.cs" %(csdir, bname))
+    if len(csfiles) == 0:
+        return 0, 0, 0
+
+    hd, hsize, err = fb.read_header(csfiles[0], 4, fb.fmtdict)
+    if err:
+        print("Error %d reading header: %s" %(err, csfiles[0]))
+        return 0, 0, 0
+
+    bps = 2 * hd['nbits'] // 8
+    dsize = os.path.getsize(csfiles[0]) - hsize
+    nsamp = dsize // bps
+
+    return len(csfiles), nsamp, bps
+
+
+def fil_chan_info(csdir, bname, nchan):
+    """
+    Get the channel frequencies (MHz) and sample time (s) 
+    of the nchan channel filterbank made from the 
+    {bname}*.cs files.  Each subband (fch1 is its center 
+    and foff its width) is split into nchan / nsub channels
+    """
+    csfiles = glob.glob("%s/%s*.cs" %(csdir, bname))
+    fcs = []
+    bw = 0.0
+    for csfile in csfiles:
+        hd, hsize, err = fb.read_header(csfile, 4, fb.fmtdict)
+        if err:
+            print("Error %d reading header: %s" %(err, csfile))
+            continue
+        fcs.append(hd['fch1'])
+        bw = abs(hd['foff'])
+
+    if len(fcs) == 0 or bw == 0:
+        return None, None
+
+    chan_bw = bw * len(csfiles) / max(nchan, 1)
+    flo = min(fcs) - 0.5 * bw
+    freqs = flo + chan_bw * (np.arange(max(nchan, 1)) + 0.5)
+    dt = 1e-6 / chan_bw
+
+    return freqs, dt
+
+
+def estimate_needs(job, ncpu, mem_gb):
+    """
+    Estimate the CPU, memory and scratch disk needs of a
+    bb_proc.py job from its options and the cs headers.
+
+      cpu:  digifil threads (at least 2 for the search
+            plus the background RFI plots)
+
+      mem:  the larger of the DADA conversion (memlim) and
+            the search, which holds a few copies of the
+            dedispersed time series
+
+    A job with --auto picks its threads and memory from
+    the whole host, so it gets the whole batch budget
+    (ncpu CPUs and mem_gb GB) and runs on its own
+
+      disk: DADA file + filterbank + two dat files (the 
+            dedispersed and filtered series) per DM trial 
+            (none with --stream), on the scratch directory 
+            if the job uses one
+    """
+    args = bb_proc.parse_input(job.opts + [job.csdir, job.bname, job.outdir])
+    nsub, nsamp, bps = cs_data_info(job.csdir, job.bname)
+
+    job.ncpu = max(args.nthread, 2)
+
+    # DADA is 8-bit complex, filterbank is 32-bit
+    # floats with nchan / nsub times fewer spectra
+    dada_bytes = nsub * nsamp * 2
+    fil_bytes = nsub * nsamp * 4
+    nspec = nsub * nsamp // max(args.nchan, 1)
+    dat_bytes = nspec * 4
+
+    # Each DM trial (with -dmr) writes its own dat file
+    ntrials = 1
+    if args.dmrange > 0 and not args.stream:
+        freqs, dt = fil_chan_info(job.csdir, job.bname, args.nchan)
+        if freqs is not None:
+            dms = dedisp.plan_dm_trials(args.dm, args.dm - args.dmrange,
+                                        args.dm + args.dmrange, freqs, dt)
+            ntrials = len(dms)
+        else: pass
+    else: pass
+
+    # dat_filter works in float64 (on the whole series
+    # with the fft engine, in blocks with sos).  The
+    # streaming search only holds a few blocks and
+    # writes no dat files
+    if args.stream:
+        search_bytes = 0
+        ndat = 0
+    elif (len(args.filter) or args.autofilter) and \
+         args.filter_engine == 'fft':
+        search_bytes = 4 * dat_bytes
+        ndat = 2 * ntrials
+    else:
+        search_bytes = 3 * dat_bytes
+        ndat = 2 * ntrials
+    job.mem_gb = max(args.memlim, search_bytes / 1e9)
+
+    if args.auto:
+        job.ncpu = ncpu
+        job.mem_gb = mem_gb
+    else: pass
+
+    # Do not count the filterbank if it's already there
+    if os.path.exists("%s/%s.fil" %(job.outdir, job.bname)):
+        dada_bytes = fil_bytes = 0
+    job.disk_gb = (dada_bytes + fil_bytes + ndat * dat_bytes) / 1e9
+
+    if args.scratch is not None:
+        job.diskdir = args.scratch
+    else:
+        job.diskdir = job.outdir
+
+    return job
+
+
+###########################
+##  SCHEDULER            ##
+###########################
+
+def start_job(job):
+    """
+    Start bb_proc.py for job with output going
+    to a log file in the output directory
+    """
+    if not os.path.exists(job.outdir):
+        os.makedirs(job.outdir)
+
+    script_path = "%s/bb_proc.py" %srcdir
+    cmd = [sys.executable, "-u", script_path] + job.opts +\
+          [job.csdir, job.bname, job.outdir]
+
+    job.logfile = "%s/%s_bb_proc.log" %(job.outdir, job.bname)
+    print("Starting %s" %job)
+    print("  %s" %(" ".join(cmd)))
+    print("  log: %s" %job.logfile)
+
+    with open(job.logfile, 'w') as flog:
+        job.proc = subprocess.Popen(cmd, stdout=flog,
+                                    stderr=subprocess.STDOUT)
+    job.tstart = time.time()
+    job.status = "running"
+
+    return
+
+
+def get_out_fs(outdir):
+    """
+    Path to check for disk space for outdir (its
+    parent if it does not exist yet)
+    """
+    if os.path.exists(outdir):
+        return outdir
+    else:
+        return os.path.dirname(os.path.abspath(outdir))
+
+
+def fits_budget(job, running, ncpu, mem_gb, disk_res):
+    """
+    Check if job fits in what is left of the host budget
+    given the running jobs.  disk_res is the fraction of
+    free space on each file system we are willing to use
+    """
+    # A job that is too big for the whole host gets
+    # the host to itself
+    if len(running) == 0:
+        return True
+
+    cpu_used = sum([ jj.ncpu for jj in running ])
+    mem_used = sum([ jj.mem_gb for jj in running ])
+    if cpu_used + job.ncpu > ncpu:
+        return False
+    if mem_used + job.mem_gb > mem_gb:
+        return False
+
+    # Running jobs on the same file system still have
+    # to write some of their products
+    fs_out = get_out_fs(job.diskdir)
+    fs_id = hp.get_fs_id(fs_out)
+    disk_used = sum([ jj.disk_gb for jj in running if jj.fs_id == fs_id ])
+    disk_free = disk_res * hp.get_disk_free_gb(fs_out)
+    if disk_used + job.disk_gb > disk_free:
+        return False
+
+    return True
+
+
+def run_batch(joblist, ncpu, mem_gb, disk_res=0.9, poll=10.0):
+    """
+    Run jobs concurrently within the host budget of ncpu
+    CPUs and mem_gb GB of memory.  Pending jobs are started
+    in order of priority (then manifest order) whenever they
+    fit; smaller jobs may start ahead of a larger one that
+    does not fit yet.
+    """
+    pending = sorted(joblist, key=lambda jj: (-jj.priority, jj.num))
+    running = []
+    done = []
+
+    while len(pending) or len(running):
+        # Check on running jobs
+        for job in running[:]:
+            retcode = job.proc.poll()
+            if retcode is None:
+                continue
+            job.tstop = time.time()
+            job.retcode = retcode
+            job.status = "done" if retcode == 0 else "failed"
+            print("Finished %s -- %s (%.1f min)" %(job.bname, job.status,
+                                      (job.tstop - job.tstart)/60.))
+            running.remove(job)
+            done.append(job)
+
+        # Start whatever fits
+        for job in pending[:]:
+            if fits_budget(job, running, ncpu, mem_gb, disk_res):
+                job.fs_id = hp.get_fs_id(get_out_fs(job.diskdir))
+                start_job(job)
+                pending.remove(job)
+                running.append(job)
+
+        if len(pending) or len(running):
+            time.sleep(poll)
+
+    return done
+
+
+def write_summary(joblist, outfile):
+    """
+    Write summary of the batch jobs to a JSON file
+    """
+    out = []
+    for job in joblist:
+        jd = {'basename' : job.bname,
+              'csdir'    : job.csdir,
+              'outdir'   : job.outdir,
+              'priority' : job.priority,
+              'opts'     : job.opts,
+              'ncpu'     : job.ncpu,
+              'mem_gb'   : job.mem_gb,
+              'disk_gb'  : job.disk_gb,
+              'status'   : job.status,
+              'retcode'  : job.retcode,
+              'logfile'  : job.logfile,
+              'wall_s'   : job.tstop - job.tstart}
+        out.append(jd)
+
+    with open(outfile, 'w') as fout:
+        json.dump(out, fout, indent=1)
+
+    return
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Run bb_proc.py on many observations within a host budget"
+    parser = ArgumentParser(description=prog_desc)
+
+    parser.add_argument('manifest',
+                        help='File with one observation per line: ' +\
+                             'csdir basename outdir [priority] [options]')
+    parser.add_argument('-o', '--opts', default="", required=False,
+                        help='bb_proc.py options common to all jobs ' +\
+                             '(in quotes, e.g., "-dm 219.46 -nc 128")')
+    parser.add_argument('-c', '--ncpu', default=-1, type=int,
+                        help='CPUs available to the batch ' +\
+                             '(def: -1, all CPUs on host)',
+                        required=False)
+    parser.add_argument('-m', '--mem', default=-1, type=float,
+                        help='Memory available to the batch in GB ' +\
+                             '(def: -1, 90%% of available memory)',
+                        required=False)
+    parser.add_argument('-d', '--diskfrac', default=0.9, type=float,
+                        help='Fraction of free disk space to use (def: 0.9)',
+                        required=False)
+    parser.add_argument('-p', '--poll', default=10.0, type=float,
+                        help='Seconds between job status checks (def: 10)',
+                        required=False)
+    parser.add_argument('-s', '--summary', default="batch_summary.json",
+                        help='Output summary file (def: batch_summary.json)',
+                        required=False)
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Print the job estimates and exit')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Run batch
+    """
+    tstart = time.time()
+
+    args = parse_input()
+
+    ncpu = args.ncpu
+    if ncpu <= 0:
+        ncpu = hp.get_ncpu()
+    mem_gb = args.mem
+    if mem_gb <= 0:
+        mem_gb = 0.9 * hp.get_mem_gb()
+
+    print("\n\n===== BATCH PARAMETERS =====")
+    print("  Manifest: %s" %args.manifest)
+    print("  Common options: %s" %args.opts)
+    print("  CPU budget: %d" %ncpu)
+    print("  Memory budget: %.1f GB" %mem_gb)
+    print("  Disk fraction: %.2f" %args.diskfrac)
+    print("============================\n\n")
+
+    joblist = read_manifest(args.manifest, common_opts=args.opts)
+    print("Found %d jobs" %len(joblist))
+
+    for job in joblist:
+        estimate_needs(job, ncpu, mem_gb)
+        print("  %s" %job)
+
+    if args.dry_run:
+        return
+
+    run_batch(joblist, ncpu, mem_gb, disk_res=args.diskfrac,
+              poll=args.poll)
+    write_summary(joblist, args.summary)
+
+    nfail = len([ jj for jj in joblist if jj.status != "done" ])
+    tstop = time.time()
+    print("")
+    print("Finished %d jobs (%d failed) in %.1f minutes" %(\
+           len(joblist), nfail, (tstop - tstart)/60.))
+
+    return
+
+
+debug = 0
+
+if __name__ == "__main__":
+    if debug:
+        pass
+    else:
+        main()
@@ -3,26 +3,33 @@ import os
 import sys
 import glob
 import time
-from subprocess import call
+import shutil
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 import bp_rfi as bp_rfi
+import run_metrics as rmet
+import host_probe as hp
 
 #srcdir = '/src/bb_proc'
 cur_dir = os.path.realpath(__file__)
 srcdir  = cur_dir.rsplit('/', 1)[0]
 
 def convert_cs2fil(csdir, bname, outdir, nchan, dm, 
-                   nthread, memlim):
+                   nthread, memlim, chunk_mb=0):
     """
     Run bb2fil_chunk.py to convert cs fil to fil
 
     This will make a DADA file from the cs file, 
     then run digifil to make a channelized filterbank 
     file with intrachannel dispersive delays removed.
+
+    chunk_mb is the read size for the DADA conversion 
+    (if <= 0, bb2fil picks the largest that fits memlim)
     """
     tstart = time.time()
 
     script_path = "%s/bb2fil/bb2fil_chunk.py" %srcdir
+    metrics_file = "%s/%s_fil_metrics.json" %(outdir, bname)
     cmd = "python -u " +\
           "%s " %script_path +\
           "--basename %s " %bname +\
@@ -32,10 +39,13 @@ def convert_cs2fil(csdir, bname, outdir, nchan, dm,
           "--nchan %d " %nchan +\
           "--dm %.4f " %dm +\
           "--nthread %d " %nthread +\
-          "--mem_lim %.1f " %memlim
+          "--mem_lim %.1f " %memlim +\
+          "--chunk_mb %.1f " %chunk_mb +\
+          "--metrics %s " %metrics_file
 
     print(cmd)
-    call(cmd, shell=True)
+    rmet.run_cmd(cmd, "filterbank")
+    rmet.merge_records(metrics_file, parent="filterbank")
 
     tstop = time.time()
     tdur = tstop - tstart
@@ -43,6 +53,17 @@ def convert_cs2fil(csdir, bname, outdir, nchan, dm,
     return tdur
 
 
+def get_cs_bytes(csdir, bname):
+    """
+    Total size of the {bname}*.cs files.  The DADA 
+    file is at most this big and the 32-bit filterbank 
+    at most twice this (for 8-bit cs data)
+    """
+    csfiles = glob.glob("%s/%s*.cs" %(csdir, bname))
+    cs_bytes = sum([ os.path.getsize(cf) for cf in csfiles ])
+    return cs_bytes
+
+
 def check_rfi_tavg(nchan, tfac):
     """
     digifil will complain if nchan * tfac > 2^19
@@ -103,7 +124,7 @@ def make_rfi_fil(filfile, outdir, tfac=512, nthread=1):
         print("  Decimated file already exists!")
         print("  %s" %outfile)
     else:
-        call(dec_cmd, shell=True)
+        rmet.run_cmd(dec_cmd, "decimation")
 
     tstop = time.time()
     tdur = tstop - tstart
@@ -111,19 +132,91 @@ def make_rfi_fil(filfile, outdir, tfac=512, nthread=1):
     return tdur, outfile
 
 
+def make_rfi_plots(rfi_fil, outdir):
+    """
+    Make plots showing RFI stats calculated either with 
+    1 min of data of time/4, whichever is smallest 
+
+    This is usually run in a background worker while the 
+    search is running.  The worker has its own records, so 
+    we return the stage record for join_rfi_plots to add 
+    in the main process (run here, stage() already adds it)
+    """
+    with rmet.stage("rfi_plots") as rec:
+        rtime = bp_rfi.get_time_chunk(rfi_fil, 60, nt_min=4)
+        outbase_rfi = "%s/bp" %outdir
+        bp_rfi.rfi_plot(rfi_fil, rtime, outbase_rfi, bpass=True)
+        bp_rfi.rfi_plot(rfi_fil, rtime, outbase_rfi, bpass=False)
+
+    return rec
+
+
+def join_rfi_plots(rfi_pool, rfi_job):
+    """
+    Wait for the background RFI plots to finish and 
+    add the stage record.  A failure here just means 
+    missing diagnostic plots, so we report it and move on
+
+    Returns the time spent making plots
+    """
+    if rfi_job is None:
+        return 0
+
+    print("\n\n=== WAITING FOR RFI PLOTS ===")
+    try:
+        rec = rfi_job.result()
+        rmet.add_record(rec)
+        tplot = rec['wall_s']
+    except Exception as err:
+        print("  RFI diagnostic plots failed: %s" %err)
+        tplot = 0
+    rfi_pool.shutdown()
+
+    return tplot
+
+
 def run_search(filfile, outdir, nchan, nsub, dm, snr, mw, max_cands, 
                width=0.1, tel='RO', edgezap=2, zap_str="", 
-               fzaps=[], avoid_badblocks=False, apply_zerodm=False):
+               fzaps=[], avoid_badblocks=False, apply_zerodm=False, 
+               scratch=None, dd_engine='native', nthread=1, dmrange=0, 
+               stream=False, multires=0, filter_engine='sos', 
+               autofilter=False):
     """
     Run bbsearch.py to search for cands
 
     This will de-disperse, run single pulse search, 
     and make snippets 
+
+    Returns the time taken and the exit code of bbsearch.py
+
+    If scratch is given, the dat and snippet files 
+    are put there instead of outdir
+
+    dd_engine is the dedispersion engine ('native' or 
+    'presto') and nthread the number of threads for it
+
+    If dmrange > 0, also search DM trials within 
+    +/- dmrange of dm
+
+    If stream, dedisperse, filter, and search in one 
+    pass without writing the dat files
+
+    If multires > 0, boxcars wider than multires bins 
+    are searched on decimated time series
+
+    filter_engine is 'sos' (bandstop filter per 
+    frequency) or 'fft' (one FFT notch for all)
+
+    If autofilter, birdies found in the dedispersed 
+    time series are added to the filter list
     """
     tstart = time.time()
 
     script_path = "%s/bbsearch/bbsearch.py" %srcdir 
 
+    filbase = (filfile.split("/")[-1]).split(".fil")[0]
+    metrics_file = "%s/%s_search_metrics.json" %(outdir, filbase)
+
     if avoid_badblocks:
         bb_str = "--badblocks "
     else:
@@ -140,6 +233,21 @@ def run_search(filfile, outdir, nchan, nsub, dm, snr, mw, max_cands,
             fz_str += "-f %s " %fz
     else:
         fz_str = ""
+
+    if autofilter:
+        af_str = "--autofilter "
+    else:
+        af_str = ""
+
+    if scratch is not None:
+        scr_str = "--scratch %s " %scratch
+    else:
+        scr_str = ""
+
+    if stream:
+        str_str = "--stream "
+    else:
+        str_str = ""
     
     cmd = "python -u %s " %script_path +\
           "%s" %bb_str +\
@@ -148,28 +256,41 @@ def run_search(filfile, outdir, nchan, nsub, dm, snr, mw, max_cands,
           "-snr %.1f " %snr +\
           "-w %.4f " %width +\
           "-mw %.3f " %mw +\
+          "-mr %d " %multires +\
           "-ezap %d " %edgezap +\
           "-zap %s " %zap_str +\
           "-nsub %d " %nsub +\
           "-ncs %d " %(int(nchan/nsub)) +\
           "%s " %fz_str +\
+          "%s" %af_str +\
+          "-fe %s " %filter_engine +\
           "-tel %s " %tel +\
           "-mc %d " %max_cands +\
+          "--metrics %s " %metrics_file +\
+          "--dedisp %s " %dd_engine +\
+          "-nt %d " %nthread +\
+          "-dmr %.3f " %dmrange +\
+          "%s" %scr_str +\
+          "%s" %str_str +\
           "%s %s " %(filfile, outdir)
    
     # Run command 
     print(cmd)   
-    call(cmd, shell=True)
+    retcode = rmet.run_cmd(cmd, "search")
+    rmet.merge_records(metrics_file, parent="search")
 
     tstop = time.time()
     tdur = tstop - tstart 
 
-    return tdur
+    return tdur, retcode
 
 
-def parse_input():
+def parse_input(argv=None):
     """
     Use argparse to parse input
+
+    argv is a list of arguments to parse instead 
+    of the command line (used by bb_batch.py)
     """
     prog_desc = "Pipeline to process and search baseband data"
     parser = ArgumentParser(description=prog_desc)
@@ -191,6 +312,10 @@ def parse_input():
     parser.add_argument('-nt', '--nthread', default=1, 
                         help='Number of threads for digifil processing (def: 1)',
                         required=False, type=int)
+    parser.add_argument('--auto', action='store_true',
+                        help='Pick nthread, memlim, and DADA chunk size ' +\
+                             'from the host CPUs, memory, and disk ' +\
+                             'speed (overrides -m and -nt)')
     parser.add_argument('-rt', '--rfidec', default=512, 
                         help='Number of samples to decimate filfile ' +\
                              'for RFI diagnostics (def: 512, to skip this: -1)',
@@ -210,6 +335,11 @@ def parse_input():
     parser.add_argument('-mw', '--maxwidth', required=False,
                         help='Max boxcar width in ms for SP search (def: 10)',
                         type=float, default=10.0)
+    parser.add_argument('-mr', '--multires', default=0, type=int, 
+                        help='Search boxcars wider than this many bins ' +\
+                             'on time series decimated by 2 per level ' +\
+                             '(def: 0, all at full resolution)', 
+                        required=False)
     parser.add_argument('-mc', '--maxcands', required=False,
                         help='Max cands for plotting. ' +\
                         'Do not plot if exceeds this number. (def = -1, no lim)',
@@ -221,15 +351,44 @@ def parse_input():
                 '60Hz signal and 5 harmonics with width 1.0Hz).  To zap '+\
                 'multiple frequencies, repeat this argument',
            action='append', required=False, default=[])
+    parser.add_argument('--autofilter', action='store_true',
+                        help='Find periodic RFI (birdies) in the ' +\
+                             'dedispersed time series and add them to ' +\
+                             'the filter list')
+    parser.add_argument('-fe', '--filter_engine', default='sos', 
+                        choices=['sos', 'fft'], required=False, 
+                        help='Filter each frequency with a bandstop ' +\
+                             'filter (sos) or zero them all in one FFT ' +\
+                             '(fft) (def: sos)')
     parser.add_argument('--zerodm', action='store_true',
                         help='Apply the zero DM filter when dedispersing')
     parser.add_argument('--badblocks', action='store_true',
                         help='Ignore bad blocks in single pulse search')
+    parser.add_argument('-dmr', '--dmrange', default=0.0, type=float, 
+                        help='Search DM trials within +/- dmrange of ' +\
+                             'the coherent DM (def: 0, just search dm)', 
+                        required=False)
+    parser.add_argument('--dedisp', default='native', 
+                        choices=['native', 'presto'], required=False, 
+                        help='Dedisperse with bbsearch/dedisp.py (native) ' +\
+                             'or PRESTO prepdata (presto) (def: native)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Dedisperse, filter, and search in one pass ' +\
+                             'without writing dat files (native only)')
     parser.add_argument('-tel', '--tel', default='RO',  
                         help='DSN Telescope Name GS/RO/CN (def: RO)',
                         required=False)
-
-    args = parser.parse_args()
+    parser.add_argument('--scratch', default=None, required=False, 
+                        help='Directory (ideally local disk) for the ' +\
+                             'intermediate DADA, filterbank, dat, and ' +\
+                             'snippet files (def: use outdir)')
+    parser.add_argument('--keep_fil', action='store_true',
+                        help='Move the filterbank from scratch to outdir ' +\
+                             'at the end of the run')
+    parser.add_argument('--keep_scratch', action='store_true',
+                        help='Do not delete the scratch files at the end')
+
+    args = parser.parse_args(argv)
 
     return args
 
@@ -267,6 +426,8 @@ def main():
     print("  Candidate Snippet Size: %.3f sec" %width)
     mw = args.maxwidth
     print("  Max single pulse template width: %.1fms" %mw)
+    multires = args.multires
+    print("  Full resolution boxcars up to: %d bins" %multires)
     max_cands = args.maxcands
     print("  Max cands for plotting: %d" %max_cands)
     ezap = args.edgezap
@@ -279,12 +440,24 @@ def main():
     else:
         fzap_str = "No filtering"
     print("  Filtering (f0, nh, W): %s" %fzap_str)
+    autofilter = args.autofilter
+    print("  Automatic birdie filtering: %r" %autofilter)
+    fengine = args.filter_engine
+    print("  Filter engine: %s" %fengine)
     zdm = args.zerodm
     print("  Zero DM during de-dispersion: %r" %zdm)
     blocks = args.badblocks
     print("  Ignore bad blocks in SP search: %r" %blocks)
+    dd_engine = args.dedisp
+    print("  Dedispersion: %s" %dd_engine)
+    dmr = args.dmrange
+    print("  DM search range: +/- %.2f pc/cc" %dmr)
+    stream = args.stream
+    print("  Streaming search: %r" %stream)
     tel = args.tel
     print("  Telescope: %s" %tel)
+    scratch = args.scratch
+    print("  Scratch Directory: %s" %scratch)
     print("===================") 
     
     # Make sure output directory exists, 
@@ -292,7 +465,40 @@ def main():
     if not os.path.exists(outdir):
         print("outdir not found: %s" %outdir)
         print("Make sure outdir exists, then try again")
-        sys.exit(0)
+        sys.exit(1)
+    else: pass
+
+    metrics_file = "%s/run_metrics.json" %outdir
+
+    # Intermediate products go in a directory for 
+    # this observation on scratch (if we have one)
+    if scratch is not None:
+        workdir = "%s/%s" %(scratch, bname)
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = outdir
+
+    # Pick processing parameters from the host 
+    # capabilities if requested
+    chunk_mb = 0
+    rfi_bkgd = True
+    tune = None
+    if args.auto:
+        print("\n\n=== AUTO TUNING ===")
+        tune = hp.auto_tune(csdir, workdir)
+        nthread = tune['nthread']
+        memlim = tune['memlim']
+        chunk_mb = tune['chunk_mb']
+        rfi_bkgd = tune['rfi_bkgd']
+        print("  CPUs: %d" %tune['ncpu'])
+        print("  Available Memory: %.1f GB" %tune['mem_avail_gb'])
+        print("  cs dir read speed: %.0f MB/s" %tune['read_mbs'])
+        print("  workdir write speed: %.0f MB/s" %tune['write_mbs'])
+        print("  -> Max Threads: %d" %nthread)
+        print("  -> Memory Limit: %.1f GB" %memlim)
+        print("  -> DADA chunk size: %d MB" %chunk_mb)
+        print("  -> Background RFI plots: %r" %rfi_bkgd)
     else: pass
         
     # If filterbank does not already exists,
@@ -301,8 +507,16 @@ def main():
     print("\n\n=== BASEBAND TO FILTERBANK ===")
     filfile = "%s/%s.fil" %(outdir, bname)
     if not os.path.exists(filfile):
-        tfil = convert_cs2fil(csdir, bname, outdir, nchan, dm, 
-                              nthread, memlim)
+        filfile = "%s/%s.fil" %(workdir, bname)
+
+    if not os.path.exists(filfile):
+        cs_bytes = get_cs_bytes(csdir, bname)
+        if not hp.check_free_space(workdir, 3 * cs_bytes, "filterbank"):
+            rmet.write_metrics(metrics_file, tstart, basename=bname, 
+                               params=vars(args), tuning=tune)
+            sys.exit(1)
+        tfil = convert_cs2fil(csdir, bname, workdir, nchan, dm, 
+                              nthread, memlim, chunk_mb=chunk_mb)
     else:
         print("  filfile exists: %s" %filfile)
         print("  Skipping filterbank conversion...")
@@ -315,34 +529,73 @@ def main():
     print("\n\n=== FINDING BAD CHANNELS ===")
     rfi_tdec = check_rfi_tavg(nchan, rfi_tdec)
     if rfi_tdec > 0:
-        dec_dur, rfi_fil = make_rfi_fil(filfile, outdir, tfac=rfi_tdec, 
+        dec_dur, rfi_fil = make_rfi_fil(filfile, workdir, tfac=rfi_tdec, 
                                         nthread=nthread) 
         # Find bad channels from bandpass       
-        nchan_win = bp_rfi.get_win_num(nchan, nsub, wfrac=0.2) 
-        zap_str = bp_rfi.bp_bad_chans(rfi_fil, outdir, mode='avg', 
-                                      diff_thresh=3, nchan_win=nchan_win)
-        # Make plots showing RFI stats calculated either with 
-        # 1 min of data of time/4, whichever is smallest 
-        rtime = bp_rfi.get_time_chunk(rfi_fil, 60, nt_min=4)
-        outbase_rfi = "%s/bp" %outdir
-        bp_rfi.rfi_plot(rfi_fil, rtime, outbase_rfi, bpass=True)
-        bp_rfi.rfi_plot(rfi_fil, rtime, outbase_rfi, bpass=False)
+        with rmet.stage("bandpass"):
+            nchan_win = bp_rfi.get_win_num(nchan, nsub, wfrac=0.2) 
+            zap_str = bp_rfi.bp_bad_chans(rfi_fil, outdir, mode='avg', 
+                                          diff_thresh=3, nchan_win=nchan_win)
+        # The search only needs zap_str, so make the RFI 
+        # diagnostic plots in a background worker (if we 
+        # have a CPU to spare)
+        if rfi_bkgd:
+            rfi_pool = ProcessPoolExecutor(max_workers=1)
+            rfi_job = rfi_pool.submit(make_rfi_plots, rfi_fil, outdir)
+        else:
+            rfi_pool = None
+            rfi_job = None
+            make_rfi_plots(rfi_fil, outdir)
     else:
         dec_dur = 0
         zap_str = ""
+        rfi_pool = None
+        rfi_job = None
 
     # Make sure filterbank file exists, then 
     # run search
     print("\n\n=== SINGLE PULSE SEARCH ===")
     if not os.path.exists(filfile):
         print("  filfile not found: %s" %filfile)
-        return 
+        join_rfi_plots(rfi_pool, rfi_job)
+        rmet.write_metrics(metrics_file, tstart, basename=bname, 
+                           params=vars(args), tuning=tune)
+        sys.exit(1)
     else: 
         pass
+
+    if scratch is not None:
+        search_dir = workdir
+    else:
+        search_dir = None
      
-    tsearch = run_search(filfile, outdir, nchan, nsub, dm, snr, mw, max_cands, 
-                 width=width, tel=tel, edgezap=ezap, zap_str=zap_str, 
-                 fzaps=filter_list, avoid_badblocks=blocks, apply_zerodm=zdm)
+    tsearch, search_ret = run_search(filfile, outdir, nchan, nsub, dm, snr, 
+                 mw, max_cands, width=width, tel=tel, edgezap=ezap, 
+                 zap_str=zap_str, fzaps=filter_list, avoid_badblocks=blocks, 
+                 apply_zerodm=zdm, scratch=search_dir, dd_engine=dd_engine, 
+                 nthread=nthread, dmrange=dmr, stream=stream, multires=multires, 
+                 filter_engine=fengine, autofilter=autofilter)
+
+    # Make sure RFI plots are done
+    tplot = join_rfi_plots(rfi_pool, rfi_job)
+
+    # Keep the filterbank if requested, then 
+    # clear out the scratch directory
+    if scratch is not None:
+        if args.keep_fil and os.path.dirname(filfile) == workdir:
+            fil_bytes = os.path.getsize(filfile)
+            if hp.check_free_space(outdir, fil_bytes, "filterbank copy"):
+                with rmet.stage("keep_fil"):
+                    print("  Moving %s to %s" %(filfile, outdir))
+                    shutil.move(filfile, outdir)
+            else: pass
+        else: pass
+
+        if not args.keep_scratch:
+            print("  Removing scratch directory: %s" %workdir)
+            shutil.rmtree(workdir, ignore_errors=True)
+        else: pass
+    else: pass
 
     tstop = time.time()
     total_time = tstop - tstart
@@ -354,10 +607,22 @@ def main():
     print("")
     print("Filterbank:         %.1f minutes" %(tfil/60.))
     print("Find Bad Chans:     %.1f minutes" %(dec_dur/60.))
+    print("RFI Plots (bkgd):   %.1f minutes" %(tplot/60.))
     print("Searching:          %.1f minutes" %(tsearch/60.))
     print("")
     print("Total Time:         %.1f minutes" %(total_time/60.))
 
+    # Write machine-readable per stage metrics
+    rmet.write_metrics(metrics_file, tstart, basename=bname, 
+                       params=vars(args), tuning=tune)
+
+    # Let the caller (eg, bb_batch.py) know if the 
+    # search did not finish
+    if search_ret:
+        print("Search failed (exit code %d)" %search_ret)
+        sys.exit(1)
+    else: pass
+
     return
 
 
@@ -7,21 +7,33 @@ import os
 import copy
 import sys
 import time
-import your 
+import shutil
 from subprocess import call 
 from argparse import ArgumentParser
-import write_filterbank as wfil 
-import snippet_plots_sp as sp_plt
+
+# your, write_filterbank (your) and snippet_plots_sp 
+# (matplotlib) are slow to import, so they are imported 
+# in the functions that use them
 
 #scriptdir = "/src/bb_proc/bbsearch"
 cur_dir = os.path.realpath(__file__)
 scriptdir  = cur_dir.rsplit('/', 1)[0]
 
+# Shared pipeline modules (eg, run_metrics) are one level up
+srcdir = cur_dir.rsplit('/', 2)[0]
+sys.path.append(srcdir)
+import run_metrics as rmet
+import host_probe as hp
+import dedisp
+import filterbank as fbk
+import spcands
+
 ############################
 ## Filterbank Parameters ##
 ############################
 
 def get_chan_info(data_file):
+    import your
     yr = your.Your(data_file)
     foff = yr.your_header.foff
     fch1 = yr.your_header.fch1
@@ -31,13 +43,29 @@ def get_chan_info(data_file):
     return nchans, fch1, foff, dt
 
 
+def get_nspec(filfile):
+    """
+    Number of spectra in the filterbank (from the 
+    header size and the bits per sample)
+    """
+    hdr, hsize = fbk.read_header(filfile)
+    nbytes = hdr['nchans'] * hdr['nbits'] // 8
+    nspec = (os.path.getsize(filfile) - hsize) // nbytes
+    return nspec
+
+
 ##############################
 ## Making and Reading Cands ##
 ##############################
 
 class SP_CAND:
     def __init__(self, line, num):
-        cols = line.split()
+        # line is a line of a singlepulse file or a row 
+        # of a candidate array (see spcands.py)
+        if isinstance(line, str):
+            cols = line.split()
+        else:
+            cols = line
         self.dm = float(cols[0])
         self.snr = float(cols[1])
         self.time = float(cols[2])
@@ -59,8 +87,18 @@ class SP_CAND:
 def cands_from_spfile(spfile):
     """
     Read in the candidates from a *singlepulse (sp) file
-    and return an array of SP_CAND class objects
+    and return an array of SP_CAND class objects.  They 
+    come from the binary spcands file for spfile if there
+    is an up to date one (or if spfile is one)
     """
+    cfile = spcands.get_binary(spfile)
+    if cfile is not None:
+        cands, hdr = spcands.read_spcands(cfile)
+        candlist = [ SP_CAND(cc, ii + 1) for ii, cc in 
+                     enumerate(cands.tolist()) ]
+        return np.array(candlist)
+    else: pass
+
     ii = 1
     candlist = []
     with open(spfile, 'r') as fin:
@@ -101,7 +139,7 @@ def fix_file(filfile, tel, dsn):
         fix_cmd += "--dsn"
 
     print(fix_cmd)
-    call(fix_cmd, shell=True)
+    rmet.run_cmd(fix_cmd, "fix_header")
 
     return
 
@@ -178,13 +216,18 @@ def get_zap_chans(edgezap, nchansub, nsub, zchans="", flip=True):
     return zap_chan_str
 
 
-def dedisperse(filfile, dm, zapstr, zdm=False, outdir='.'):
+def dedisperse(filfile, dm, zapstr, zdm=False, outdir='.', 
+               engine='native', nthread=1, tel="Unknown"):
     """
-    Run prepdata to dedisperse the filterbank file 
-    at some DM, zapping channels if desired
+    Dedisperse the filterbank file at some DM, 
+    zapping channels if desired (zapstr in PRESTO 
+    channel numbering)
 
     Include zerodm option if zdm=True
 
+    engine = 'native' uses dedisp.py (memory mapped, 
+    nthread threads), engine = 'presto' runs prepdata
+
     Will do nothing if file already exists
     """
     filbase = (filfile.split("/")[-1]).split(".fil")[0] 
@@ -213,16 +256,68 @@ def dedisperse(filfile, dm, zapstr, zdm=False, outdir='.'):
         print("  Found dat file: %s" %datfile)
         print("  Skipping dedispersion")
         pass
+    elif engine == 'native':
+        hdr, hsize = dedisp.fbk.read_header(filfile)
+        zchans = dedisp.chans_from_string(zapstr)
+        zchans = dedisp.presto_to_file_chans(zchans, hdr['nchans'], 
+                                             hdr['foff'])
+        with rmet.stage("dedisp", dm=dm, nthread=nthread):
+            dedisp.dedisperse(filfile, dm, outbase, zap_chans=zchans, 
+                              zerodm=zdm, nthread=nthread, telescope=tel)
     else:
         print(dm_cmd)
-        call(dm_cmd, shell=True)
+        rmet.run_cmd(dm_cmd, "prepdata", dm=dm)
 
     return datfile
 
 
-def filter_dat(datfile, zaplist):
+def dedisperse_trials(filfile, dms, zapstr, zdm=False, outdir='.', 
+                      engine='native', nthread=1, tel="Unknown", nsub=0):
+    """
+    Dedisperse the filterbank file at each DM in dms 
+    (see dedisperse for the other options).  The native 
+    engine does all trials in one pass using subband 
+    dedispersion with nsub subbands (def: auto), presto 
+    runs prepdata for each trial.
+
+    Will do nothing if all the files already exist
+
+    Returns list of dat files
+    """
+    filbase = (filfile.split("/")[-1]).split(".fil")[0] 
+    outbases = [ "%s/%s_DM%.3f" %(outdir, filbase, dm) for dm in dms ]
+    datfiles = [ "%s.dat" %ob for ob in outbases ]
+
+    if np.all([ os.path.exists(df) for df in datfiles ]):
+        print("  Found all %d dat files" %len(datfiles))
+        print("  Skipping dedispersion")
+    elif engine == 'native':
+        hdr, hsize = dedisp.fbk.read_header(filfile)
+        zchans = dedisp.chans_from_string(zapstr)
+        zchans = dedisp.presto_to_file_chans(zchans, hdr['nchans'], 
+                                             hdr['foff'])
+        with rmet.stage("dedisp", ndm=len(dms), nthread=nthread):
+            dedisp.dedisperse_trials(filfile, dms, outbases, 
+                                     zap_chans=zchans, zerodm=zdm, 
+                                     nthread=nthread, nsub=nsub, 
+                                     telescope=tel)
+    else:
+        for dm in dms:
+            dedisperse(filfile, dm, zapstr, zdm=zdm, outdir=outdir, 
+                       engine=engine)
+
+    return datfiles
+
+
+def filter_dat(datfile, zaplist, engine='sos', block_mb=64):
     """
     Run filter on dat file 
+
+    engine = 'sos' filters each frequency with a 
+    bandstop filter, 'fft' zeros them all in one FFT
+
+    The sos engine streams the dat file through memory 
+    in blocks of block_mb MB (0 to load it all)
     """
     if len(zaplist) == 0:
         print("Skipping filter of dat file")
@@ -234,10 +329,12 @@ def filter_dat(datfile, zaplist):
         zstr += "-z %s " %zz
     
     filter_cmd = "python -u %s/dat_filter.py " %scriptdir +\
+                 "-e %s " %engine +\
+                 "-b %.1f " %block_mb +\
                  "%s %s" %(zstr, datfile)
     
     print(filter_cmd)
-    call(filter_cmd, shell=True)
+    rmet.run_cmd(filter_cmd, "filtering")
 
     basename = datfile.rsplit('.dat', -1)[0]
     outdat = "%s_filter.dat" %basename  
@@ -245,9 +342,41 @@ def filter_dat(datfile, zaplist):
     return outdat
 
 
-def sp_search(datfile, snr, bb=False, maxwidth=1.0, dtrendlen=8):
+def auto_filter(filfile, dm, zapstr, zdm=False, datfile=None, nthread=1):
     """
-    Run single pulse search
+    Find periodic RFI (birdies) to filter in the time 
+    series dedispersed at dm.  Uses datfile if we have 
+    one, otherwise dedisperses filfile on the fly 
+    (without writing the dat file)
+
+    Returns list of f0,nh,width strings for filter_dat
+    """
+    import birdies
+    import dat_filter
+
+    with rmet.stage("birdies", dm=dm):
+        if datfile is not None:
+            infile = "%s.inf" %(datfile.rsplit('.dat', 1)[0])
+            dt = dat_filter.get_dt_from_inf(infile)
+            zlist = birdies.dat_birdies(datfile, dt)
+        else:
+            hdr, hsize = dedisp.fbk.read_header(filfile)
+            zchans = dedisp.chans_from_string(zapstr)
+            zchans = dedisp.presto_to_file_chans(zchans, hdr['nchans'], 
+                                                 hdr['foff'])
+            zlist = birdies.fil_birdies(filfile, dm, zap_chans=zchans, 
+                                        zerodm=zdm, nthread=nthread)
+
+    return zlist
+
+
+def sp_search(datfiles, snr, bb=False, maxwidth=1.0, dtrendlen=8, 
+              multires=0, nproc=1, binary=False):
+    """
+    Run single pulse search on a list of dat files 
+    (eg, one per DM trial) in one call
+
+    Returns list of singlepulse files
 
       snr:  SNR threshold
     
@@ -260,33 +389,177 @@ def sp_search(datfile, snr, bb=False, maxwidth=1.0, dtrendlen=8):
                   using a size of 8000 bins.
 
       bb: Do NOT ignore bad blocks if True
+
+      multires: search boxcars wider than this (in bins) 
+                on time series decimated by 2 per level 
+                (0 = all at full resolution)
+
+      nproc: number of processes searching the dat 
+             files (or the chunks of a single file)
+
+      binary: also write binary spcands files
     """
-    datbase = datfile.split(".dat")[0]
-    spfile = "%s.singlepulse" %datbase
+    spfiles = [ "%s.singlepulse" %(df.split(".dat")[0]) for df in datfiles ]
 
     if bb:
         b_str = ""
     else:
         b_str = "-b "
 
+    if binary:
+        b_str += "--spcands "
+    else: pass
+
     sp_cmd = "python -u %s/single_pulse_search_w16ms.py " %scriptdir +\
              "-t %.2f " %snr +\
              "-m %.4f " %maxwidth +\
              "-d %d " %dtrendlen +\
+             "-r %d " %multires +\
+             "-n %d " %nproc +\
              "%s" %b_str +\
-             "%s" %datfile
+             "%s" %(" ".join(datfiles))
    
-    if os.path.exists(spfile):
-        print("  Found singlepulse file: %s" %spfile)
+    if np.all([ os.path.exists(sf) for sf in spfiles ]):
+        print("  Found singlepulse files: %s" %(", ".join(spfiles)))
         print("  Skipping single pulse search")
 
     else:
         print(sp_cmd)
-        call(sp_cmd, shell=True)
+        rmet.run_cmd(sp_cmd, "sp_search", ndm=len(datfiles))
+
+    return spfiles
+
+
+def stream_search(filfile, dm, zapstr, zaplist, snr, zdm=False,
+                  outdir='.', bb=False, maxwidth=1.0, nthread=1,
+                  tel="Unknown", keep_dat=False, multires=0, binary=False):
+    """
+    Dedisperse, filter (zaplist), and single pulse search
+    filfile at dm in one pass with sp_stream.py, so no dat
+    files are written (unless keep_dat).  Options are as
+    for dedisperse, filter_dat, and sp_search.
+
+    Will do nothing if the singlepulse file already exists
+
+    Returns the singlepulse file
+    """
+    import sp_stream
+
+    filbase = (filfile.split("/")[-1]).split(".fil")[0]
+    outbase =  "%s/%s_DM%.3f" %(outdir, filbase, dm)
+    spfile = "%s.singlepulse" %outbase
+
+    if os.path.exists(spfile):
+        print("  Found singlepulse file: %s" %spfile)
+        print("  Skipping streaming search")
+        return spfile
+    else: pass
+
+    hdr, hsize = dedisp.fbk.read_header(filfile)
+    zchans = dedisp.chans_from_string(zapstr)
+    zchans = dedisp.presto_to_file_chans(zchans, hdr['nchans'], hdr['foff'])
+
+    with rmet.stage("stream_search", dm=dm, nthread=nthread):
+        sp_stream.stream_search(filfile, dm, outbase, zap_chans=zchans,
+                                zerodm=zdm, zaplist=zaplist, threshold=snr,
+                                maxwidth=maxwidth, badblocks=bb,
+                                nthread=nthread, write_dat=keep_dat,
+                                multires=multires, telescope=tel,
+                                binary=binary)
 
     return spfile
 
 
+def merge_dm_cands(spfiles, outfile, freqs, dt, binary=False):
+    """
+    Merge the single pulse candidates from all DM 
+    trials into one singlepulse file (and a binary 
+    spcands file if binary).
+
+    A burst is found at many nearby DM trials, so 
+    starting with the highest SNR candidate we drop 
+    other candidates that overlap it in time once the 
+    shift from the DM difference is accounted for (the
+    rule of sift_dm_dupes in snippet_plots_sp.py, but 
+    with the dispersion constant of dedisp.py so the 
+    shifts match the dedispersion delays)
+
+    Returns outfile
+    """
+    cands = [ spcands.load_cands(sf) for sf in spfiles ]
+    if len(cands):
+        cands = np.concatenate(cands)
+    else:
+        cands = np.zeros(0, dtype=spcands.cand_dtype)
+    
+    dms = cands['DM']
+    snrs = cands['sigma']
+    tts = cands['time']
+    wws = cands['downfact'] * dt
+
+    # Time shift per unit DM of the band averaged delay
+    fhi = np.max(freqs)
+    tshift = dedisp.KDM * np.mean(freqs**-2.0 - fhi**-2.0)
+
+    # Search window in time around each candidate 
+    # has to cover the largest possible offset
+    keep = np.ones(len(cands), dtype=bool)
+    if len(cands):
+        tmax = tshift * (np.max(dms) - np.min(dms)) + 2 * np.max(wws)
+    else: 
+        tmax = 0
+    tx = np.argsort(tts, kind='stable')
+    tsort = tts[tx]
+
+    for ii in np.argsort(snrs, kind='stable')[::-1]:
+        if not keep[ii]:
+            continue
+        jlo = np.searchsorted(tsort, tts[ii] - tmax, side='left')
+        jhi = np.searchsorted(tsort, tts[ii] + tmax, side='right')
+        jj = tx[jlo:jhi]
+        jj = jj[ keep[jj] & (jj != ii) ]
+
+        dts = tshift * (dms[jj] - dms[ii])
+        dup = (np.abs(tts[ii] - tts[jj]) <= np.abs(dts) + wws[jj] + wws[ii]) &\
+              (np.sign(tts[ii] - tts[jj]) * np.sign(dts) >= 0)
+        keep[jj[dup]] = False
+
+    merged = cands[tx[keep[tx]]]
+    with open(outfile, 'w') as fout:
+        fout.write("# DM      Sigma      Time (s)     Sample    Downfact\n")
+        for cc in merged.tolist():
+            fout.write(spcands.cand_fmt %cc)
+
+    if binary:
+        spcands.write_spcands(spcands.spcands_name(outfile), merged, 
+                              dt=dt, ndm=len(spfiles),
+                              source=os.path.basename(outfile))
+    else: pass
+
+    print("  Merged %d cands from %d DMs into %d" %(\
+           len(cands), len(spfiles), np.sum(keep)))
+
+    return outfile
+
+
+def copy_products(workdir, outdir, datbase):
+    """
+    Copy the small final products of the search (the 
+    candidate list, inf files, and single pulse plot) 
+    from the scratch workdir to outdir
+    """
+    plist = glob.glob("%s/%s*.singlepulse" %(workdir, datbase)) +\
+            glob.glob("%s/%s*.spcands" %(workdir, datbase)) +\
+            glob.glob("%s/%s*.inf" %(workdir, datbase)) +\
+            glob.glob("%s/%s*singlepulse.ps" %(workdir, datbase))
+
+    for pfile in plist:
+        print("  Copying %s to %s" %(pfile, outdir))
+        shutil.copy2(pfile, outdir)
+
+    return
+
+
 def extract_snippets(filfile, outbase, splist, nspec):
     """
     Extract data around candidates and write to 
@@ -316,15 +589,47 @@ def extract_snippets(filfile, outbase, splist, nspec):
     return 
 
 
+def merge_windows(starts, nspec, maxlen):
+    """
+    Group the (sorted) snippet start samples into runs 
+    whose windows of nspec samples overlap, so each run 
+    is one read.  Runs are cut at maxlen samples.  
+    Returns a list of (i0, i1) index ranges of starts
+    """
+    groups = []
+    i0 = 0
+    for ii in range(1, len(starts)):
+        if (starts[ii] >= starts[ii-1] + nspec) or \
+           (starts[ii] + nspec - starts[i0] > maxlen):
+            groups.append((i0, ii))
+            i0 = ii
+        else: pass
+    if len(starts):
+        groups.append((i0, len(starts)))
+    else: pass
+    return groups
+
+
 def your_extract_snippets(filfile, outbase, splist, 
-                          nspec, nmax=-1):
+                          nspec, nmax=-1, nthread=4):
     """
     Extract data around candidates and write to 
     small filterbank file.  Candidates input as 
     list of SPCAND class objects.
 
     Output data will have nspec time samples
+
+    The filterbank is memory mapped and the data of 
+    overlapping snippets are read together.  Snippets 
+    get the header of the first one with tstart (and 
+    the file name) filled in, and are written by 
+    nthread threads
     """
+    import your
+    import write_filterbank as wfil 
+    from filterbank import get_dtype
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
     # Get number of zeros to bad so cand nums
     # are all the same length
     nz = int( np.ceil(np.log10(len(splist)+1)) )
@@ -334,56 +639,83 @@ def your_extract_snippets(filfile, outbase, splist,
     hdr_bytes = yr.hdrbytes
     nchans = yr.nchans
     dt = yr.tsamp 
+    dtype = get_dtype(yr.nbits)
     bps = yr.nbits // 8  # bytes per sample
 
     # Sort sp cands by time
     tt = np.array([ ss.time for ss in splist ])
     xx = np.argsort(tt)
     spsort = splist[xx]
+    if nmax > 0:
+        spsort = spsort[:nmax]
+    else:
+        pass
+    if len(spsort) == 0:
+        return
+    else: pass
 
-    with open(filfile, 'rb') as fin:
-        # Skip header bytes 
-        #fin.seek(hdr_bytes)
-
-        # Now loop over cands and extract data
-        for ii, cc in enumerate(spsort):
-            if nmax > 0 and ii >= nmax:
-                break
-            else:
-                pass
-            print("Cand %d / %d" %(ii+1, len(spsort)))
-            # Give index from orig file
-            #num_str = str(xx[ii]).zfill(nz)  
-            num_str = str(cc.cnum).zfill(nz)  
-            outfile = "%s_cand%s" %(outbase, num_str)
-
-            # start position in bytes
-            nstart = (cc.samp - nspec//2) * nchans * bps + hdr_bytes
-            # If cand is at very start of file, make sure we 
-            # we don't back up into header
-            if nstart < hdr_bytes:
-                nstart = hdr_bytes
-              
-            #print(nstart)
-            fin.seek(nstart)
-            #print(fin.tell())
-
-            # get start time 
-            tstart = cc.samp * dt
-            
-            # num to read in smaples b/c fromfile
-            nread  = nspec * nchans  
-            
-            # Get the data
-            dat = np.fromfile(fin, count=nread, dtype='f4')
-            dat = np.reshape(dat, (-1, nchans))
-            #print(dat.shape)
-    
-            # Write to file
-            if len(dat):
-                wfil.write_snippet(dat, yr, outfile, tstart)
-            else:
-                print("No data found!")
+    # Whole spectra in the file
+    nsamp = (os.path.getsize(filfile) - hdr_bytes) // (nchans * bps)
+    fdata = np.memmap(filfile, dtype=dtype, mode='r', offset=hdr_bytes, 
+                      shape=(nsamp, nchans))
+
+    # start samples.  If cand is at very start of file, make 
+    # sure we we don't back up into header
+    samps = np.array([ cc.samp for cc in spsort ])
+    starts = np.maximum(samps - nspec//2, 0)
+
+    # Read at most ~128 MB at a time
+    maxlen = max(2**27 // (nchans * bps), nspec)
+    groups = merge_windows(starts, nspec, maxlen)
+
+    template = wfil.snippet_template(yr, "%s_hdr_tmp" %outbase)
+
+    nout = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(nthread, 1)) as pool:
+        for i0, i1 in groups:
+            # Get the data of the group in one read
+            g0 = starts[i0]
+            g1 = min(starts[i1-1] + nspec, nsamp)
+            gdat = np.array(fdata[g0:g1])
+
+            for ii in range(i0, i1):
+                cc = spsort[ii]
+                if (ii+1) % 100 == 0 or ii+1 == len(spsort):
+                    print("Cand %d / %d" %(ii+1, len(spsort)))
+                else: pass
+                # Give index from orig file
+                num_str = str(cc.cnum).zfill(nz)  
+                outfile = "%s_cand%s" %(outbase, num_str)
+
+                # get start time 
+                tstart = cc.samp * dt
+
+                dat = gdat[starts[ii]-g0:starts[ii]-g0+nspec]
+
+                # Write to file
+                if len(dat):
+                    pending.append(pool.submit(wfil.write_snippet_fast,
+                                               dat, template, outfile, 
+                                               tstart))
+                    nout += 1
+                else:
+                    print("No data found!")
+
+            # Don't let the writes (and the data they hold) 
+            # fall too far behind
+            while len(pending) > 4 * max(nthread, 1):
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for ff in done:
+                    ff.result()
+                pending = list(not_done)
+
+        for ff in pending:
+            ff.result()
+
+    print("Wrote %d snippets (%d reads)" %(nout, len(groups)))
+
+    del fdata
 
     return 
 
@@ -423,9 +755,21 @@ def parse_input():
                 '60Hz signal and 5 harmonics with width 1.0Hz).  To zap '+\
                 'multiple frequencies, repeat this argument',
            action='append', required=False, default=[])
+    parser.add_argument('--autofilter', action='store_true',
+           help='Find periodic RFI (birdies) in the dedispersed time ' +\
+                'series and add them to the filter list')
+    parser.add_argument('-fe', '--filter_engine', default='sos', 
+           choices=['sos', 'fft'], required=False, 
+           help='Filter each frequency with a bandstop filter (sos) or ' +\
+                'zero them all in one FFT (fft).  The streaming search ' +\
+                'always uses sos (def: sos)')
     parser.add_argument('-mw', '--maxwidth', required=False, 
            help='Max boxcar width in ms for SP search (def: 10)',
            type=float, default=10.0)
+    parser.add_argument('-mr', '--multires', required=False, 
+           help='Search boxcars wider than this many bins on time ' +\
+                'series decimated by 2 per level (def: 0, all at ' +\
+                'full resolution)', type=int, default=0)
     parser.add_argument('-mc', '--maxcands', required=False, 
            help='Max cands for plotting. ' +\
                 'Do not plot if exceeds this number. (def = -1, no lim)',
@@ -436,12 +780,56 @@ def parse_input():
            help='Ignore bad blocks in single pulse search')
     parser.add_argument('-tel', '--tel', default='RO', required=False, 
            help='DSN Telescope Name GS/RO/CN (def: RO)')
+    parser.add_argument('--metrics', default=None, required=False, 
+           help='Write per stage resource use to this JSON file')
+    parser.add_argument('--dedisp', default='native', required=False, 
+           choices=['native', 'presto'], 
+           help='Dedisperse with dedisp.py (native) or prepdata ' +\
+                '(presto) (def: native)')
+    parser.add_argument('-nt', '--nthread', default=1, type=int, 
+           help='Number of threads for dedispersion and ' +\
+                'snippet writing, and processes for the ' +\
+                'single pulse search (def: 1)', 
+           required=False)
+    parser.add_argument('-dmr', '--dmrange', default=0.0, type=float, 
+           help='Also search DM trials within +/- dmrange of -dm ' +\
+                '(def: 0, only search -dm)', required=False)
+    parser.add_argument('-dmtol', '--dmtol', default=1.25, type=float, 
+           help='DM trial spacing in units of the effective time ' +\
+                'resolution across the band (def: 1.25)', required=False)
+    parser.add_argument('-ddsub', '--ddsub', default=0, type=int, 
+           help='Number of subbands for DM trial dedispersion ' +\
+                '(def: 0, about sqrt(nchans))', required=False)
+    parser.add_argument('--scratch', default=None, required=False, 
+           help='Directory (ideally local disk) for the intermediate ' +\
+                'dat and snippet files.  Candidate lists and plots ' +\
+                'still go to outdir (def: use outdir)')
+    parser.add_argument('--stream', action='store_true',
+           help='Dedisperse, filter, and search in one pass without ' +\
+                'writing dat files (native dedispersion only)')
+    parser.add_argument('--keep_dat', action='store_true',
+           help='Also write the dat files in --stream mode')
+    parser.add_argument('--spcands', action='store_true',
+           help='Also write the candidates to binary spcands files ' +\
+                '(read much faster than the singlepulse text)')
 
     args = parser.parse_args()
 
     return args
 
 
+def exit_failed(metrics_file):
+    """
+    Write out the stage records so far (if we have a 
+    metrics file) and exit with a nonzero status so the 
+    calling script knows the search did not finish
+    """
+    if metrics_file is not None:
+        rmet.dump_records(metrics_file)
+    else: pass
+    sys.exit(1)
+
+
 def main():
     """
     Run processing
@@ -480,24 +868,50 @@ def main():
     else:
         fzap_str = "No filtering"
     print("  Filtering (f0, nh, W): %s" %fzap_str)
+    autofilter = args.autofilter
+    print("  Automatic birdie filtering: %r" %autofilter)
+    fengine = args.filter_engine
+    print("  Filter engine: %s" %fengine)
     mw = args.maxwidth
     print("  Max single pulse template width: %.1fms" %mw)
+    multires = args.multires
+    print("  Full resolution boxcars up to: %d bins" %multires)
     tel = args.tel
     print("  Telescope: %s" %tel)
     max_cands = args.maxcands
     print("  Max cands for plotting: %d" %max_cands)
+    metrics_file = args.metrics
+    dd_engine = args.dedisp
+    print("  Dedispersion: %s" %dd_engine)
+    nthread = args.nthread
+    print("  Number of threads: %d" %nthread)
+    dmr = args.dmrange
+    print("  DM search range: +/- %.2f pc/cc" %dmr)
+    stream = args.stream
+    if stream and dd_engine != 'native':
+        print("  --stream needs native dedispersion, not streaming")
+        stream = False
+    print("  Streaming search: %r" %stream)
+    print("  Binary cand files: %r" %args.spcands)
+    workdir = args.scratch
+    if workdir is None:
+        workdir = outdir
+    print("  Work Directory: %s" %workdir)
     print("===================\n\n")
 
     # Check that fil file and output dir exist
     if not os.path.exists(filfile):
         print("Filterbank file not found!")
         print("   %s" %filfile)
-        return 
+        exit_failed(metrics_file)
     # Check if output directory exists
     if not os.path.exists(outdir):
         print("Output directory does not exist!")
         print("   %s" %outdir)
-        return 
+        exit_failed(metrics_file)
+    # Make scratch directory if needed
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
 
     ### Run fix file ###
     dsn = True
@@ -509,20 +923,89 @@ def main():
     ### Get zap channel string ###
     zstr = get_zap_chans(ezap, nchansub, nsub, zchans=zap)
 
-    ### Dedisperse ###
-    print("\n\n===== DEDISPERSION =====")
-    datfile = dedisperse(filfile, dm, zstr, zdm=zdm, outdir=outdir)
+    # Plan DM trials if searching a range
+    freqs = fch1 + foff * np.arange(nchans)
+    filbase = (filfile.split("/")[-1]).split(".fil")[0] 
+    if dmr > 0:
+        dms = dedisp.plan_dm_trials(dm, dm - dmr, dm + dmr, freqs, dt, 
+                                    tol=args.dmtol)
+        print("  %d DM trials from %.3f to %.3f" %(\
+               len(dms), dms[0], dms[-1]))
+        sbase = "%s_DM%.3f-%.3f" %(filbase, dms[0], dms[-1])
+    else:
+        dms = np.array([dm])
+        sbase = "%s_DM%.3f" %(filbase, dm)
 
-    ### Frequency Filter ###
-    print("\n\n===== FILTERING =====")
-    datfile = filter_dat(datfile, filter_list)
+    # Size of the 32-bit dedispersed time series (one 
+    # per DM trial)
+    dat_bytes = len(dms) * 4 * get_nspec(filfile)
 
-    ### Single Pulse Search ###
-    print("\n\n===== SP SEARCH =====")
     mw_sec = mw * 1e-3
     mw_bins = min( int(mw_sec/dt), 8000 ) 
-    spfile = sp_search(datfile, snr, bb=blocks, 
-                       maxwidth=mw_sec, dtrendlen=32)
+
+    if stream:
+        ### Dedisperse + Filter + Search in one pass ###
+        print("\n\n===== STREAMING SP SEARCH =====")
+        if args.keep_dat and \
+           not hp.check_free_space(workdir, dat_bytes, "dedispersion"):
+            exit_failed(metrics_file)
+        if autofilter:
+            filter_list = filter_list + auto_filter(filfile, dm, zstr, 
+                                                    zdm=zdm, nthread=nthread)
+        else: pass
+        spfiles = [ stream_search(filfile, dm_ii, zstr, filter_list, snr, 
+                                  zdm=zdm, outdir=workdir, bb=blocks, 
+                                  maxwidth=mw_sec, nthread=nthread, tel=tel, 
+                                  keep_dat=args.keep_dat, multires=multires,
+                                  binary=args.spcands)
+                    for dm_ii in dms ]
+
+    else:
+        ### Dedisperse ###
+        print("\n\n===== DEDISPERSION =====")
+        if not hp.check_free_space(workdir, dat_bytes, "dedispersion"):
+            exit_failed(metrics_file)
+        if len(dms) > 1:
+            datfiles = dedisperse_trials(filfile, dms, zstr, zdm=zdm, 
+                                         outdir=workdir, engine=dd_engine, 
+                                         nthread=nthread, tel=tel, 
+                                         nsub=args.ddsub)
+        else:
+            datfiles = [ dedisperse(filfile, dm, zstr, zdm=zdm, 
+                                    outdir=workdir, engine=dd_engine, 
+                                    nthread=nthread, tel=tel) ]
+
+        ### Frequency Filter ###
+        print("\n\n===== FILTERING =====")
+        if autofilter:
+            # Birdies from the trial nearest the input DM
+            idm = np.argmin(np.abs(dms - dm))
+            filter_list = filter_list + auto_filter(filfile, dms[idm], zstr, 
+                                                    datfile=datfiles[idm])
+        else: pass
+        if len(filter_list) and \
+           not hp.check_free_space(workdir, dat_bytes, "filtering"):
+            exit_failed(metrics_file)
+        datfiles = [ filter_dat(df, filter_list, engine=fengine) 
+                     for df in datfiles ]
+
+        ### Single Pulse Search ###
+        print("\n\n===== SP SEARCH =====")
+        spfiles = sp_search(datfiles, snr, bb=blocks, 
+                            maxwidth=mw_sec, dtrendlen=32, 
+                            multires=multires, nproc=nthread,
+                            binary=args.spcands)
+
+    # Merge cands from all DM trials 
+    if len(spfiles) > 1:
+        spfile = merge_dm_cands(spfiles, "%s/%s.singlepulse" %(workdir, sbase), 
+                                freqs, dt, binary=args.spcands)
+    else:
+        spfile = spfiles[0]
+
+    # Candidate lists are final products
+    if workdir != outdir:
+        copy_products(workdir, outdir, filbase)
 
     # Read cands from SP file
     splist = cands_from_spfile(spfile)
@@ -546,15 +1029,23 @@ def main():
     print("\n\n===== EXTRACT CAND DATA =====")
     
     # Get output base
-    filbase = (filfile.split("/")[-1]).split(".fil")[0] 
-    outbase =  "%s/%s_DM%.3f" %(outdir, filbase, dm)
+    outbase =  "%s/%s" %(workdir, sbase)
 
     # Set spec + extract data
     nspec = int( width / dt + 0.5 )
-    your_extract_snippets(filfile, outbase, splist, nspec, nmax=nplot)
+    if nplot > -1:
+        nsnip = min(nplot, ncands)
+    else:
+        nsnip = ncands
+    snip_bytes = nsnip * nspec * nchans * 4
+    if not hp.check_free_space(workdir, snip_bytes, "snippets"):
+        exit_failed(metrics_file)
+    with rmet.stage("extraction", ncands=ncands):
+        your_extract_snippets(filfile, outbase, splist, nspec, nmax=nplot,
+                              nthread=nthread)
 
     ### Make plots from candidates ###
-    sbase = "%s_DM%.3f" %(filbase, dm)
+    import snippet_plots_sp as sp_plt
     # Set dec factor to get about 100 channels
     f_dec = max( int(nchans/100), 1 )
     nbins=100
@@ -562,8 +1053,9 @@ def main():
     rmax=-1
 
     # Make summary plots
-    sp_plt.make_summary_plots(spfile, outdir, sbase, 
-                              outdir=outdir, rmax=rmax)
+    with rmet.stage("summary_plots", ncands=ncands):
+        sp_plt.make_summary_plots(spfile, workdir, sbase, 
+                                  outdir=outdir, rmax=rmax)
 
     # Make cand plots
     pzstr = get_zap_chans(ezap, nchansub, nsub, zchans=zap, flip=False)
@@ -572,10 +1064,14 @@ def main():
         plt_splist = splist[: nplot] 
     else:
         plt_splist = spfile
-    sp_plt.make_snippet_plots(plt_splist, outdir, sbase, outdir=outdir, 
-                              snr_min=snr, wmax=wmax, t_dec=-1, 
-                              f_dec=f_dec, outbins=nbins, rmax=rmax, 
-                              zstr=pzstr)
+    with rmet.stage("cand_plots", ncands=ncands):
+        sp_plt.make_snippet_plots(plt_splist, workdir, sbase, outdir=outdir, 
+                                  snr_min=snr, wmax=wmax, t_dec=-1, 
+                                  f_dec=f_dec, outbins=nbins, rmax=rmax, 
+                                  zstr=pzstr)
+
+    if metrics_file is not None:
+        rmet.dump_records(metrics_file)
 
     return
 
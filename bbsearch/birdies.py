@@ -0,0 +1,418 @@
+import time
+import numpy as np
+from scipy import fft as sfft
+from scipy import ndimage, optimize, signal, stats
+from argparse import ArgumentParser
+import dat_filter
+import dedisp
+
+
+###########################
+##  POWER SPECTRUM       ##
+###########################
+
+def get_nfft(nsamp, dt, df=0.05, min_seg=4):
+    """
+    FFT length (power of 2) for a frequency resolution of
+    about df Hz, made shorter if needed so that nsamp
+    samples give at least min_seg segments to average
+    """
+    nfft = 2**int(np.ceil(np.log2(1.0 / (df * dt))))
+    nmax = 2**int(np.floor(np.log2(max(nsamp // min_seg, 2))))
+    return min(nfft, nmax)
+
+
+def get_norm_blocks(nn, nblk=1024, nmin=8):
+    """
+    Edges of the blocks used to get the local median power.
+    Low frequencies can be red, so the blocks start at nmin
+    bins and grow to half their starting bin, up to nblk
+    """
+    edges = [1]
+    while edges[-1] < nn:
+        ww = min(max(edges[-1] // 2, nmin), nblk)
+        edges.append(edges[-1] + ww)
+    edges[-1] = nn
+    if len(edges) > 2 and edges[-1] - edges[-2] < nmin:
+        edges.pop(-2)
+    else: pass
+    return np.array(edges)
+
+
+def local_median(powers, nblk=1024):
+    """
+    Local median of the powers, from the medians in the
+    blocks from get_norm_blocks interpolated between the
+    block centers
+    """
+    nn = len(powers)
+    edges = get_norm_blocks(nn, nblk=nblk)
+    meds = np.array([ np.median(powers[edges[ii] : edges[ii+1]]) \
+                      for ii in range(len(edges) - 1) ])
+    meds[meds <= 0] = np.max(meds)
+    xx = 0.5 * (edges[:-1] + edges[1:] - 1)
+    return np.interp(np.arange(nn), xx, meds)
+
+
+def avg_power_spectrum(blocks, nfft):
+    """
+    Average power spectrum of a time series that arrives
+    as consecutive blocks (eg, from a memory map or from
+    dedispersion).  The series is split into segments of
+    nfft samples (any partial segment at the end is
+    dropped), each of which has its mean removed and a
+    Hann window applied before the FFT.  Each segment is
+    divided by its local median power so that a stretch
+    of bad data does not swamp the average.
+
+    Returns the mean (relative) power in each of the nfft//2 + 1
+    frequency bins and the number of segments
+    """
+    win = signal.windows.hann(nfft, sym=False).astype('float32')
+    psum = np.zeros(nfft // 2 + 1)
+    nseg = 0
+
+    buf = np.zeros(0, dtype='float32')
+    for blk in blocks:
+        buf = np.concatenate( (buf, blk) )
+        nn = len(buf) // nfft
+        for ii in range(nn):
+            seg = buf[ii * nfft : (ii + 1) * nfft]
+            seg = (seg - np.mean(seg)) * win
+            pseg = np.abs(sfft.rfft(seg))**2
+            psum += pseg / local_median(pseg)
+            nseg += 1
+        buf = buf[nn * nfft :]
+
+    if nseg:
+        psum /= nseg
+    else: pass
+
+    return psum, nseg
+
+
+def normalize_powers(powers, nseg, nblk=1024):
+    """
+    Divide out the local median of the powers so that
+    noise has a mean normalized power of 1.  The mean of
+    nseg segments follows a gamma distribution, whose
+    median we use to go from median to mean
+    """
+    gmed = stats.gamma.median(nseg, scale=1.0/nseg)
+    pnorm = powers / local_median(powers, nblk=nblk) * gmed
+    pnorm[0] = 1.0
+
+    return pnorm
+
+
+###########################
+##  HARMONIC DETECTION   ##
+###########################
+
+def harmonic_sum(pnorm, nharm):
+    """
+    Sum the normalized powers of the first nharm harmonics
+    of each fundamental bin.  We only know the fundamental
+    frequency to half a bin, so harmonic h of bin k uses
+    the largest power within h//2 bins of h * k
+    """
+    nfund = (len(pnorm) - 1) // nharm + 1
+    kk = np.arange(nfund)
+    hsum = np.zeros(nfund)
+    for hh in range(1, nharm + 1):
+        pmax = ndimage.maximum_filter1d(pnorm, size=2 * (hh // 2) + 1)
+        hsum += pmax[hh * kk]
+    return hsum
+
+
+def hsum_sigma(hmax, hsum, nh, nseg, ntrials):
+    """
+    Significance of the largest harmonic sum hmax given
+    all of the sums hsum of nh harmonics.  A sum of nh
+    noise powers (each averaged over nseg segments) is
+    gamma distributed, but the max over neighbouring bins
+    shifts and stretches it, so we match the median and
+    MAD of hsum to those of the gamma distribution before
+    getting the false alarm probability over ntrials
+    """
+    gg = stats.gamma(nh * nseg, scale=1.0/nseg)
+    gmed = gg.median()
+    gmad = optimize.brentq(lambda xx: gg.cdf(gmed + xx) - \
+                           gg.cdf(gmed - xx) - 0.5, 0, 10 * gg.std())
+
+    med = np.median(hsum)
+    mad = np.median(np.abs(hsum - med))
+    if mad <= 0:
+        return 0.0
+    else: pass
+
+    xx = gmed + (hmax - med) / mad * gmad
+    logp = gg.logsf(xx) + np.log(ntrials)
+    if not np.isfinite(logp):
+        # Beyond the gamma tail in double precision
+        sigma = (hmax - med) / (1.4826 * mad)
+    elif logp > np.log(0.5):
+        sigma = 0.0
+    elif logp < -600:
+        sigma = np.sqrt(-2 * logp)
+    else:
+        sigma = stats.norm.isf(np.exp(logp))
+    return sigma
+
+
+def get_harmonics(pnorm, k0, pthresh, hmax=64, ngap=4):
+    """
+    Find the harmonics of the fundamental near bin k0.
+    The fundamental is refined from each harmonic we find,
+    so harmonic h is the peak within the uncertainty of
+    h times the current fundamental (plus a bin), and is
+    significant if its power is above pthresh.  We stop
+    after ngap missing harmonics in a row.
+
+    Returns the bins of the significant harmonic peaks
+    and their harmonic numbers
+    """
+    nn = len(pnorm)
+    peaks = []
+    harms = []
+    fest = float(k0)
+    hlast = 1
+    nmiss = 0
+    for hh in range(1, hmax + 1):
+        hc = int(round(hh * fest))
+        dh = int(np.ceil(0.5 * hh / hlast)) + 1
+        lo = max(hc - dh, 1)
+        hi = min(hc + dh + 1, nn)
+        if lo >= hi:
+            break
+        else: pass
+        pk = lo + np.argmax(pnorm[lo:hi])
+        if pnorm[pk] > pthresh:
+            peaks.append(pk)
+            harms.append(hh)
+            fest = pk / float(hh)
+            hlast = hh
+            nmiss = 0
+        else:
+            nmiss += 1
+            if nmiss >= ngap:
+                break
+            else: pass
+    return np.array(peaks, dtype=int), np.array(harms, dtype=int)
+
+
+def peak_halfwidth(pnorm, pk, pthresh):
+    """
+    Half width (in bins) of the region around peak pk
+    where the normalized power stays above pthresh
+    """
+    nn = len(pnorm)
+    lo = pk
+    while lo > 0 and pnorm[lo - 1] > pthresh:
+        lo -= 1
+    hi = pk
+    while hi < nn - 1 and pnorm[hi + 1] > pthresh:
+        hi += 1
+    return max(pk - lo, hi - pk) + 1
+
+
+def find_birdies(pnorm, df, nseg, fmin=1.0, nharm=16, sigma=6.0,
+                 hsigma=5.0, wmin=0.25, maxfam=5):
+    """
+    Find families of harmonically related spikes (birdies)
+    in the normalized power spectrum pnorm (bins of df Hz,
+    averaged over nseg segments).
+
+    Each round we harmonic sum 1, 2, 4, ... nharm harmonics
+    and take the most significant fundamental above fmin
+    if its sum is significant at sigma (after trials).  The
+    harmonics of that fundamental are then checked one by
+    one against a per-bin threshold of hsigma to get the
+    number of harmonics, a better fundamental (from the
+    highest harmonic), and the width of the peaks (at
+    least wmin Hz).  Those bins are flattened before
+    looking for the next family, up to maxfam families.
+
+    Returns a list of (f0, number of harmonics beyond f0,
+    width) as used by dat_filter.py
+    """
+    pn = pnorm.copy()
+    nn = len(pn)
+    kmin = max(int(np.ceil(fmin / df)), 1)
+    pthresh = stats.gamma.isf(stats.norm.sf(hsigma), nseg, scale=1.0/nseg)
+
+    hlist = [ 2**ii for ii in range(int(np.log2(nharm)) + 1) ]
+    zaps = []
+    for ifam in range(maxfam):
+        best = None
+        for nh in hlist:
+            hsum = harmonic_sum(pn, nh)
+            if len(hsum) <= kmin:
+                continue
+            else: pass
+            ii = kmin + np.argmax(hsum[kmin:])
+            zz = hsum_sigma(hsum[ii], hsum[kmin:], nh, nseg,
+                            len(hsum) - kmin)
+            if zz > sigma and (best is None or zz > best[0]):
+                best = (zz, ii, nh)
+            else: pass
+
+        if best is None:
+            break
+        else: pass
+
+        zbest, k0, nh = best
+        peaks, harms = get_harmonics(pn, k0, pthresh)
+        if len(peaks) == 0:
+            # Only significant as a sum, use the fundamental bin
+            peaks = np.array([k0])
+            harms = np.array([1])
+        else: pass
+
+        f0 = peaks[-1] * df / harms[-1]
+        nhw = max([ peak_halfwidth(pn, pk, pthresh) for pk in peaks ])
+        width = max(nhw * df, wmin)
+        width = min(width, 0.25 * f0)
+        zaps.append( (f0, harms[-1] - 1, width) )
+        print("  Birdie f0 = %.4f Hz, %d harmonics, width %.3f Hz " %(\
+               f0, harms[-1], width) + "(%.1f sigma with %d harmonics)" %(\
+               zbest, nh))
+
+        # Flatten the family before looking for more
+        for hh in range(1, harms[-1] + 1):
+            lo = max(int(np.floor((hh * f0 - width) / df)), 0)
+            hi = min(int(np.ceil((hh * f0 + width) / df)) + 1, nn)
+            pn[lo:hi] = 1.0
+
+    return zaps
+
+
+def zap_strings(zaps):
+    """
+    Convert (f0, nh, width) into f0,nh,width strings
+    for dat_filter.py -z (or bbsearch.py -f)
+    """
+    return [ "%.4f,%d,%.3f" %(f0, nh, ww) for f0, nh, ww in zaps ]
+
+
+def get_birdies(blocks, nsamp, dt, df=0.05, fmin=1.0, nharm=16,
+                sigma=6.0, hsigma=5.0, wmin=0.25, maxfam=5):
+    """
+    Find birdies in a time series of nsamp samples that
+    arrives as consecutive blocks.  See find_birdies for
+    the options.  Returns the dat_filter zap strings
+    """
+    tstart = time.time()
+
+    nfft = get_nfft(nsamp, dt, df=df)
+    print("Birdie search: %d pt FFTs (%.4f Hz resolution)" %(\
+           nfft, 1.0 / (nfft * dt)))
+    powers, nseg = avg_power_spectrum(blocks, nfft)
+    if nseg == 0:
+        print("  Time series too short for birdie search")
+        return []
+    else: pass
+
+    pnorm = normalize_powers(powers, nseg)
+    zaps = find_birdies(pnorm, 1.0 / (nfft * dt), nseg, fmin=fmin,
+                        nharm=nharm, sigma=sigma, hsigma=hsigma,
+                        wmin=wmin, maxfam=maxfam)
+
+    tstop = time.time()
+    print("  Found %d birdie families in %d segments -- %.1f sec" %(\
+           len(zaps), nseg, tstop - tstart))
+
+    return zap_strings(zaps)
+
+
+def dat_birdies(datfile, dt, block_mb=64.0, **kwargs):
+    """
+    Find birdies in a dat file (read through a memory
+    map in blocks of block_mb MB)
+    """
+    dat = np.memmap(datfile, dtype='float32', mode='r')
+    nblk = max(int(block_mb * 2**20 / 4), 1024)
+    blocks = ( dat[ii : ii + nblk] for ii in range(0, len(dat), nblk) )
+    return get_birdies(blocks, len(dat), dt, **kwargs)
+
+
+def fil_birdies(filfile, dm, zap_chans=[], zerodm=False, nthread=1,
+                **kwargs):
+    """
+    Find birdies in filfile dedispersed at dm without
+    writing the time series (for the streaming search)
+    """
+    hdr, data, good, delays, nout = dedisp.dedisp_setup(filfile, dm,
+                                                        zap_chans)
+    if data is None:
+        return []
+    else: pass
+    blocks = dedisp.dedisp_stream(data, good, delays, nout, zerodm=zerodm,
+                                  nthread=nthread)
+    return get_birdies(blocks, nout, hdr['tsamp'], **kwargs)
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Find periodic RFI (birdies) in a *.dat file"
+    parser = ArgumentParser(description=prog_desc)
+    parser.add_argument('datfile', help='Time series *.dat file')
+    parser.add_argument('-df', '--df', default=0.05, type=float,
+                        help='Frequency resolution in Hz (def: 0.05)',
+                        required=False)
+    parser.add_argument('-fmin', '--fmin', default=1.0, type=float,
+                        help='Lowest fundamental in Hz (def: 1)',
+                        required=False)
+    parser.add_argument('-nh', '--nharm', default=16, type=int,
+                        help='Max harmonics to sum (def: 16)',
+                        required=False)
+    parser.add_argument('-s', '--sigma', default=6.0, type=float,
+                        help='Harmonic sum threshold (def: 6)',
+                        required=False)
+    parser.add_argument('-hs', '--hsigma', default=5.0, type=float,
+                        help='Threshold for each harmonic (def: 5)',
+                        required=False)
+    parser.add_argument('-w', '--wmin', default=0.25, type=float,
+                        help='Minimum zap width in Hz (def: 0.25)',
+                        required=False)
+    parser.add_argument('-n', '--maxfam', default=5, type=int,
+                        help='Max number of families (def: 5)',
+                        required=False)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Run birdie search and print the zap list
+    """
+    args = parse_input()
+
+    datfile, inffile, retval = dat_filter.check_files(args.datfile)
+    if retval:
+        return
+    else: pass
+
+    dt = dat_filter.get_dt_from_inf(inffile)
+    zlist = dat_birdies(datfile, dt, df=args.df, fmin=args.fmin,
+                        nharm=args.nharm, sigma=args.sigma,
+                        hsigma=args.hsigma, wmin=args.wmin,
+                        maxfam=args.maxfam)
+
+    print("")
+    print(" ".join([ "-z %s" %zz for zz in zlist ]))
+
+    return
+
+
+debug = 0
+
+if __name__ == "__main__":
+    if debug:
+        pass
+    else:
+        main()
@@ -5,6 +5,7 @@ import sys
 import shutil
 import time
 from scipy import signal
+from scipy import fft as sfft
 from argparse import ArgumentParser
 
 def get_dt_from_inf(inf_file):
@@ -124,7 +125,178 @@ def get_filter_freq_ranges(freqs, nharms, widths, fnyq):
     return fcenters, fstarts, fstops
 
 
-def filter_harms(datfile, dt, freqs, nharms, widths, outbase=None):
+def get_filters(dt, freqs, nharms, widths):
+    """
+    Get the bandstop filters (as sos) for all the
+    f0,nh,w zaps.  Returns the center frequencies
+    and the list of filters
+    """
+    fnyq = 1 / (2.0 * dt)
+    fcs, flos, fhis = get_filter_freq_ranges(freqs, nharms, widths, fnyq)
+    sos_list = [ butter_bandstop(fnyq, flos[ii], fhis[ii], order=3)
+                 for ii in range(len(fcs)) ]
+    return fcs, sos_list
+
+
+def filter_block(dat, sos_list):
+    """
+    Apply each (zero phase) filter in sos_list to dat
+    """
+    for sos in sos_list:
+        dat = signal.sosfiltfilt(sos, dat)
+    return dat
+
+
+def get_edge_len(sos_list, tol=1e-6, npiece=2**16, nmax=2**26):
+    """
+    Number of samples it takes the impulse response of
+    the filters in sos_list (applied in series) to decay
+    below tol.  A block filtered with this many extra
+    samples on either side matches filtering the whole
+    series (to about tol) away from the extra samples.
+
+    The response is computed in pieces of npiece samples
+    so narrow notches do not need a huge array
+    """
+    zi = [ np.zeros((sos.shape[0], 2)) for sos in sos_list ]
+    xx = np.zeros(npiece)
+    xx[0] = 1.0
+
+    nedge = 0
+    for ii in range(0, nmax, npiece):
+        yy = xx
+        for jj, sos in enumerate(sos_list):
+            yy, zi[jj] = signal.sosfilt(sos, yy, zi=zi[jj])
+        big = np.flatnonzero(np.abs(yy) > tol)
+        if len(big) == 0:
+            break
+        nedge = ii + big[-1] + 1
+        xx = np.zeros(npiece)
+
+    return nedge
+
+
+def filter_stream(blocks, sos_list, nedge, nmin=2**18):
+    """
+    Filter a time series that arrives as consecutive
+    blocks (eg, from dedispersion) and yield the filtered
+    series as float32 blocks.
+
+    Each output block is filtered along with nedge
+    samples (see get_edge_len) of the data on either
+    side, so only about 2 * nedge + nmin samples are
+    held at a time.  Output blocks are at least nmin
+    samples (except the last one)
+    """
+    nmin = max(nmin, nedge)
+    buf = np.zeros(0, dtype='float32')
+    buf0 = 0  # Sample number of buf[0]
+    nout = 0  # Samples yielded so far
+
+    for blk in blocks:
+        buf = np.concatenate( (buf, blk) )
+        nend = buf0 + len(buf) - nedge
+        if nend - nout < nmin:
+            continue
+        else: pass
+
+        fdat = filter_block(buf.astype('float64'), sos_list)
+        yield fdat[nout - buf0 : nend - buf0].astype('float32')
+        nout = nend
+
+        # Keep nedge samples before the next output
+        ncut = max(nout - nedge - buf0, 0)
+        buf = buf[ncut:]
+        buf0 += ncut
+
+    if buf0 + len(buf) > nout:
+        fdat = filter_block(buf.astype('float64'), sos_list)
+        yield fdat[nout - buf0 :].astype('float32')
+
+    return
+
+
+def notch_gain(nfreq, df, flos, fhis, taper=0.0):
+    """
+    Gain for each of the nfreq bins (spaced by df Hz) of 
+    a real FFT with notches from flos to fhis (Hz).  The 
+    gain is zero in the notches and, if taper > 0, rises 
+    back to one over taper Hz on either side following 
+    a cosine
+    """
+    gain = np.ones(nfreq, dtype='float32')
+    ntap = int(taper / df)
+
+    for flo, fhi in zip(flos, fhis):
+        ilo = max(int(np.ceil(flo / df)), 0)
+        ihi = min(int(np.floor(fhi / df)), nfreq - 1)
+        if ihi < ilo:
+            continue
+        else: pass
+        gain[ilo : ihi + 1] = 0
+
+        if ntap > 0:
+            xx = np.arange(1, ntap + 1) / float(ntap)
+            gtap = (0.5 - 0.5 * np.cos(np.pi * xx)).astype('float32')
+            klo = np.arange(ilo - 1, ilo - ntap - 1, -1)
+            khi = np.arange(ihi + 1, ihi + ntap + 1)
+            for kk in [klo, khi]:
+                ok = (kk >= 0) & (kk < nfreq)
+                gain[kk[ok]] = np.minimum(gain[kk[ok]], gtap[ok])
+        else: pass
+
+    return gain
+
+
+def fft_notch(dat, dt, flos, fhis, taper=0.0):
+    """
+    Zero (or taper, see notch_gain) all the bands from 
+    flos to fhis (Hz) in one real FFT of dat and then 
+    transform back.  The cost is the same no matter how 
+    many bands we zap.  float32 data stays float32
+    """
+    nn = len(dat)
+    spec = sfft.rfft(dat)
+    spec *= notch_gain(len(spec), 1.0 / (nn * dt), flos, fhis, taper=taper)
+    return sfft.irfft(spec, n=nn)
+
+
+def filter_file_stream(datfile, out_dat, sos_list, block_mb=64.0):
+    """
+    Filter datfile with the filters in sos_list and write 
+    the result to out_dat without loading either file.
+
+    The input is memory mapped and read in float32 blocks 
+    of about block_mb MB which go through filter_stream 
+    with enough extra samples at the edges for the filter 
+    transients to die out (see get_edge_len).  The output 
+    is a preallocated memory map, so peak memory is a few 
+    blocks no matter how long the file is
+    """
+    dat = np.memmap(datfile, dtype='float32', mode='r')
+    nn = len(dat)
+    nblk = max(int(block_mb * 2**20 / 4), 1024)
+
+    nedge = get_edge_len(sos_list)
+    print("Filtering %d samples in blocks of %d (%d edge samples)" %(\
+           nn, nblk, nedge))
+
+    out = np.memmap(out_dat, dtype='float32', mode='w+', shape=(nn,))
+    blocks = ( dat[ii : ii + nblk] for ii in range(0, nn, nblk) )
+
+    istart = 0
+    for fblk in filter_stream(blocks, sos_list, nedge, nmin=nblk):
+        out[istart : istart + len(fblk)] = fblk
+        istart += len(fblk)
+
+    out.flush()
+    del out
+
+    return out_dat
+
+
+def filter_harms(datfile, dt, freqs, nharms, widths, outbase=None, 
+                 engine='sos', taper=0.0, block_mb=0):
     """
     Filter out freq f0 and nharms harmonics.
     from the fb file.
@@ -133,8 +305,18 @@ def filter_harms(datfile, dt, freqs, nharms, widths, outbase=None):
             -1 : filter all harmonics up to Nyquist
              N : filter f0, 2f0, ..., (N+1)f0
 
-    Typical attenuation is ~120-150 dB around the filtered
-    frequencies.
+    engine = 'sos' runs a butterworth bandstop filter
+             forward and backward for each frequency.
+             Typical attenuation is ~120-150 dB around 
+             the filtered frequencies.
+
+             'fft' zeros all the bands in one real FFT
+             of the whole series (see fft_notch), with 
+             a cosine taper of taper Hz at the edges
+
+    If block_mb > 0, the sos engine streams the data 
+    through memory in blocks of about block_mb MB 
+    (see filter_file_stream) instead of loading it all
     """
     tstart = time.time()
     
@@ -152,20 +334,27 @@ def filter_harms(datfile, dt, freqs, nharms, widths, outbase=None):
         out_dat = "%s_filter.dat" %basename
         out_inf = "%s_filter.inf" %basename
 
-    # read data
-    print("Reading data from: %s" %datfile)
-    dat = np.fromfile(datfile, dtype='f4')
-
-    for ii in np.arange(0, len(fcs), 1):
-        print("Filtering frequency: %.1f Hz" %(fcs[ii]))
-        f_start = flos[ii]
-        f_stop  = fhis[ii]
-        sos = butter_bandstop(fnyq, f_start, f_stop, order=3)
-        dat = signal.sosfiltfilt(sos, dat)
+    if engine == 'sos' and block_mb > 0:
+        fcs, sos_list = get_filters(dt, freqs, nharms, widths)
+        filter_file_stream(datfile, out_dat, sos_list, block_mb=block_mb)
 
-    # Write dat file
-    dat = dat.astype('f4')
-    dat.tofile(out_dat)
+    else:
+        # read data
+        print("Reading data from: %s" %datfile)
+        dat = np.fromfile(datfile, dtype='f4')
+
+        if engine == 'fft':
+            print("Notching %d frequencies in one FFT" %(len(fcs)))
+            dat = fft_notch(dat, dt, flos, fhis, taper=taper)
+        else:
+            fcs, sos_list = get_filters(dt, freqs, nharms, widths)
+            for ii, sos in enumerate(sos_list):
+                print("Filtering frequency: %.1f Hz" %(fcs[ii]))
+                dat = signal.sosfiltfilt(sos, dat)
+
+        # Write dat file
+        dat = dat.astype('f4')
+        dat.tofile(out_dat)
 
     # Copy inf file with new name
     shutil.copyfile(inffile, out_inf)
@@ -196,6 +385,19 @@ def parse_input():
                              '(def: same as input but with \"_filter\" '+\
                              'appended)',
                         required=False)
+    parser.add_argument('-e', '--engine', default='sos',
+                        choices=['sos', 'fft'], required=False,
+                        help='Filter with a butterworth bandstop for each ' +\
+                             'frequency (sos) or zero all of them in one ' +\
+                             'FFT (fft) (def: sos)')
+    parser.add_argument('-t', '--taper', default=0.0, type=float,
+                        help='Width (Hz) of cosine taper at the edges of ' +\
+                             'the fft notches (def: 0, hard edges)',
+                        required=False)
+    parser.add_argument('-b', '--block_mb', default=0, type=float,
+                        help='Stream the data through memory in blocks of ' +\
+                             'this many MB (sos engine only, def: 0, ' +\
+                             'load the whole file)', required=False)
 
     args = parser.parse_args()
 
@@ -224,6 +426,7 @@ def main():
         dfn = datfile.rsplit('/', 1)[-1]
         basename = dfn.rsplit('.dat', 1)[0]
         print("  Output file base name: %s" %basename)
+    print("  Filter engine: %s" %args.engine)
     print("======================\n\n")
    
     datfile, inffile, retval = check_files(datfile)
@@ -234,7 +437,8 @@ def main():
         dt = get_dt_from_inf(inffile)
         print("\nSample Time: %.2f us\n" %(dt * 1e6))
         filter_harms(datfile, dt, freqs, nharms, widths, 
-                     outbase=outbase)
+                     outbase=outbase, engine=args.engine, 
+                     taper=args.taper, block_mb=args.block_mb)
 
     return 
 
@@ -0,0 +1,624 @@
+import os
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+import filterbank as fbk
+
+# Dispersion constant (s MHz^2 cm^3 / pc) using the
+# same value as PRESTO so delays match prepdata
+KDM = 1.0 / 2.41e-4
+
+
+###########################
+##  FILTERBANK ACCESS    ##
+###########################
+
+def read_fil(filfile):
+    """
+    Read the header and memory map the data of a
+    filterbank file.  Returns the header dict and
+    the data as a (nspec, nchans) array (or None
+    if we cannot read the data type)
+    """
+    hdr, hsize = fbk.read_header(filfile)
+    nchans = hdr['nchans']
+    nbits = hdr['nbits']
+
+    if nbits not in [8, 16, 32]:
+        print("Only 8, 16, and 32 bit filterbanks supported")
+        print("nbits = %d invalid" %nbits)
+        return hdr, None
+    else: pass
+
+    dtype = fbk.get_dtype(nbits)
+    bps = nbits // 8
+    nspec = (os.path.getsize(filfile) - hsize) // (nchans * bps)
+
+    data = np.memmap(filfile, dtype=dtype, mode='r', offset=hsize,
+                     shape=(nspec, nchans))
+
+    return hdr, data
+
+
+def chans_from_string(zapstr):
+    """
+    Convert a PRESTO style channel string (eg,
+    "0:3,10,12:15") into an array of channels
+    """
+    chans = []
+    if zapstr == "":
+        return np.array(chans, dtype=int)
+
+    for zz in zapstr.split(','):
+        if ':' in zz:
+            clo, chi = zz.split(':')
+            chans += list(range(int(clo), int(chi) + 1))
+        else:
+            chans.append(int(zz))
+
+    return np.array(chans, dtype=int)
+
+
+def presto_to_file_chans(chans, nchans, foff):
+    """
+    PRESTO numbers channels from the lowest frequency,
+    so flip channel numbers if the file has the highest
+    frequency first (foff < 0)
+    """
+    chans = np.asarray(chans, dtype=int)
+    if foff < 0:
+        chans = nchans - 1 - chans
+    else: pass
+    return chans
+
+
+###########################
+##  DEDISPERSION         ##
+###########################
+
+def chan_delays(freqs, dm, dt):
+    """
+    Dispersive delay of each channel (in samples)
+    relative to the highest frequency.  Rounded to
+    the nearest sample like prepdata.
+    """
+    fhi = np.max(freqs)
+    tdel = KDM * dm * (freqs**-2.0 - fhi**-2.0)
+    return np.floor(tdel / dt + 0.5).astype(int)
+
+
+def dedisp_block(data, good, delays, istart, nout, zerodm=False):
+    """
+    Shift and sum the good channels of data to get
+    output samples istart to istart + nout.  delays
+    are for the good channels only.
+
+    If zerodm, subtract the mean of the good channels
+    from each spectrum before summing
+    """
+    maxd = np.max(delays)
+    chunk = data[istart : istart + nout + maxd][:, good]
+    chunk = chunk.astype('float32')
+
+    if zerodm:
+        chunk -= np.mean(chunk, axis=1, keepdims=True)
+    else: pass
+
+    # Channel-major so each shifted add is contiguous
+    chunk = np.ascontiguousarray(chunk.T)
+
+    out = np.zeros(nout, dtype='float32')
+    for ii, dd in enumerate(delays):
+        out += chunk[ii, dd : dd + nout]
+
+    return out
+
+
+def get_block_size(ngood, maxd, block_mb):
+    """
+    Number of output samples per block so that each
+    input block (with the maxd extra samples needed
+    for the delays) is about block_mb MB of float32.
+
+    Each block reads nblk + maxd input rows, so nblk is 
+    at least maxd (and 4096) to keep the rows read more 
+    than once to under half.  For large delays the blocks
+    are then bigger than block_mb (see get_block_mem)
+    """
+    nrows = int(block_mb * 2**20 / (4 * ngood))
+    nblk = max(nrows - maxd, maxd, 4096)
+    return nblk
+
+
+def get_block_mem(ngood, maxd, nblk):
+    """
+    Memory (in MB) used by each thread for a block: the
+    float32 copy of the nblk + maxd input rows and its
+    channel-major (transposed) copy.  The subbands of
+    subband_block add a little to this
+    """
+    return 2.0 * (nblk + maxd) * ngood * 4 / 2**20
+
+
+def dedisp_setup(filfile, dm, zap_chans=[]):
+    """
+    Get what we need to dedisperse filfile at dm: the
+    header, the memory mapped data, the mask of good
+    (not zapped) channels, their delays, and the number
+    of output samples.
+
+    data is None if there is a problem
+    """
+    hdr, data = read_fil(filfile)
+    if data is None:
+        return hdr, None, None, None, 0
+
+    nspec, nchans = data.shape
+    dt = hdr['tsamp']
+    freqs = hdr['fch1'] + hdr['foff'] * np.arange(nchans)
+
+    good = np.ones(nchans, dtype=bool)
+    good[zap_chans] = False
+    if np.sum(good) == 0:
+        print("All channels zapped!")
+        return hdr, None, None, None, 0
+    else: pass
+
+    delays = chan_delays(freqs, dm, dt)[good]
+    maxd = np.max(delays)
+    nout = nspec - maxd
+    if nout <= 0:
+        print("Dispersion delay (%d samples) longer than data" %maxd)
+        return hdr, None, None, None, 0
+    else: pass
+
+    return hdr, data, good, delays, nout
+
+
+def dedisperse(filfile, dm, outbase, zap_chans=[], zerodm=False,
+               nthread=1, block_mb=16.0, telescope="Unknown"):
+    """
+    Incoherently dedisperse filfile at dm and write
+    the time series to outbase.dat (plus outbase.inf)
+    in the same format as prepdata.
+
+    zap_chans are channels (in file order) to leave out
+    of the sum.  Apply the zero DM filter if zerodm.
+
+    The filterbank is memory mapped and processed in
+    time blocks of about block_mb MB spread over nthread
+    threads (each thread holds about two copies of its 
+    block, see get_block_mem).  The output has the 
+    (nspec - max delay) samples for which all channels 
+    have data.
+
+    Returns the name of the dat file (or None on error)
+    """
+    tstart = time.time()
+
+    hdr, data, good, delays, nout = dedisp_setup(filfile, dm, zap_chans)
+    if data is None:
+        return None
+
+    nchans = data.shape[1]
+    maxd = np.max(delays)
+    nblk = get_block_size(np.sum(good), maxd, block_mb)
+    starts = np.arange(0, nout, nblk)
+
+    print("Dedispersing %s at DM = %.3f" %(filfile, dm))
+    print("  %d/%d channels, max delay = %d samples" %(\
+           np.sum(good), nchans, maxd))
+    print("  %d blocks of %d samples on %d threads (%.0f MB each)" %(\
+           len(starts), nblk, nthread, 
+           get_block_mem(np.sum(good), maxd, nblk)))
+
+    # Write the output straight into the dat file
+    datfile = "%s.dat" %outbase
+    out = np.memmap(datfile, dtype='float32', mode='w+', shape=(nout,))
+
+    def run_block(istart):
+        nn = min(nblk, nout - istart)
+        out[istart : istart + nn] = dedisp_block(data, good, delays,
+                                                 istart, nn, zerodm=zerodm)
+        return
+
+    with ThreadPoolExecutor(max_workers=nthread) as pool:
+        list(pool.map(run_block, starts))
+
+    out.flush()
+    del out
+
+    write_inf(outbase, hdr, nout, dm, telescope=telescope)
+
+    tstop = time.time()
+    print("Dedispersion -- %.1f sec" %(tstop - tstart))
+
+    return datfile
+
+
+def dedisp_stream(data, good, delays, nout, zerodm=False, nthread=1, 
+                  block_mb=16.0):
+    """
+    Dedisperse in time blocks (as in dedisperse) but 
+    yield the float32 blocks of the time series in order 
+    instead of writing them out.  Inputs are from 
+    dedisp_setup.
+
+    At most 2 * nthread blocks are in flight, so memory 
+    use does not depend on the length of the data
+    """
+    maxd = np.max(delays)
+    nblk = get_block_size(np.sum(good), maxd, block_mb)
+    starts = np.arange(0, nout, nblk)
+
+    def run_block(istart):
+        nn = min(nblk, nout - istart)
+        return dedisp_block(data, good, delays, istart, nn, zerodm=zerodm)
+
+    with ThreadPoolExecutor(max_workers=nthread) as pool:
+        futs = deque()
+        for istart in starts:
+            futs.append( pool.submit(run_block, istart) )
+            if len(futs) >= 2 * nthread:
+                yield futs.popleft().result()
+        while len(futs):
+            yield futs.popleft().result()
+
+    return
+
+
+###########################
+##  DM TRIAL SEARCH      ##
+###########################
+
+def plan_dm_trials(dm0, dmlo, dmhi, freqs, dt, tol=1.25):
+    """
+    Plan DM trials from dmlo to dmhi around the DM 
+    dm0 used for coherent dedispersion (dm0 is always 
+    a trial).
+
+    The step between trials is set so the change in 
+    delay across the band is tol times the effective 
+    time resolution, which is the sample time plus the 
+    smearing within a channel from the DM error (the 
+    channels are coherently dedispersed at dm0)
+    """
+    fhi = np.max(freqs)
+    flo = np.min(freqs)
+    if len(freqs) > 1:
+        chan_bw = np.abs(freqs[1] - freqs[0])
+    else:
+        chan_bw = 0.0
+    kband = KDM * (flo**-2.0 - fhi**-2.0)
+
+    def dm_step(dm):
+        tsmear = 2 * KDM * np.abs(dm - dm0) * chan_bw / flo**3.0
+        teff = np.sqrt(dt**2.0 + tsmear**2.0)
+        return tol * teff / kband
+
+    dms = [dm0]
+    dm = dm0
+    while dm + dm_step(dm) <= dmhi:
+        dm += dm_step(dm)
+        dms.append(dm)
+
+    dm = dm0
+    while dm - dm_step(dm) >= max(dmlo, 0):
+        dm -= dm_step(dm)
+        dms.append(dm)
+
+    return np.sort(dms)
+
+
+def get_subbands(freqs, good, nsub):
+    """
+    Split the good channels into nsub subbands of 
+    (about) equal numbers of channels.  Returns the 
+    subband number of each good channel and the top 
+    frequency of each subband
+    """
+    gfreqs = freqs[good]
+    ngood = len(gfreqs)
+    nsub = max(min(nsub, ngood), 1)
+    
+    # Number subbands from the top of the band
+    xx = np.argsort(gfreqs)[::-1]
+    sub_num = np.zeros(ngood, dtype=int)
+    sub_num[xx] = np.arange(ngood) * nsub // ngood
+
+    sub_fhi = np.array([ np.max(gfreqs[sub_num == ii]) 
+                         for ii in range(nsub) ])
+    
+    return sub_num, sub_fhi
+
+
+def group_dm_trials(dms, freqs, good, sub_num, dt, tol=0.5):
+    """
+    Group DM trials that can share the first stage of 
+    the subband dedispersion.  Each group uses the DM 
+    at the middle of its range to align the channels 
+    within each subband, so the span of a group is set 
+    so the delay error across the widest (in delay) 
+    subband is at most tol samples.
+
+    Returns a list of (subband DM, trial indices)
+    """
+    gfreqs = freqs[good]
+    ksub = 0
+    for ii in np.unique(sub_num):
+        fsub = gfreqs[sub_num == ii]
+        ksub = max(ksub, KDM * (np.min(fsub)**-2.0 - np.max(fsub)**-2.0))
+
+    if ksub > 0:
+        span = 2 * tol * dt / ksub
+    else:
+        span = np.inf
+
+    groups = []
+    istart = 0
+    for ii in range(1, len(dms) + 1):
+        if ii == len(dms) or dms[ii] - dms[istart] > span:
+            dm_sub = 0.5 * (dms[istart] + dms[ii-1])
+            groups.append( (dm_sub, np.arange(istart, ii)) )
+            istart = ii
+        else: pass
+
+    return groups
+
+
+def subband_block(data, good, plan, istart, nout, outs, zerodm=False):
+    """
+    Two stage (subband) dedispersion of output samples 
+    istart to istart + nout for all DM trials.
+
+    For each group in plan, the channels are first shifted 
+    and summed into subbands at the group DM, then the 
+    subbands are shifted and summed for each trial in the 
+    group.  Results are written to outs[trial]
+    """
+    maxd = max([ pp['maxd'] for pp in plan ])
+    chunk = data[istart : istart + nout + maxd][:, good]
+    chunk = chunk.astype('float32')
+
+    if zerodm:
+        chunk -= np.mean(chunk, axis=1, keepdims=True)
+    else: pass
+
+    chunk = np.ascontiguousarray(chunk.T)
+
+    for pp in plan:
+        d1 = pp['d1']
+        d2 = pp['d2']
+        sub_num = pp['sub_num']
+        nsub = d2.shape[1]
+
+        # Stage 1: channels -> subbands at the group DM
+        nsamp = nout + np.max(d2)
+        subs = np.zeros( (nsub, nsamp), dtype='float32' )
+        for ii, dd in enumerate(d1):
+            subs[sub_num[ii]] += chunk[ii, dd : dd + nsamp]
+
+        # Stage 2: subbands -> time series for each trial
+        for jj, kk in enumerate(pp['trials']):
+            out = np.zeros(nout, dtype='float32')
+            for ss in range(nsub):
+                dd = d2[jj, ss]
+                out += subs[ss, dd : dd + nout]
+            outs[kk][istart : istart + nout] = out
+
+    return
+
+
+def dedisperse_trials(filfile, dms, outbases, zap_chans=[], zerodm=False,
+                      nthread=1, block_mb=16.0, nsub=0, 
+                      telescope="Unknown"):
+    """
+    Dedisperse filfile at each of the DMs in dms and 
+    write the time series to outbases[ii].dat (+ .inf) 
+    using two stage subband dedispersion.  The channels 
+    are summed into nsub subbands (def: about sqrt(nchans))
+    once per group of nearby trials, so the cost grows 
+    much slower than the number of trials.
+
+    All outputs have the same number of samples, set by 
+    the largest delay of the highest DM.
+
+    Returns the list of dat files (or None on error)
+    """
+    tstart = time.time()
+
+    hdr, data = read_fil(filfile)
+    if data is None:
+        return None
+
+    nspec, nchans = data.shape
+    dt = hdr['tsamp']
+    freqs = hdr['fch1'] + hdr['foff'] * np.arange(nchans)
+    fhi = np.max(freqs)
+
+    good = np.ones(nchans, dtype=bool)
+    good[zap_chans] = False
+    if np.sum(good) == 0:
+        print("All channels zapped!")
+        return None
+    else: pass
+
+    if nsub <= 0:
+        nsub = int(2**np.round(np.log2(np.sqrt(np.sum(good)))))
+
+    sub_num, sub_fhi = get_subbands(freqs, good, nsub)
+    groups = group_dm_trials(dms, freqs, good, sub_num, dt)
+
+    # Delays for each group: d1 are the channel delays 
+    # within each subband at the group DM, d2 the subband 
+    # delays relative to the top of the band for each trial
+    gfreqs = freqs[good]
+    plan = []
+    for dm_sub, trials in groups:
+        tdel = KDM * dm_sub * (gfreqs**-2.0 - sub_fhi[sub_num]**-2.0)
+        d1 = np.floor(tdel / dt + 0.5).astype(int)
+        d2 = np.zeros( (len(trials), len(sub_fhi)), dtype=int )
+        for jj, kk in enumerate(trials):
+            tdel = KDM * dms[kk] * (sub_fhi**-2.0 - fhi**-2.0)
+            d2[jj] = np.floor(tdel / dt + 0.5).astype(int)
+        plan.append({'trials' : trials, 'sub_num' : sub_num, 
+                     'd1' : d1, 'd2' : d2, 
+                     'maxd' : np.max(d1) + np.max(d2)})
+
+    maxd = max([ pp['maxd'] for pp in plan ])
+    nout = nspec - maxd
+    if nout <= 0:
+        print("Dispersion delay (%d samples) longer than data" %maxd)
+        return None
+    else: pass
+
+    nblk = get_block_size(np.sum(good), maxd, block_mb)
+    starts = np.arange(0, nout, nblk)
+
+    print("Dedispersing %s at %d DMs (%.3f - %.3f)" %(\
+           filfile, len(dms), np.min(dms), np.max(dms)))
+    print("  %d/%d channels in %d subbands, %d subband DMs" %(\
+           np.sum(good), nchans, len(sub_fhi), len(groups)))
+    print("  %d blocks of %d samples on %d threads (%.0f MB each)" %(\
+           len(starts), nblk, nthread, 
+           get_block_mem(np.sum(good), maxd, nblk)))
+
+    datfiles = [ "%s.dat" %ob for ob in outbases ]
+    outs = [ np.memmap(df, dtype='float32', mode='w+', shape=(nout,)) 
+             for df in datfiles ]
+
+    def run_block(istart):
+        nn = min(nblk, nout - istart)
+        subband_block(data, good, plan, istart, nn, outs, zerodm=zerodm)
+        return
+
+    with ThreadPoolExecutor(max_workers=nthread) as pool:
+        list(pool.map(run_block, starts))
+
+    for ii, out in enumerate(outs):
+        out.flush()
+        write_inf(outbases[ii], hdr, nout, dms[ii], telescope=telescope)
+    del outs
+
+    tstop = time.time()
+    print("Dedispersion -- %.1f sec" %(tstop - tstart))
+
+    return datfiles
+
+
+###########################
+##  PRESTO INF FILES     ##
+###########################
+
+def sigproc_angle_str(val):
+    """
+    Convert a SIGPROC ddmmss.s (or hhmmss.s) value
+    into a dd:mm:ss.ssss string
+    """
+    if val < 0:
+        sign = "-"
+    else:
+        sign = ""
+    val = abs(val)
+    dd = int(val // 10000)
+    mm = int((val - dd * 10000) // 100)
+    ss = val - dd * 10000 - mm * 100
+    return "%s%02d:%02d:%07.4f" %(sign, dd, mm, ss)
+
+
+def write_inf(outbase, hdr, nout, dm, telescope="Unknown"):
+    """
+    Write PRESTO style inf file for the time series
+    """
+    nchans = hdr['nchans']
+    foff = hdr['foff']
+    flo = min(hdr['fch1'], hdr['fch1'] + foff * (nchans - 1))
+
+    pars = [
+      ("Data file name without suffix", os.path.basename(outbase)),
+      ("Telescope used", telescope),
+      ("Instrument used", "Unknown"),
+      ("Object being observed", hdr.get('source_name', "Unknown")),
+      ("J2000 Right Ascension (hh:mm:ss.ssss)",
+            sigproc_angle_str(hdr.get('src_raj', 0.0))),
+      ("J2000 Declination     (dd:mm:ss.ssss)",
+            sigproc_angle_str(hdr.get('src_dej', 0.0))),
+      ("Data observed by", "Unknown"),
+      ("Epoch of observation (MJD)", "%.15f" %hdr['tstart']),
+      ("Barycentered?           (1=yes, 0=no)", "0"),
+      ("Number of bins in the time series", "%d" %nout),
+      ("Width of each time series bin (sec)", "%.15g" %hdr['tsamp']),
+      ("Any breaks in the data? (1=yes, 0=no)", "0"),
+      ("Type of observation (EM band)", "Radio"),
+      ("Beam diameter (arcsec)", "0"),
+      ("Dispersion measure (cm-3 pc)", "%.12g" %dm),
+      ("Central freq of low channel (MHz)", "%.12g" %flo),
+      ("Total bandwidth (MHz)", "%.12g" %(nchans * abs(foff))),
+      ("Number of channels", "%d" %nchans),
+      ("Channel bandwidth (MHz)", "%.12g" %abs(foff)),
+      ("Data analyzed by", "bbsearch"),
+    ]
+
+    inffile = "%s.inf" %outbase
+    with open(inffile, 'w') as fout:
+        for key, val in pars:
+            fout.write(" %-39s=  %s\n" %(key, val))
+        fout.write(" Any additional notes:\n")
+        fout.write("    Dedispersed with bbsearch/dedisp.py\n\n")
+
+    return inffile
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Dedisperse a filterbank file to a PRESTO *.dat file"
+    parser = ArgumentParser(description=prog_desc)
+    parser.add_argument('filfile', help='Filterbank file')
+    parser.add_argument('-dm', '--dm', required=True, type=float,
+                        help='Dispersion Measure (pc/cc)')
+    parser.add_argument('-o', '--outbase', required=True,
+                        help='Output base name (writes outbase.dat/inf)')
+    parser.add_argument('-ignorechan', '--ignorechan', default="",
+                        help='Channels to ignore in PRESTO numbering ' +\
+                             '(eg, "0:3,10")', required=False)
+    parser.add_argument('--zerodm', action='store_true',
+                        help='Apply the zero DM filter')
+    parser.add_argument('-nt', '--nthread', default=1, type=int,
+                        help='Number of threads (def: 1)', required=False)
+    parser.add_argument('-bs', '--block_mb', default=16.0, type=float,
+                        help='Input block size per thread in MB (def: 16)',
+                        required=False)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Run dedispersion
+    """
+    args = parse_input()
+
+    hdr, hsize = fbk.read_header(args.filfile)
+    zap = chans_from_string(args.ignorechan)
+    zap = presto_to_file_chans(zap, hdr['nchans'], hdr['foff'])
+
+    dedisperse(args.filfile, args.dm, args.outbase, zap_chans=zap,
+               zerodm=args.zerodm, nthread=args.nthread,
+               block_mb=args.block_mb)
+
+    return
+
+
+debug = 0
+
+if __name__ == "__main__":
+    if debug:
+        pass
+    else:
+        main()
@@ -91,6 +91,8 @@ def read_longintval(filfile, stdout=False):
 def read_string(filfile, stdout=False):
     strlen = struct.unpack('i', filfile.read(4))[0]
     strval = filfile.read(strlen)
+    # python3 reads bytes
+    strval = strval.decode("utf-8")
     if stdout:
         print("  string = '%s'"%strval)
     return strval
@@ -118,6 +120,9 @@ def read_hdr_val(filfile, stdout=False):
         return None, None
 
 def prep_string(string):
+    # python3 needs bytes
+    if isinstance(string, str):
+        string = string.encode("utf-8")
     return struct.pack('i', len(string))+string
 
 def prep_double(name, value):
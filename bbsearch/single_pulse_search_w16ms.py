@@ -2,17 +2,35 @@
 from __future__ import print_function
 from builtins import str, zip
 from optparse import OptionParser
-import bisect, os, sys, glob
+import bisect, heapq, os, sys, glob
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import scipy, scipy.signal, scipy.stats
-from presto.presto import rfft, next2_to_n
 from presto import infodata
-from presto.Pgplot import *
+import spcands
+# The boxcars are done with FFT convolutions (the presto rfft
+# binding) or prefix sums, which need nothing but numpy
+try:
+    from presto.presto import rfft, next2_to_n
+    default_engine = 'fft'
+except ImportError:
+    rfft = None
+    default_engine = 'cumsum'
+    def next2_to_n(x):
+        # Smallest power of 2 >= x
+        return 1 << int(np.ceil(np.log2(max(x, 1))))
 
 # This is for Python 2/3 comptibility
 def mycmp(a, b):
     return ((a > b) - (a < b))
 
+# Candidates are kept in structured arrays with these
+# fields (the same as the candidate class below, and those
+# of the binary spcands files) and are written out with 
+# cand_fmt
+cand_dtype = spcands.cand_dtype
+cand_fmt = spcands.cand_fmt
+
 class candidate(object):
     def __init__(self, DM, sigma, time, bin, downfact):
         self.DM = DM
@@ -21,7 +39,7 @@ class candidate(object):
         self.bin = bin
         self.downfact = downfact
     def __str__(self):
-        return "%7.2f %7.2f %13.6f %16d     %3d\n"%\
+        return cand_fmt % \
                (self.DM, self.sigma, self.time, self.bin, self.downfact)
     def __eq__(self, other):
         return (self.bin == other.bin)
@@ -78,81 +96,852 @@ def make_fftd_kerns(downfacts, fftlen):
         fftd_kerns.append(rfft(kern / np.sqrt(downfact), -1))
     return fftd_kerns
 
+def boxcar_offsets(downfact):
+    # Bins before and after each output bin that are summed
+    # by the boxcar of downfact bins.  These match the kernels
+    # of make_fftd_kerns (and scipy.signal.convolve)
+    nafter = downfact // 2
+    if downfact % 2:  # Odd number
+        nbefore = downfact // 2
+    else:             # Even number
+        nbefore = downfact // 2 - 1
+    return nbefore, nafter
+
+def get_cumsum(chunk):
+    # Prefix sums of chunk (in float64 for accuracy) with 
+    # a leading zero, so cumsum[j] - cumsum[i] = sum(chunk[i:j])
+    cumsum = np.zeros(len(chunk) + 1, dtype=np.float64)
+    np.cumsum(chunk, dtype=np.float64, out=cumsum[1:])
+    return cumsum
+
+def cumsum_convolve(cumsum, downfact, lo, hi):
+    """
+    cumsum_convolve(cumsum, downfact, lo, hi):
+        Boxcar smooth the data with prefix sums 'cumsum' (see
+            get_cumsum) with the same normalization and alignment
+            as the kernels of make_fftd_kerns.  The returned vector
+            is for bins 'lo' up to but not including 'hi' (both 
+            must be at least downfact/2 bins from the ends)
+    """
+    nbefore, nafter = boxcar_offsets(downfact)
+    box = cumsum[lo+nbefore+1:hi+nbefore+1] - cumsum[lo-nafter:hi-nafter]
+    box *= 1.0 / np.sqrt(downfact)
+    return box.astype(np.float32)
+
+# Boxcars whose SNR bound (see boxcar_bound) is below
+# threshold - bound_margin are not searched.  The margin
+# covers the rounding of the (float32) convolutions
+bound_margin = 0.05
+
+def bound_level(downfact):
+    # Block level (blocks of 2**lev bins) for the bound of
+    # this downfact, with blocks of about downfact/8 bins
+    return max((downfact // 8).bit_length() - 1, 0)
+
+def get_cumsum_blocks(cumsum, maxlev):
+    # Min and max of the prefix sums in blocks of 2**lev bins
+    # for lev = 0 .. maxlev.  The end is padded with the last
+    # value to make whole blocks
+    npad = -len(cumsum) % 2**maxlev
+    cs = np.concatenate([cumsum, np.full(npad, cumsum[-1])])
+    cblocks = [(cs, cs)]
+    for lev in range(maxlev):
+        bmin, bmax = cblocks[-1]
+        cblocks.append((np.minimum(bmin[0::2], bmin[1::2]),
+                        np.maximum(bmax[0::2], bmax[1::2])))
+    return cblocks
+
+def boxcar_bound(cblocks, downfact, lo, hi):
+    """
+    boxcar_bound(cblocks, downfact, lo, hi):
+        Upper bound on the max of the boxcar smoothed data
+            (as from cumsum_convolve) for bins 'lo' up to but not
+            including 'hi'.  Each boxcar is a difference of
+            prefix sums, cumsum[s+downfact] - cumsum[s], so the
+            max over each block of starts s is bounded by the
+            block maxes of its ends less the block min (see
+            get_cumsum_blocks).  As for cumsum_convolve, 'lo' 
+            and 'hi' must be at least downfact/2 bins from the 
+            ends
+    """
+    nbefore, nafter = boxcar_offsets(downfact)
+    lev = min(bound_level(downfact), len(cblocks) - 1)
+    bmin, bmax = cblocks[lev]
+    blen = 2**lev
+    # Blocks of the starts, and the offsets (in blocks) of
+    # the first and last block of their ends
+    b0 = (lo - nafter) // blen
+    b1 = (hi - nafter - 1) // blen + 1
+    k0 = downfact // blen
+    k1 = (downfact + blen - 1) // blen
+    ends = bmax[b0+k0:b1+k0].copy()
+    # The last block of the ends can be past the padded end
+    # for the last starts.  Their ends are then all in the
+    # first block, so those are left out
+    ends1 = bmax[b0+k1:b1+k1]
+    ends[:len(ends1)] = np.maximum(ends[:len(ends1)], ends1)
+    return (ends - bmin[b0:b1]).max() / np.sqrt(downfact)
+
+def range_max(vals, lo, hi):
+    # Max of vals[lo[k]:hi[k]] for each k (-inf if empty).
+    # Uses a sparse table built one level at a time, where
+    # level m holds the max of each run of 2**m values
+    out = np.full(len(lo), -np.inf)
+    nn = hi - lo
+    ok = nn > 0
+    lev = np.zeros(len(lo), dtype=np.int64)
+    lev[ok] = np.frexp(nn[ok])[1] - 1
+    tab = np.asarray(vals, dtype=np.float64)
+    for mm in range(lev.max() + 1 if len(lev) else 0):
+        if mm:
+            half = 2**(mm-1)
+            tab = np.maximum(tab[:-half], tab[half:])
+        sel = np.flatnonzero(ok & (lev == mm))
+        if len(sel):
+            out[sel] = np.maximum(tab[lo[sel]], tab[hi[sel] - 2**mm])
+    return out
+
+def get_live(bins, sigmas, halfs):
+    # One pass over the (bin sorted) candidates to find the
+    # ones still in the list when the pairwise pruning loop
+    # gets to them ("live").  A candidate is removed before
+    # its turn by a brighter live candidate before it that is
+    # within max(its half width, our half width) bins.  The
+    # live candidates are kept in a heap (brightest first,
+    # dropped once out of reach by their own half width) and
+    # a stack of decreasing sigma (for our half width)
+    live = np.zeros(len(bins), dtype=bool)
+    heap = []
+    sbins, ssigs = [], []
+    for ii, (bb, ss, hh) in enumerate(zip(bins.tolist(), sigmas.tolist(),
+                                          halfs.tolist())):
+        while heap and heap[0][1] < bb:
+            heapq.heappop(heap)
+        if heap and -heap[0][0] > ss:
+            continue
+        kk = bisect.bisect_left(sbins, bb - hh)
+        if kk < len(sbins) and ssigs[kk] > ss:
+            continue
+        live[ii] = True
+        heapq.heappush(heap, (-ss, bb + hh))
+        while ssigs and ssigs[-1] <= ss:
+            sbins.pop()
+            ssigs.pop()
+        sbins.append(bb)
+        ssigs.append(ss)
+    return live
+
+def window_max(bins, sigmas, halfs):
+    # For each candidate ii, the max sigma of the later 
+    # candidates jj (in sorted order) within 
+    # max(halfs[ii], halfs[jj]) bins.  The candidates with
+    # each half width are a contiguous run in bin order, so
+    # each half width needs one range max query per cand
+    nn = len(bins)
+    idx = np.arange(nn)
+    hmax = range_max(sigmas, idx + 1,
+                     np.searchsorted(bins, bins + halfs, side='right'))
+    for hh in np.unique(halfs):
+        gg = np.flatnonzero(halfs == hh)
+        lo = np.searchsorted(gg, idx, side='right')
+        hi = np.searchsorted(bins[gg], bins + hh, side='right')
+        hmax = np.maximum(hmax, range_max(sigmas[gg], lo, hi))
+    return hmax
+
+def prune_mask(bins, sigmas, halfs):
+    # Survivors (True) of the pairwise pruning loop that
+    # prune_related1/2 used to run: step through the bin
+    # sorted candidates and compare each one still in the
+    # list with the later ones still in the list that are 
+    # within max(both half widths) bins, removing the less
+    # significant of each pair (the first one on ties).  A
+    # candidate that is removed during its own turn still
+    # removes the later ones it beats.
+    #
+    # This comes down to: a candidate survives if it is live
+    # (see get_live) and no later candidate within reach is
+    # at least as bright and still in the list at its turn.
+    # A later live candidate always is, and a later one that
+    # is not live can only have been removed (before our 
+    # turn) by a live candidate ahead of us that reached it 
+    # with its half width.  Only that last (rare) case is
+    # checked one candidate at a time.
+    nn = len(bins)
+    if nn < 2:
+        return np.ones(nn, dtype=bool)
+    live = get_live(bins, sigmas, halfs)
+    lsigs = np.where(live, sigmas, -np.inf)
+    keep = live & (window_max(bins, lsigs, halfs) < sigmas)
+    check = np.flatnonzero(keep & (window_max(bins, sigmas, halfs) >= sigmas))
+    if len(check):
+        # Position of each cand among the live cands
+        lidx = np.flatnonzero(live)
+        lpos = np.cumsum(live) - live
+        hmax = halfs.max()
+        pi, pj = [], []
+        for ii in check.tolist():
+            jhi = np.searchsorted(bins, bins[ii] + hmax, side='right')
+            jj = np.arange(ii + 1, jhi)
+            jj = jj[(bins[jj] - bins[ii] <= np.maximum(halfs[ii], halfs[jj])) &
+                    (sigmas[jj] >= sigmas[ii])]
+            pi += [ii] * len(jj)
+            pj += jj.tolist()
+        pi, pj = np.array(pi), np.array(pj)
+        # Brightest live cand before ii within the reach of jj
+        plo = np.searchsorted(bins[lidx], bins[pj] - halfs[pj], side='left')
+        pmax = range_max(sigmas[lidx], plo, lpos[pi])
+        blocked = np.unique(pi[pmax <= sigmas[pj]])
+        keep[blocked] = False
+    return keep
+
 def prune_related1(hibins, hivals, downfact):
     # Remove candidates that are close to other candidates
     # but less significant.  This one works on the raw 
     # candidate arrays and uses the single downfact
     # that they were selected with.
-    toremove = set()
-    for ii in range(0, len(hibins)-1):
-        if ii in toremove:  continue
-        xbin, xsigma = hibins[ii], hivals[ii]
-        for jj in range(ii+1, len(hibins)):
-            ybin, ysigma = hibins[jj], hivals[jj]
-            if (abs(ybin-xbin) > downfact//2):
-                break
-            else:
-                if jj in toremove:
-                    continue
-                if (xsigma > ysigma):
-                    toremove.add(jj)
-                else:
-                    toremove.add(ii)
-    # Now zap them starting from the end
-    toremove = sorted(toremove, reverse=True)
-    for bin in toremove:
-        del(hibins[bin])
-        del(hivals[bin])
-    return hibins, hivals
+    halfs = np.full(len(hibins), downfact//2, dtype=np.int64)
+    keep = prune_mask(hibins, hivals, halfs)
+    return hibins[keep], hivals[keep]
     
-def prune_related2(dm_candlist, downfacts):
+def prune_related2(dm_cands, downfacts):
     # Remove candidates that are close to other candidates
     # but less significant.  This one works on the candidate 
-    # instances and looks at the different downfacts of the
-    # the different candidates.
-    toremove = set()
-    for ii in range(0, len(dm_candlist)-1):
-        if ii in toremove:  continue
-        xx = dm_candlist[ii]
-        xbin, xsigma = xx.bin, xx.sigma
-        for jj in range(ii+1, len(dm_candlist)):
-            yy = dm_candlist[jj]
-            ybin, ysigma = yy.bin, yy.sigma
-            if (abs(ybin-xbin) > max(downfacts)//2):
-                break
-            else:
-                if jj in toremove:
-                    continue
-                prox = max([xx.downfact//2, yy.downfact//2, 1])
-                if (abs(ybin-xbin) <= prox):
-                    if (xsigma > ysigma):
-                        toremove.add(jj)
-                    else:
-                        toremove.add(ii)
-    # Now zap them starting from the end
-    toremove = sorted(toremove, reverse=True)
-    for bin in toremove:
-        del(dm_candlist[bin])
-    return dm_candlist
-
-def prune_border_cases(dm_candlist, offregions):
+    # array (sorted by bin) and looks at the different 
+    # downfacts of the different candidates (within at most
+    # half of the largest downfact).
+    halfs = np.clip(dm_cands['downfact']//2, 1, max(max(downfacts)//2, 1))
+    keep = prune_mask(dm_cands['bin'], dm_cands['sigma'], halfs)
+    return dm_cands[keep]
+
+def prune_border_cases(dm_cands, offregions):
     # Ignore those that are located within a half-width
     # of the boundary between data and padding
     #print offregions
-    toremove = set()
-    for ii in range(len(dm_candlist)-1, -1, -1):
-        cand = dm_candlist[ii]
-        loside = cand.bin-cand.downfact/2
-        hiside = cand.bin+cand.downfact/2
-        if hiside < offregions[0][0]: break
-        for off, on in offregions:
-            if (hiside > off and loside < on):
-                toremove.add(ii)
-    # Now zap them starting from the end
-    toremove = sorted(toremove, reverse=True)
-    for ii in toremove:
-        del(dm_candlist[ii])
-    return dm_candlist
+    loside = dm_cands['bin'] - dm_cands['downfact'] / 2
+    hiside = dm_cands['bin'] + dm_cands['downfact'] / 2
+    border = np.zeros(len(dm_cands), dtype=bool)
+    for off, on in offregions:
+        border |= (hiside > off) & (loside < on)
+    # As before, only check back to the last cand that ends
+    # before the first off region
+    early = np.flatnonzero(hiside < offregions[0][0])
+    if len(early):
+        border[:early[-1]+1] = False
+    return dm_cands[~border]
+
+def make_cands(DM, hibins, hivals, downfact, dt, detrendlen, bad_mask, 
+               nfac=1):
+    # Candidate array for the threshold crossings (hibins, 
+    # hivals) found with downfact that are not in bad blocks.
+    # The bins are in units of nfac full resolution bins and
+    # are returned at full resolution (center of the bin)
+    good = ~bad_mask[hibins // detrendlen]
+    cands = np.zeros(np.count_nonzero(good), dtype=cand_dtype)
+    cands['DM'] = DM
+    cands['sigma'] = hivals[good]
+    cands['bin'] = hibins[good] * nfac + nfac // 2
+    cands['time'] = cands['bin'] * dt
+    cands['downfact'] = downfact * nfac
+    return cands
+
+def sort_cands(cand_arrays):
+    # Join the per-chunk candidate arrays and sort by bin.
+    # The sort is stable, so candidates with the same bin
+    # stay in the order they were found in
+    if len(cand_arrays) == 0:
+        return np.zeros(0, dtype=cand_dtype)
+    cands = np.concatenate(cand_arrays)
+    return cands[np.argsort(cands['bin'], kind='stable')]
+
+def write_cands(outfile, dm_cands):
+    # Write the candidates (one per line) to an open file
+    for cand in dm_cands.tolist():
+        outfile.write(cand_fmt % cand)
+
+default_downfacts = [2, 3, 4, 6, 9, 14, 20, 30, 45, 70, 100, 150, 220, 
+                     300, 450, 700, 1000, 1500, 2400, 3600, 5400, 7200, 
+                     12000, 18000, 24000, 36000]
+
+def get_search_lengths(dt, maxwidth):
+    # Get the largest downfact for maxwidth (sec) along with
+    # the detrending length (~0.1 sec, but at least twice the
+    # largest downfact) and the FFT length that covers a 
+    # detrending block plus the largest downfact
+    if maxwidth > 0.0:
+        max_downfact = int(maxwidth/dt)
+    else:
+        max_downfact = default_downfacts[-1]
+
+    if max_downfact > default_downfacts[-1]:
+        print("Desired max template width: %d bins (%.3f ms)" \
+               %(max_downfact, max_downfact*dt*1000))
+        print("is larger than max template size: %d (%.3f ms)" \
+               %(default_downfacts[-1], default_downfacts[-1]*dt*1000))
+        print(".... using that instead")
+        max_downfact = default_downfacts[-1]
+
+    # Detrend on timescale of ~0.1 sec
+    detrendlen = int(next2_to_n(int(0.1/dt)))
+    if detrendlen < 2 * max_downfact:
+        detrendlen = int(next2_to_n(2 * max_downfact))
+
+    fftlen = int(next2_to_n(detrendlen + max_downfact))
+    print(fftlen, detrendlen)
+    print("Detrend time: %.3f sec" %(detrendlen * dt))
+    return detrendlen, fftlen, max_downfact
+
+def get_downfacts(dt, maxwidth, max_downfact):
+    # Choose the maximum width to search based on time instead
+    # of bins.  This helps prevent increased S/N when the downsampling
+    # changes as the DM gets larger.
+    if maxwidth > 0.0:
+        downfacts = [x for x in default_downfacts if x*dt <= maxwidth]
+    else:
+        downfacts = [x for x in default_downfacts if x <= max_downfact]
+    if len(downfacts) == 0:
+        downfacts = [default_downfacts[0]]
+    return downfacts
+
+def trim_blocks(blocks, lo, hi):
+    # Median of each block (row) and the values that would be
+    # in sorted(block)[lo:hi] (in no particular order).  We
+    # partition about the middle of each block and then each
+    # half at lo or hi, which is quicker than a full sort or
+    # one partition at both lo and hi
+    mid = blocks.shape[1]//2
+    part = np.partition(blocks, mid, axis=1)
+    if lo < mid:
+        lows = np.partition(part[:, :mid], lo, axis=1)[:, lo:]
+    else:
+        lows = part[:, lo:mid]
+    highs = np.partition(part[:, mid:], hi-mid, axis=1)[:, :hi-mid]
+    return part[:, mid], np.hstack((lows, highs))
+
+def detrend_blocks(timeseries, fast=False, batchlen=2**22):
+    # De-trend the (numblocks, detrendlen) timeseries in place
+    # and return the standard deviation of each block.  If 
+    # fast, only remove the median.  The blocks are done in 
+    # batches of about batchlen samples, with the linear fit 
+    # of every block in a batch done at once by least squares
+    # about the block center (where the offset and slope are 
+    # independent)
+    numblocks, detrendlen = timeseries.shape
+    stds = np.zeros(numblocks, dtype=np.float64)
+    # The following gets rid of (hopefully) most of the 
+    # outlying values (i.e. power dropouts and single pulses)
+    # If you throw out 5% (2.5% at bottom and 2.5% at top)
+    # of random gaussian deviates, the measured stdev is ~0.871
+    # of the true stdev.  Thus the 1.0/0.871=1.148 correction below.
+    # We keep the values that would be in sorted[lo:hi]
+    lo = detrendlen//40
+    hi = detrendlen + (-detrendlen//40)
+    xx = (np.arange(detrendlen) - 0.5 * (detrendlen - 1)).astype(np.float32)
+    sxx = np.sum(xx.astype(np.float64)**2) or 1.0
+    nbatch = max(batchlen // detrendlen, 1)
+    for ii in range(0, numblocks, nbatch):
+        blocks = timeseries[ii:ii+nbatch]
+        if not fast:
+            offs = blocks.mean(axis=1, dtype=np.float64)
+            # (einsum rather than np.dot, which can round each row 
+            # differently depending on the rows around it)
+            slopes = np.einsum('ij,j->i', blocks, xx).astype(np.float64) / sxx
+            blocks -= offs[:,np.newaxis].astype(np.float32)
+            blocks -= np.outer(slopes, xx).astype(np.float32)
+        med, trim = trim_blocks(blocks, lo, hi)
+        if fast:  # use median removal instead of detrending (2x speedup)
+            blocks -= med[:,np.newaxis]
+            trim -= med[:,np.newaxis]
+        # The following is roughly .std() since we already removed the median
+        stds[ii:ii+nbatch] = np.sqrt(np.einsum('ij,ij->i', trim, trim,
+                                               dtype=np.float64) / 
+                                     (0.95*detrendlen))
+    stds *= 1.148
+    return stds
+
+def get_block_stats(stds):
+    # Get the pseudo-median and spread of the block standard
+    # deviations after separating off the very low and very
+    # high values
+    numblocks = len(stds)
+    # sort the standard deviations and separate those with
+    # very low or very high values
+    sort_stds = stds.copy()
+    sort_stds.sort()
+    # identify the differences with the larges values (this
+    # will split off the chunks with very low and very high stds
+    locut = (sort_stds[1:numblocks//2+1] -
+             sort_stds[:numblocks//2]).argmax() + 1
+    hicut = (sort_stds[numblocks//2+1:] -
+             sort_stds[numblocks//2:-1]).argmax() + numblocks//2 - 2
+    std_stds = np.std(sort_stds[locut:hicut])
+    median_stds = sort_stds[(locut+hicut)//2]
+    return median_stds, std_stds
+
+def get_bad_blocks(stds, badblocks=True):
+    # Find the blocks with very low or very high standard
+    # deviations.  The stds of these "bad" blocks are set to 
+    # the pseudo-median in place.  Returns the bad block 
+    # numbers and the pseudo-median.
+    median_stds, std_stds = get_block_stats(stds)
+    print("    pseudo-median block standard deviation = %.2f" % (median_stds))
+    if (badblocks):
+        lo_std = median_stds - 4.0 * std_stds
+        hi_std = median_stds + 4.0 * std_stds
+        # Determine a list of "bad" chunks.  We will not search these.
+        bad_blocks = np.nonzero((stds < lo_std) | (stds > hi_std))[0]
+        print("    identified %d bad blocks out of %d (i.e. %.2f%%)" % \
+              (len(bad_blocks), len(stds),
+               100.0*float(len(bad_blocks))/float(len(stds))))
+        stds[bad_blocks] = median_stds
+    else:
+        bad_blocks = []
+    return bad_blocks, median_stds
+
+def get_chunk(timeseries, chunknum, numchunks, chunklen, overlap, start=0):
+    # Get chunk number chunknum of the normalized timeseries
+    # along with overlap bins on either side.  The overlaps
+    # are zero padded at the beginning and end of the file.
+    # timeseries[0] is sample number start of the file.
+    worklen = chunklen + 2*overlap
+    loind = chunknum*chunklen-overlap-start
+    hiind = (chunknum+1)*chunklen+overlap-start
+    # Take care of beginning and end of file overlap issues
+    if (chunknum==0): # Beginning of file
+        chunk = np.zeros(worklen, dtype=np.float32)
+        chunk[overlap:] = timeseries[loind+overlap:hiind]
+    elif (chunknum==numchunks-1): # end of the timeseries
+        chunk = np.zeros(worklen, dtype=np.float32)
+        chunk[:-overlap] = timeseries[loind:hiind-overlap]
+    else:
+        chunk = timeseries[loind:hiind]
+    return chunk
+
+def read_blocks(filenm, roundN, detrendlen, fast=False, batchlen=2**22,
+                blo=0, bhi=None):
+    # Read the first roundN samples of a .dat file through a
+    # memory map in batches of about batchlen samples (whole
+    # detrending blocks) and de-trend them.  Only blocks blo
+    # up to (not including) bhi are read.  Yields the first
+    # block number, the de-trended (numblocks, detrendlen) 
+    # batch, and its block standard deviations.  The batches
+    # line up with those used inside detrend_blocks, so the
+    # results are the same as de-trending the whole file.
+    # Each batch gets its own map so the pages already read
+    # are released (and don't count against us) as we go.
+    if bhi is None:
+        bhi = roundN // detrendlen
+    nbatch = max(batchlen // detrendlen, 1)
+    for b0 in range(blo, bhi, nbatch):
+        b1 = min(b0 + nbatch, bhi)
+        mm = np.memmap(filenm, dtype=np.float32, mode='r',
+                       offset=4*b0*detrendlen, 
+                       shape=((b1 - b0)*detrendlen,))
+        blocks = np.array(mm)
+        del mm
+        blocks.shape = (b1 - b0, detrendlen)
+        stds = detrend_blocks(blocks, fast=fast, batchlen=batchlen)
+        yield b0, blocks, stds
+
+def get_file_stds(filenm, roundN, detrendlen, fast=False):
+    # First pass over a .dat file for the block standard
+    # deviations (needed for the bad block statistics)
+    stds = [ bstds for b0, blocks, bstds in 
+             read_blocks(filenm, roundN, detrendlen, fast=fast) ]
+    if len(stds):
+        return np.concatenate(stds)
+    else:
+        return np.zeros(0, dtype=np.float64)
+
+def norm_chunks(filenm, roundN, detrendlen, stds, bad_mask, chunklen,
+                overlap, fast=False, batchlen=2**22, c0=0, c1=None):
+    # Second pass over a .dat file.  The blocks are de-trended
+    # again, normalized by stds (the bad blocks zeroed), and
+    # we yield (chunknum, chunk) for each search chunk (see 
+    # get_chunk) as soon as its overlap has been read.  Only
+    # one batch of blocks and one chunk are held at a time.
+    # Only chunks c0 up to (not including) c1 are done, and 
+    # only the blocks they (and their overlaps) need are read.
+    numchunks = roundN // chunklen
+    if c1 is None:
+        c1 = numchunks
+    blo = max(c0*chunklen - overlap, 0) // detrendlen
+    bhi = min(-(-(c1*chunklen + overlap) // detrendlen),
+              roundN // detrendlen)
+    chunknum = c0
+    buf = np.zeros(0, dtype=np.float32)
+    buf0 = blo*detrendlen   # Sample number of buf[0]
+    for b0, blocks, bstds in read_blocks(filenm, roundN, detrendlen,
+                                         fast=fast, batchlen=batchlen,
+                                         blo=blo, bhi=bhi):
+        b1 = b0 + len(blocks)
+        blocks /= stds[b0:b1,np.newaxis]
+        # Even though we don't search the bad blocks, it is 
+        # important to zero them because of the overlaps for 
+        # the convolutions
+        blocks[bad_mask[b0:b1]] = 0.0
+        buf = np.concatenate((buf, blocks.ravel()))
+        while chunknum < c1 and \
+              min((chunknum+1)*chunklen+overlap, roundN) <= buf0 + len(buf):
+            yield chunknum, get_chunk(buf, chunknum, numchunks, chunklen,
+                                      overlap, start=buf0)
+            chunknum += 1
+            # Drop the data before the next chunk
+            ncut = chunknum*chunklen - overlap - buf0
+            if ncut > 0:
+                buf = buf[ncut:]
+                buf0 += ncut
+
+def search_chunk(chunk, chunknum, chunklen, overlap, detrendlen, bad_mask,
+                 downfacts, fftd_kerns, threshold, dt, DM, 
+                 engine=default_engine, declev=0):
+    # Search one chunk (with its overlaps) of the normalized 
+    # timeseries with each of the boxcars and return an array
+    # of the candidates above threshold (see make_cands).
+    # bad_mask is True for the blocks we should not search.
+    # The boxcars are done by FFT convolution with fftd_kerns
+    # if engine is 'fft', from prefix sums if 'cumsum' (then 
+    # fftd_kerns is not used), or with scipy.signal.convolve.
+    # Boxcars that cannot reach threshold in this chunk (see
+    # boxcar_bound) are skipped.
+    #
+    # If declev > 0 the chunk is from the timeseries decimated
+    # by 2**declev (and chunklen, overlap, detrendlen are in 
+    # decimated bins).  Candidate bins and downfacts are given
+    # at full resolution and the unsmoothed data are not 
+    # searched (that is done at declev = 0)
+    nfac = 2**declev
+    blocks_per_chunk = chunklen // detrendlen
+    lowblock = blocks_per_chunk * chunknum
+    cand_arrays = []
+    # Search this chunk if it is not all bad
+    if not np.all(bad_mask[lowblock:lowblock+blocks_per_chunk]):
+        # This is the good part of the data (end effects removed)
+        goodchunk = chunk[overlap:-overlap]
+
+        # Search non-downsampled data first
+        # NOTE:  these nonzero() calls are some of the most
+        #        expensive calls in the program.
+        if declev == 0:
+            hibins = np.flatnonzero(goodchunk>threshold)
+            hivals = goodchunk[hibins]
+            hibins += chunknum * chunklen
+            cand_arrays.append(make_cands(DM, hibins, hivals, 1, dt,
+                                          detrendlen, bad_mask))
+
+        # Prefix sums for the cumsum engine and the SNR bounds.
+        # The chunk is FFTd when first needed
+        cumsum = get_cumsum(chunk)
+        cblocks = get_cumsum_blocks(cumsum, bound_level(max(downfacts)))
+        fftd_chunk = None
+
+        # Now do the downsampling...
+        for ii, downfact in enumerate(downfacts):
+            # Skip the boxcars that cannot get to threshold
+            # (most of them, for a chunk of noise)
+            if boxcar_bound(cblocks, downfact, overlap, len(chunk) - overlap) \
+               < threshold - bound_margin:
+                continue
+            if engine == 'fft': 
+                if fftd_chunk is None:
+                    fftd_chunk = rfft(chunk, -1)
+                # Note:  FFT convolution is faster for _all_ downfacts, even 2
+                goodchunk = fft_convolve(fftd_chunk, fftd_kerns[ii],
+                                         overlap, -overlap)
+            elif engine == 'cumsum':
+                # One subtraction per bin for any downfact
+                goodchunk = cumsum_convolve(cumsum, downfact, overlap,
+                                            len(chunk) - overlap)
+            else:
+                # The normalization of this kernel keeps the post-smoothing RMS = 1
+                kernel = np.ones(downfact, dtype=np.float32) / \
+                         np.sqrt(downfact)
+                smoothed_chunk = scipy.signal.convolve(chunk, kernel, 1)
+                goodchunk = smoothed_chunk[overlap:-overlap]
+            hibins = np.flatnonzero(goodchunk>threshold)
+            hivals = goodchunk[hibins]
+            hibins += chunknum * chunklen
+            # Now walk through the new candidates and remove those
+            # that are not the highest but are within downfact/2
+            # bins of a higher signal pulse
+            hibins, hivals = prune_related1(hibins, hivals, downfact)
+            # The blocks of the survivors are found from their
+            # own bins in make_cands
+            cand_arrays.append(make_cands(DM, hibins, hivals, downfact, dt,
+                                          detrendlen, bad_mask, nfac=nfac))
+    if len(cand_arrays):
+        return np.concatenate(cand_arrays)
+    else:
+        return np.zeros(0, dtype=cand_dtype)
+
+def decimate_chunk(chunk):
+    # Add pairs of bins.  Dividing by sqrt(2) keeps the 
+    # RMS = 1 normalization, so a boxcar of d decimated bins
+    # gives the same sigma as one of 2*d full resolution bins
+    nn = len(chunk) // 2 * 2
+    return ((chunk[0:nn:2] + chunk[1:nn:2]) / np.sqrt(2.0)).astype(np.float32)
+
+def get_multires_plan(downfacts, chunklen, overlap, fftlen, maxdown0,
+                      engine=default_engine):
+    # Split the downfacts between decimation levels.  Level 0
+    # searches downfacts <= maxdown0 at full resolution and a
+    # wider downfact w is searched at the first level L where
+    # w / 2**L <= maxdown0, using round(w / 2**L) bins of the
+    # timeseries decimated by 2**L.  Each level gets its own
+    # (smaller) FFT length and overlap.  Returns a list of 
+    # (level, downfacts, fftlen, overlap, fftd_kerns), where
+    # fftd_kerns is None unless engine is 'fft'
+    # Always keep the smallest downfact at full resolution
+    maxdown0 = max(maxdown0, downfacts[0])
+    # Deepest level that keeps the decimated chunks aligned
+    maxlev = 0
+    while (chunklen % 2**(maxlev+1) == 0) and \
+          (overlap % 2**(maxlev+1) == 0) and \
+          (chunklen // 2**(maxlev+1) >= 2 * maxdown0):
+        maxlev += 1
+    levs = {}
+    for downfact in downfacts:
+        if downfact <= maxdown0:
+            lev = 0
+        else:
+            lev = int(np.ceil(np.log2(float(downfact) / maxdown0)))
+            lev = min(lev, maxlev)
+        dfact = max(int(round(downfact / 2.0**lev)), 1)
+        levdfs = levs.setdefault(lev, [])
+        if dfact not in levdfs:
+            levdfs.append(dfact)
+    plan = []
+    for lev in sorted(levs):
+        levdfs = levs[lev]
+        chunklen_l = chunklen // 2**lev
+        fftlen_l = int(next2_to_n(chunklen_l + max(levdfs)))
+        fftlen_l = min(fftlen_l, fftlen // 2**lev)
+        overlap_l = (fftlen_l - chunklen_l) // 2
+        if engine == 'fft':
+            fftd_kerns = make_fftd_kerns(levdfs, fftlen_l)
+        else:
+            fftd_kerns = None
+        plan.append((lev, levdfs, fftlen_l, overlap_l, fftd_kerns))
+    return plan
+
+def search_chunk_multires(chunk, chunknum, chunklen, overlap, detrendlen,
+                          bad_mask, plan, threshold, dt, DM, 
+                          engine=default_engine):
+    # Search one chunk at each level of the multi-resolution
+    # plan (see get_multires_plan).  Each level is decimated 
+    # from the one before, and we cut out the part of it with
+    # the level's (smaller) overlaps.  Returns the candidates
+    # of all levels (in level order)
+    cand_arrays = []
+    lchunk = chunk
+    lev_now = 0
+    for lev, levdfs, fftlen_l, overlap_l, fftd_kerns in plan:
+        while lev_now < lev:
+            lchunk = decimate_chunk(lchunk)
+            lev_now += 1
+        ostart = overlap // 2**lev - overlap_l
+        chunklen_l = chunklen // 2**lev
+        subchunk = lchunk[ostart:ostart + chunklen_l + 2*overlap_l]
+        cand_arrays.append(search_chunk(subchunk, chunknum, chunklen_l,
+                                        overlap_l, detrendlen // 2**lev,
+                                        bad_mask, levdfs, fftd_kerns,
+                                        threshold, dt, DM, engine=engine,
+                                        declev=lev))
+    return np.concatenate(cand_arrays)
+
+def get_plan_downfacts(plan):
+    # Full resolution downfacts searched by the plan
+    return [d * 2**lev for lev, levdfs, ff, oo, kk in plan for d in levdfs]
+
+# Search kernels of the worker processes (the fftd_kerns, or
+# the multires plan), set once per worker by init_worker
+worker_kerns = None
+
+def init_worker(kerns):
+    global worker_kerns
+    worker_kerns = kerns
+
+def search_chunks(filenm, roundN, stds, bad_mask, c0, c1, sopts,
+                  kerns=None, verbose=False):
+    # Normalize and search chunks c0 up to (not including) c1
+    # of a .dat file (see norm_chunks).  sopts is a dict of the
+    # search parameters, and kerns are the fftd_kerns (or the
+    # plan if sopts['multires'] > 0), from init_worker if None.
+    # Returns the list of candidate arrays in chunk order.
+    # This is the unit of work handed to the process pool
+    if kerns is None:
+        kerns = worker_kerns
+    detrendlen = sopts['detrendlen']
+    chunklen = sopts['chunklen']
+    overlap = sopts['overlap']
+    numchunks = roundN // chunklen
+    if verbose:
+        pchunks = (numchunks * 0.01 * np.arange(0, 101, 5)).astype('int')
+    else:
+        pchunks = []
+    chunk_cands = []
+    for chunknum, chunk in norm_chunks(filenm, roundN, detrendlen, stds,
+                                       bad_mask, chunklen, overlap,
+                                       fast=sopts['fast'],
+                                       batchlen=sopts['batchlen'],
+                                       c0=c0, c1=c1):
+        if chunknum in pchunks:
+            print("Processing chunk: %d/%d" %(chunknum, numchunks) +\
+                  "  (%.1f%%)" %(100 * chunknum/numchunks))
+        if sopts['multires'] > 0:
+            cands = search_chunk_multires(chunk, chunknum, chunklen,
+                                          overlap, detrendlen, bad_mask,
+                                          kerns, sopts['threshold'],
+                                          sopts['dt'], sopts['DM'],
+                                          engine=sopts['engine'])
+        else:
+            cands = search_chunk(chunk, chunknum, chunklen, overlap,
+                                 detrendlen, bad_mask, sopts['downfacts'],
+                                 kerns, sopts['threshold'], sopts['dt'],
+                                 sopts['DM'], engine=sopts['engine'])
+        chunk_cands.append(cands)
+    return chunk_cands
+
+def get_chunk_ranges(numchunks, nproc, nper=4):
+    # Split the chunks into about nper ranges per process
+    # (more ranges than processes to even out the load)
+    nrange = max(min(nper * nproc, numchunks), 1)
+    edges = (np.arange(nrange + 1) * numchunks) // nrange
+    return [ (int(edges[ii]), int(edges[ii+1])) for ii in range(nrange)
+             if edges[ii+1] > edges[ii] ]
+
+def search_file(filenm, sopts, kerns=None, pool=None, verbose=True):
+    # Search one .dat file and write its .singlepulse file (and
+    # .spcands file if sopts['spcands']).  sopts are the search
+    # options of main and kerns are as in search_chunks.  The 
+    # chunks are searched in the process pool if one is given.
+    # Returns the infodata of the file and its candidates
+    if kerns is None:
+        kerns = worker_kerns
+    detrendlen = sopts['detrendlen']
+    chunklen = sopts['chunklen']
+    if filenm.endswith(".dat"):
+        filenmbase = filenm[:filenm.rfind(".dat")]
+    else:
+        filenmbase = filenm
+    info = infodata.infodata(filenmbase+".inf")
+    N, dt = int(info.N), info.dt
+    if sopts['multires'] > 0:
+        downfacts = get_plan_downfacts(kerns)
+    else:
+        downfacts = get_downfacts(dt, sopts['maxwidth'], 
+                                  sopts['max_downfact'])
+    if info.breaks:
+        offregions = list(zip([x[1] for x in info.onoff[:-1]],
+                         [x[0] for x in info.onoff[1:]]))
+
+        # If last break spans to end of file, don't read it in (its just padding)
+        if offregions[-1][1] == N - 1:
+            N = offregions[-1][0] + 1
+
+    outfile = open(filenmbase+'.singlepulse', mode='w')
+
+    # Compute the file length in detrendlens
+    roundN = N // detrendlen * detrendlen
+    numchunks = roundN // chunklen
+    numblocks = roundN // detrendlen
+    # Pass 1: de-trend the data one batch of blocks at a
+    # time (through a memory map) for the block statistics
+    print('Reading "%s"...'%filenm)
+    print('  De-trending the data and computing statistics...')
+    stds = get_file_stds(filenm, roundN, detrendlen, fast=sopts['fast'])
+    bad_blocks, median_stds = get_bad_blocks(stds, sopts['badblocks'])
+    # Mask of bad blocks for the candidate cuts below
+    bad_mask = np.zeros(numblocks, dtype=bool)
+    bad_mask[bad_blocks] = True
+    print("  Now searching...")
+
+    # Pass 2: de-trend again, normalize, and search each 
+    # chunk as it is read.  With a process pool, each
+    # worker does this (along with the thresholding and
+    # prune_related1) for a range of chunks and we merge
+    # the results in chunk order
+    copts = dict(sopts, downfacts=downfacts, dt=dt, DM=info.DM)
+    if pool is None:
+        chunk_cands = search_chunks(filenm, roundN, stds, bad_mask,
+                                    0, numchunks, copts, kerns=kerns,
+                                    verbose=verbose)
+    else:
+        ranges = get_chunk_ranges(numchunks, sopts['nproc'])
+        futs = [ pool.submit(search_chunks, filenm, roundN, stds,
+                             bad_mask, c0, c1, copts) 
+                 for c0, c1 in ranges ]
+        chunk_cands = []
+        lastpct = -1
+        for fut, (c0, c1) in zip(futs, ranges):
+            chunk_cands += fut.result()
+            pct = 5 * (20 * c1 // max(numchunks, 1))
+            if pct > lastpct:
+                print("Processed chunks: %d/%d  (%d%%)" %(\
+                       c1, numchunks, pct))
+                lastpct = pct
+    dm_candlist = sort_cands(chunk_cands)
+
+    # Now walk through the dm_candlist and remove the ones that
+    # are within the downsample proximity of a higher
+    # signal-to-noise pulse
+    dm_candlist = prune_related2(dm_candlist, downfacts)
+    print("  Found %d pulse candidates in %s"%(len(dm_candlist), filenm))
+    
+    # Get rid of those near padding regions
+    if info.breaks:
+        dm_candlist = prune_border_cases(dm_candlist, offregions)
+
+    # Write the pulses to an ASCII output file
+    if len(dm_candlist):
+        #dm_candlist.sort(cmp_sigma)
+        outfile.write("# DM      Sigma      Time (s)     Sample    Downfact\n")
+        write_cands(outfile, dm_candlist)
+    outfile.close()
+    if sopts['spcands']:
+        spcands.write_spcands(filenmbase+'.spcands', dm_candlist,
+                              DM=info.DM, dt=dt, N=N,
+                              threshold=sopts['threshold'],
+                              source=os.path.basename(filenm))
+    return info, dm_candlist
+
+def get_file_mem(filenm, sopts):
+    # Rough peak memory (bytes) of search_file for a .dat file:
+    # a de-trending batch with its temporaries, the block 
+    # stats, and a few chunk length arrays
+    roundN = os.path.getsize(filenm) // 4
+    roundN = roundN // sopts['detrendlen'] * sopts['detrendlen']
+    nbatch = max(sopts['batchlen'] // sopts['detrendlen'], 1)
+    batchlen = min(nbatch * sopts['detrendlen'], roundN)
+    return 24 * batchlen + 16 * (roundN // sopts['detrendlen']) + \
+           64 * (sopts['chunklen'] + 2 * sopts['overlap'])
+
+def search_files(filenms, sopts, pool, nproc, mem_gb=0.0):
+    # Search the files with search_file in the process pool 
+    # (workers set up with init_worker), with at most nproc 
+    # at a time and, if mem_gb > 0, with their total memory 
+    # (see get_file_mem) within mem_gb GB.  The files are 
+    # started in order, and one too big for the budget on its
+    # own is searched by itself.  Returns the search_file 
+    # results in the same order as filenms
+    mems = [ get_file_mem(filenm, sopts) for filenm in filenms ]
+    results = [None] * len(filenms)
+    running = {}
+    inext = 0
+    while inext < len(filenms) or len(running):
+        # Start whatever fits
+        while inext < len(filenms) and len(running) < nproc:
+            mem_used = sum([ mems[ii] for ii in running.values() ])
+            if len(running) and mem_gb > 0 and \
+               mem_used + mems[inext] > mem_gb * 1e9:
+                break
+            fut = pool.submit(search_file, filenms[inext], sopts, 
+                              verbose=False)
+            running[fut] = inext
+            inext += 1
+        done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+        for fut in done:
+            results[running.pop(fut)] = fut.result()
+    return results
 
 full_usage = """
 usage:  single_pulse_search.py [options] .dat files _or_ .singlepulse files
@@ -167,6 +956,14 @@ usage:  single_pulse_search.py [options] .dat files _or_ .singlepulse files
   [-f, --fast]        : Use a less-accurate but much faster method of detrending
   [-b, --nobadblocks] : Don't check for bad-blocks (may save strong pulses)
   [-d, --detrendlen]  : Chunksize for detrending (pow-of-2 in 1000s, default=1)
+  [-r, --multires]    : Search downfacts wider than this on decimated data
+  [-n, --nproc]       : Number of processes searching the files (or the chunks
+                        of a single file) (default=1)
+  [--mem]             : Memory (GB) for searching files in parallel (default=0,
+                        no limit)
+  [-c, --engine]      : Boxcar engine, fft or cumsum (default=fft if we have
+                        the presto rfft, else cumsum)
+  [--spcands]         : Also write the cands to a binary .spcands file
 
   Perform a single-pulse search (or simply re-plot the results of a
   single-pulse search) on a set of de-dispersed time series (.dat
@@ -238,11 +1035,13 @@ usage = "usage: %prog [options] .dat files _or_ .singlepulse files"
     
 def read_singlepulse_files(infiles, threshold, T_start, T_end):
     DMs = []
-    candlist = []
+    cand_arrays = []
     num_v_DMstr = {}
     for ii, infile in enumerate(infiles):
         if infile.endswith(".singlepulse"):
             filenmbase = infile[:infile.rfind(".singlepulse")]
+        elif infile.endswith(".spcands"):
+            filenmbase = infile[:infile.rfind(".spcands")]
         else:
             filenmbase = infile
         info = infodata.infodata(filenmbase+".inf")
@@ -252,21 +1051,53 @@ def read_singlepulse_files(infiles, threshold, T_start, T_end):
         if ii==0:
             info0 = info
         if os.stat(infile)[6]:
-            try:
-                cands = np.loadtxt(infile)
-                if len(cands.shape)==1:
-                    cands = np.asarray([cands])
-                for cand in cands:
-                    if cand[2] < T_start: continue
-                    if cand[2] > T_end: break
-                    if cand[1] >= threshold:
-                        candlist.append(candidate(*cand))
-                        num_v_DMstr[DMstr] += 1
-            except:  # No candidates in the file
-                IndexError
+            # From the binary spcands file if there is one
+            cands = spcands.load_cands(infile)
+            # Cands are in time order, so stop at the first past T_end
+            past = np.flatnonzero(cands['time'] > T_end)
+            if len(past):
+                cands = cands[:past[0]]
+            cands = cands[(cands['time'] >= T_start) & 
+                          (cands['sigma'] >= threshold)]
+            cand_arrays.append(cands)
+            num_v_DMstr[DMstr] += len(cands)
     DMs.sort()
+    if len(cand_arrays):
+        candlist = np.concatenate(cand_arrays)
+    else:
+        candlist = np.zeros(0, dtype=cand_dtype)
     return info0, DMs, candlist, num_v_DMstr
 
+# With more than max_plot_cands candidates, the SNR vs DM and
+# DM vs Time plots show the candidate density as a grayscale
+# image and only the top_plot_cands highest SNR cands as points
+max_plot_cands = 20000
+top_plot_cands = 1000
+
+def get_plot_inds(cand_SNRs):
+    # Indices of the cands to plot as points (all of them
+    # unless there are more than max_plot_cands)
+    if len(cand_SNRs) > max_plot_cands:
+        return np.argpartition(cand_SNRs, -top_plot_cands)[-top_plot_cands:]
+    else:
+        return np.arange(len(cand_SNRs))
+
+def plot_density(xx, yy, xlo, xhi, ylo, yhi, nx=400, ny=200):
+    # Grayscale image of the number of points (log scale)
+    # in nx x ny bins covering the current plot window
+    from presto import ppgplot
+    counts, xe, ye = np.histogram2d(xx, yy, bins=(nx, ny),
+                                    range=((xlo, xhi), (ylo, yhi)))
+    # pggray wants the image as (y, x)
+    img = np.log10(1.0 + counts.T).astype(np.float32)
+    dx = (xhi - xlo) / float(nx)
+    dy = (yhi - ylo) / float(ny)
+    # Pixel (1, 1) is centered on the first bin
+    tr = np.array([xlo - 0.5*dx, dx, 0.0, ylo - 0.5*dy, 0.0, dy],
+                  dtype=np.float32)
+    ppgplot.pggray_s(img, max(img.max(), 1.0), 0.0, tr)
+    return
+
 def main():
     parser = OptionParser(usage)
     parser.add_option("-x", "--xwin", action="store_true", dest="xwin",
@@ -289,6 +1120,22 @@ def main():
                       default=True, help="Don't check for bad-blocks (may save strong pulses)")
     parser.add_option("-d", "--detrendlen", type="int", dest="detrendfact", default=1,
                       help="Chunksize for detrending (pow-of-2 in 1000s)")
+    parser.add_option("-r", "--multires", type="int", dest="multires", default=0,
+                      help="Search downfacts wider than this on the timeseries "
+                           "decimated by 2x per level (default=0, all at full res)")
+    parser.add_option("-n", "--nproc", type="int", dest="nproc", default=1,
+                      help="Number of processes searching the files (or "
+                           "the chunks of a single file) (default=1)")
+    parser.add_option("--mem", type="float", dest="mem", default=0.0,
+                      help="Memory in GB for searching files in parallel "
+                           "(default=0, only limited by --nproc)")
+    parser.add_option("-c", "--engine", type="choice", dest="engine",
+                      choices=["fft", "cumsum"], default=default_engine,
+                      help="Do the boxcars by FFT convolution or from "
+                           "prefix sums (default=%s)" %default_engine)
+    parser.add_option("--spcands", action="store_true", dest="spcands",
+                      default=False, help="Also write the candidates to a "
+                      "binary .spcands file (see spcands.py)")
     (opts, args) = parser.parse_args()
     if len(args)==0:
         if opts.globexp==None:
@@ -298,7 +1145,9 @@ def main():
             args = []
             for globexp in opts.globexp.split():
                 args += glob.glob(globexp)
-    useffts = True
+    if opts.engine == 'fft' and rfft is None:
+        print("No presto rfft, using the cumsum engine")
+        opts.engine = 'cumsum'
     dosearch = True
     if opts.xwin:
         pgplot_device = "/XWIN"
@@ -311,37 +1160,17 @@ def main():
     ftmp = args[0]
     if ftmp.endswith(".dat"):
         ftmp_base = ftmp[:ftmp.rfind(".dat")]
+    elif ftmp.endswith(".singlepulse"):
+        ftmp_base = ftmp[:ftmp.rfind(".singlepulse")]
+    elif ftmp.endswith(".spcands"):
+        ftmp_base = ftmp[:ftmp.rfind(".spcands")]
     else:
         ftmp_base = ftmp
     info = infodata.infodata(ftmp_base+".inf")
     dt = info.dt
     
-    default_downfacts = [2, 3, 4, 6, 9, 14, 20, 30, 45, 70, 100, 150, 220, 
-                         300, 450, 700, 1000, 1500, 2400, 3600, 5400, 7200, 
-                         12000, 18000, 24000, 36000]
-
-    # Get a max downfact size
-    if opts.maxwidth > 0.0:
-        max_downfact = int(opts.maxwidth/dt)
-    else:
-        max_downfact = default_downfacts[-1]
-
-    if max_downfact > default_downfacts[-1]:
-        print("Desired max template width: %d bins (%.3f ms)" \
-               %(max_downfact, max_downfact*dt*1000))
-        print("is larger than max template size: %d (%.3f ms)" \
-               %(default_downfacts[-1], default_downfacts[-1]*dt*1000))
-        print(".... using that instead")
-        max_downfact = default_downfacts[-1]
-
-    # Detrend on timescale of ~0.1 sec
-    detrendlen = int(next2_to_n(int(0.1/dt)))
-    if detrendlen < 2 * max_downfact:
-        detrendlen = int(next2_to_n(2 * max_downfact))
-
-    fftlen = int(next2_to_n(detrendlen + max_downfact))
-    print(fftlen, detrendlen)
-    print("Detrend time: %.3f sec" %(detrendlen * dt))
+    # Get a max downfact size, detrending length and FFT length
+    detrendlen, fftlen, max_downfact = get_search_lengths(dt, opts.maxwidth)
 
     chunklen = detrendlen
 
@@ -352,6 +1181,9 @@ def main():
     if args[0].endswith(".singlepulse"):
         filenmbase = args[0][:args[0].rfind(".singlepulse")]
         dosearch = False
+    elif args[0].endswith(".spcands"):
+        filenmbase = args[0][:args[0].rfind(".spcands")]
+        dosearch = False
     elif args[0].endswith(".dat"):
         filenmbase = args[0][:args[0].rfind(".dat")]
     else:
@@ -364,229 +1196,68 @@ def main():
         orig_N, orig_dt = int(info.N), info.dt
         obstime = orig_N * orig_dt
     else:
+        # The search kernels (same for all files)
+        downfacts = get_downfacts(dt, opts.maxwidth, max_downfact)
+        if opts.engine == 'fft':
+            fftd_kerns = make_fftd_kerns(default_downfacts, fftlen)
+        else:
+            fftd_kerns = None
+        if opts.multires > 0:
+            plan = get_multires_plan(downfacts, chunklen, overlap, 
+                                     fftlen, opts.multires,
+                                     engine=opts.engine)
+            kerns = plan
+        else:
+            kerns = fftd_kerns
+
+        sopts = {'detrendlen' : detrendlen, 'chunklen' : chunklen,
+                 'overlap' : overlap, 'fast' : opts.fast,
+                 'batchlen' : max(2**22 // max(opts.nproc, 1), 1),
+                 'multires' : opts.multires, 'maxwidth' : opts.maxwidth,
+                 'max_downfact' : max_downfact, 'nproc' : opts.nproc,
+                 'badblocks' : opts.badblocks, 'spcands' : opts.spcands,
+                 'threshold' : opts.threshold, 'engine' : opts.engine}
+
+        # The workers get the kernels once, and each does its
+        # own reading and normalizing of the data.  With more
+        # than one file, each worker searches whole files, else
+        # each searches ranges of chunks of the one file
+        if opts.nproc > 1:
+            pool = ProcessPoolExecutor(max_workers=opts.nproc,
+                                       initializer=init_worker,
+                                       initargs=(kerns,))
+        else:
+            pool = None
+        if pool is not None and len(args) > 1:
+            results = search_files(args, sopts, pool, opts.nproc, 
+                                   mem_gb=opts.mem)
+        else:
+            results = [ search_file(filenm, sopts, kerns=kerns, pool=pool)
+                        for filenm in args ]
+        if pool is not None:
+            pool.shutdown()
+
+        # Put together the candidates of all the files
         DMs = []
-        candlist = []
+        cand_arrays = []
         num_v_DMstr = {}
-
-        # Loop over the input files
-        for filenm in args:
-            if filenm.endswith(".dat"):
-                filenmbase = filenm[:filenm.rfind(".dat")]
-            else:
-                filenmbase = filenm
-            info = infodata.infodata(filenmbase+".inf")
-            DMstr = "%.2f"%info.DM
+        for info, dm_candlist in results:
             DMs.append(info.DM)
-            N, dt = int(info.N), info.dt
-            obstime = N * dt
-            # Choose the maximum width to search based on time instead
-            # of bins.  This helps prevent increased S/N when the downsampling
-            # changes as the DM gets larger.
-            if opts.maxwidth > 0.0:
-                downfacts = [x for x in default_downfacts if x*dt <= opts.maxwidth]
-            else:
-                downfacts = [x for x in default_downfacts if x <= max_downfact]
-            if len(downfacts) == 0:
-                downfacts = [default_downfacts[0]]
-            if (filenm == args[0]):
-                orig_N = N
-                orig_dt = dt
-                if useffts:
-                    fftd_kerns = make_fftd_kerns(default_downfacts, fftlen)
-            if info.breaks:
-                offregions = list(zip([x[1] for x in info.onoff[:-1]],
-                                 [x[0] for x in info.onoff[1:]]))
-
-                # If last break spans to end of file, don't read it in (its just padding)
-                if offregions[-1][1] == N - 1:
-                    N = offregions[-1][0] + 1
-
-            outfile = open(filenmbase+'.singlepulse', mode='w')
-
-            # Compute the file length in detrendlens
-            roundN = N // detrendlen * detrendlen
-            numchunks = roundN // chunklen
-            # Read in the file
-            print('Reading "%s"...'%filenm)
-            timeseries = np.fromfile(filenm, dtype=np.float32, count=roundN)
-            # Split the timeseries into chunks for detrending
-            numblocks = roundN // detrendlen
-            timeseries.shape = (numblocks, detrendlen)
-            stds = np.zeros(numblocks, dtype=np.float64)
-            # de-trend the data one chunk at a time
-            print('  De-trending the data and computing statistics...')
-            for ii, chunk in enumerate(timeseries):
-                if opts.fast:  # use median removal instead of detrending (2x speedup)
-                    tmpchunk = chunk.copy()
-                    tmpchunk.sort()
-                    med = tmpchunk[detrendlen//2]
-                    chunk -= med
-                    tmpchunk -= med
-                else:
-                    # The detrend calls are the most expensive in the program
-                    timeseries[ii] = scipy.signal.detrend(chunk, type='linear')
-                    tmpchunk = timeseries[ii].copy()
-                    tmpchunk.sort()
-                # The following gets rid of (hopefully) most of the 
-                # outlying values (i.e. power dropouts and single pulses)
-                # If you throw out 5% (2.5% at bottom and 2.5% at top)
-                # of random gaussian deviates, the measured stdev is ~0.871
-                # of the true stdev.  Thus the 1.0/0.871=1.148 correction below.
-                # The following is roughly .std() since we already removed the median
-                stds[ii] = np.sqrt((tmpchunk[detrendlen//40:-detrendlen//40]**2.0).sum() /
-                                    (0.95*detrendlen))
-            stds *= 1.148
-            # sort the standard deviations and separate those with
-            # very low or very high values
-            sort_stds = stds.copy()
-            sort_stds.sort()
-            # identify the differences with the larges values (this
-            # will split off the chunks with very low and very high stds
-            locut = (sort_stds[1:numblocks//2+1] -
-                     sort_stds[:numblocks//2]).argmax() + 1
-            hicut = (sort_stds[numblocks//2+1:] -
-                     sort_stds[numblocks//2:-1]).argmax() + numblocks//2 - 2
-            std_stds = np.std(sort_stds[locut:hicut])
-            median_stds = sort_stds[(locut+hicut)//2]
-            print("    pseudo-median block standard deviation = %.2f" % (median_stds))
-            if (opts.badblocks):
-                lo_std = median_stds - 4.0 * std_stds
-                hi_std = median_stds + 4.0 * std_stds
-                # Determine a list of "bad" chunks.  We will not search these.
-                bad_blocks = np.nonzero((stds < lo_std) | (stds > hi_std))[0]
-                print("    identified %d bad blocks out of %d (i.e. %.2f%%)" % \
-                      (len(bad_blocks), len(stds),
-                       100.0*float(len(bad_blocks))/float(len(stds))))
-                stds[bad_blocks] = median_stds
-            else:
-                bad_blocks = []
-            print("  Now searching...")
-
-            # Now normalize all of the data and reshape it to 1-D
-            print("Normalizing data...")
-            timeseries /= stds[:,np.newaxis]
-            timeseries.shape = (roundN,)
-            # And set the data in the bad blocks to zeros
-            # Even though we don't search these parts, it is important
-            # because of the overlaps for the convolutions
-            for bad_block in bad_blocks:
-                loind, hiind = bad_block*detrendlen, (bad_block+1)*detrendlen
-                timeseries[loind:hiind] = 0.0
-            # Convert to a set for faster lookups below
-            bad_blocks = set(bad_blocks)
-
-            # Step through the data
-            dm_candlist = []
-            pchunks = (numchunks * 0.01 * np.arange(0, 101, 5)).astype('int')
-            for chunknum in range(numchunks):
-                if chunknum in pchunks:
-                    print("Processing chunk: %d/%d" %(chunknum, numchunks) +\
-                          "  (%.1f%%)" %(100 * chunknum/numchunks))
-                loind = chunknum*chunklen-overlap
-                hiind = (chunknum+1)*chunklen+overlap
-                # Take care of beginning and end of file overlap issues
-                if (chunknum==0): # Beginning of file
-                    chunk = np.zeros(worklen, dtype=np.float32)
-                    chunk[overlap:] = timeseries[loind+overlap:hiind]
-                elif (chunknum==numchunks-1): # end of the timeseries
-                    chunk = np.zeros(worklen, dtype=np.float32)
-                    chunk[:-overlap] = timeseries[loind:hiind-overlap]
-                else:
-                    chunk = timeseries[loind:hiind]
-
-                # Make a set with the current block numbers
-                lowblock = blocks_per_chunk * chunknum
-                currentblocks = set(np.arange(blocks_per_chunk) + lowblock)
-                localgoodblocks = np.asarray(list(currentblocks -
-                                                   bad_blocks)) - lowblock
-                # Search this chunk if it is not all bad
-                if len(localgoodblocks):
-                    # This is the good part of the data (end effects removed)
-                    goodchunk = chunk[overlap:-overlap]
-
-                    # need to pass blocks/chunklen, localgoodblocks
-                    # dm_candlist, dt, opts.threshold to cython routine
-
-                    # Search non-downsampled data first
-                    # NOTE:  these nonzero() calls are some of the most
-                    #        expensive calls in the program.  Best bet would 
-                    #        probably be to simply iterate over the goodchunk
-                    #        in C and append to the candlist there.
-                    hibins = np.flatnonzero(goodchunk>opts.threshold)
-                    hivals = goodchunk[hibins]
-                    hibins += chunknum * chunklen
-                    hiblocks = hibins // detrendlen
-                    # Add the candidates (which are sorted by bin)
-                    for bin, val, block in zip(hibins, hivals, hiblocks):
-                        if block not in bad_blocks:
-                            time = bin * dt
-                            dm_candlist.append(candidate(info.DM, val, time, bin, 1))
-
-                    # Prepare our data for the convolution
-                    if useffts: fftd_chunk = rfft(chunk, -1)
-
-                    # Now do the downsampling...
-                    for ii, downfact in enumerate(downfacts):
-                        if useffts: 
-                            # Note:  FFT convolution is faster for _all_ downfacts, even 2
-                            goodchunk = fft_convolve(fftd_chunk, fftd_kerns[ii],
-                                                     overlap, -overlap)
-                        else:
-                            # The normalization of this kernel keeps the post-smoothing RMS = 1
-                            kernel = np.ones(downfact, dtype=np.float32) / \
-                                     np.sqrt(downfact)
-                            smoothed_chunk = scipy.signal.convolve(chunk, kernel, 1)
-                            goodchunk = smoothed_chunk[overlap:-overlap]
-                        #hibins = np.nonzero(goodchunk>opts.threshold)[0]
-                        hibins = np.flatnonzero(goodchunk>opts.threshold)
-                        hivals = goodchunk[hibins]
-                        hibins += chunknum * chunklen
-                        hiblocks = hibins // detrendlen
-                        hibins = hibins.tolist()
-                        hivals = hivals.tolist()
-                        # Now walk through the new candidates and remove those
-                        # that are not the highest but are within downfact/2
-                        # bins of a higher signal pulse
-                        hibins, hivals = prune_related1(hibins, hivals, downfact)
-                        # Insert the new candidates into the candlist, but
-                        # keep it sorted...
-                        for bin, val, block in zip(hibins, hivals, hiblocks):
-                            if block not in bad_blocks:
-                                time = bin * dt
-                                bisect.insort(dm_candlist,
-                                              candidate(info.DM, val, time, bin, downfact))
-
-            # Now walk through the dm_candlist and remove the ones that
-            # are within the downsample proximity of a higher
-            # signal-to-noise pulse
-            dm_candlist = prune_related2(dm_candlist, downfacts)
-            print("  Found %d pulse candidates"%len(dm_candlist))
-            
-            # Get rid of those near padding regions
-            if info.breaks: prune_border_cases(dm_candlist, offregions)
-
-            # Write the pulses to an ASCII output file
-            if len(dm_candlist):
-                #dm_candlist.sort(cmp_sigma)
-                outfile.write("# DM      Sigma      Time (s)     Sample    Downfact\n")
-                for cand in dm_candlist:
-                    outfile.write(str(cand))
-            outfile.close()
-
-            # Add these candidates to the overall candidate list
-            for cand in dm_candlist:
-                candlist.append(cand)
-            num_v_DMstr[DMstr] = len(dm_candlist)
+            cand_arrays.append(dm_candlist)
+            num_v_DMstr["%.2f"%info.DM] = len(dm_candlist)
+        orig_N, orig_dt = int(results[0][0].N), results[0][0].dt
+        obstime = int(info.N) * info.dt
+        candlist = sort_cands(cand_arrays)
 
     if (opts.makeplot):
 
+        # Only load PGPLOT if we are plotting
+        from presto import ppgplot
+
         # Step through the candidates to make a SNR list
         DMs.sort()
-        snrs = []
-        for cand in candlist:
-            if not np.isinf(cand.sigma):
-                snrs.append(cand.sigma)
-        if snrs:
+        snrs = candlist['sigma'][~np.isinf(candlist['sigma'])]
+        if len(snrs):
             maxsnr = max(int(max(snrs)), int(opts.threshold)) + 3
         else:
             maxsnr = int(opts.threshold) + 3
@@ -650,13 +1321,14 @@ def main():
         ppgplot.pgmtxt('B', 2.5, 0.5, 0.5, r"DM (pc cm\u-3\d)")
         ppgplot.pgmtxt('L', 1.8, 0.5, 0.5, "Signal-to-Noise")
         ppgplot.pgsch(1.0)
-        cand_ts = np.zeros(len(candlist), dtype=np.float32)
-        cand_SNRs = np.zeros(len(candlist), dtype=np.float32)
-        cand_DMs = np.zeros(len(candlist), dtype=np.float32)
-        for ii, cand in enumerate(candlist):
-            cand_ts[ii], cand_SNRs[ii], cand_DMs[ii] = \
-                         cand.time, cand.sigma, cand.DM
-        ppgplot.pgpt(cand_DMs, cand_SNRs, 20)
+        cand_ts = candlist['time'].astype(np.float32)
+        cand_SNRs = candlist['sigma'].astype(np.float32)
+        cand_DMs = candlist['DM'].astype(np.float32)
+        plot_inds = get_plot_inds(cand_SNRs)
+        if len(candlist) > max_plot_cands:
+            plot_density(cand_DMs, cand_SNRs, min(DMs)-0.5, max(DMs)+0.5, 
+                         opts.threshold, maxsnr)
+        ppgplot.pgpt(cand_DMs[plot_inds], cand_SNRs[plot_inds], 20)
 
         # plot the DM vs Time plot
         ppgplot.pgsvp(0.06, 0.97, 0.08, 0.52)
@@ -665,6 +1337,12 @@ def main():
         ppgplot.pgbox("BCNST", 0, 0, "BCNST", 0, 0)
         ppgplot.pgmtxt('B', 2.5, 0.5, 0.5, "Time (s)")
         ppgplot.pgmtxt('L', 1.8, 0.5, 0.5, r"DM (pc cm\u-3\d)")
+        if len(candlist) > max_plot_cands:
+            plot_density(cand_ts, cand_DMs, opts.T_start, opts.T_end, 
+                         min(DMs)-0.5, max(DMs)+0.5)
+        cand_ts = cand_ts[plot_inds]
+        cand_SNRs = cand_SNRs[plot_inds]
+        cand_DMs = cand_DMs[plot_inds]
         # Circles are symbols 20-26 in increasing order
         snr_range = 12.0
         cand_symbols = (cand_SNRs-opts.threshold)/snr_range * 6.0 + 20.5
@@ -4,10 +4,12 @@ import os
 from argparse import ArgumentParser
 from subprocess import call
 import glob
+import spcands
 #import sp_spec as splt
 
 import matplotlib.pyplot as plt 
 from matplotlib.gridspec import GridSpec
+from matplotlib.colors import LogNorm
 
 #os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
 
@@ -17,7 +19,12 @@ from matplotlib.gridspec import GridSpec
 
 class SP_CAND:
     def __init__(self, line, num):
-        cols = line.split()
+        # line is a line of a singlepulse file or a row 
+        # of a candidate array (see spcands.py)
+        if isinstance(line, str):
+            cols = line.split()
+        else:
+            cols = line
         self.dm = float(cols[0])
         self.snr = float(cols[1])
         self.time = float(cols[2])
@@ -40,8 +47,18 @@ class SP_CAND:
 def cands_from_spfile(spfile):
     """
     Read in the candidates from a *singlepulse (sp) file
-    and return an array of SP_CAND class objects
+    and return an array of SP_CAND class objects.  They 
+    come from the binary spcands file for spfile if there
+    is an up to date one (or if spfile is one)
     """
+    cfile = spcands.get_binary(spfile)
+    if cfile is not None:
+        cands, hdr = spcands.read_spcands(cfile)
+        candlist = [ SP_CAND(cc, ii + 1) for ii, cc in 
+                     enumerate(cands.tolist()) ]
+        return np.array(candlist)
+    else: pass
+
     ii = 1
     candlist = []
     with open(spfile, 'r') as fin:
@@ -404,46 +421,58 @@ def sift_dm_dupes(clist, nchan, fch1, df, dt):
     candidates that may be duplicates of 
     higher SNR burts at wrong DMs
     """ 
+    if len(clist) == 0:
+        return np.array([])
+    else: pass
+
     snrs = np.array([ cc.snr for cc in clist ])
     xx = np.argsort(snrs)[::-1]
-
     c_snrs = clist[xx]
-    c_out  = []
-
-    while(len(c_snrs)):
-        #print(c_snrs[0].snr)
-        # add current candidate to output
-        c_out.append(c_snrs[0])
 
-        # get dms and times
-        dms = np.array([ cc.dm for cc in c_snrs ])
-        tts = np.array([ cc.time for cc in c_snrs ])
-        wws = np.array([ cc.wbins for cc in c_snrs ]) * dt
+    # get dms, times, and widths (in SNR order)
+    dms = np.array([ cc.dm for cc in c_snrs ])
+    tts = np.array([ cc.time for cc in c_snrs ])
+    wws = np.array([ cc.wbins for cc in c_snrs ]) * dt
+
+    # Time offset per unit DM (see t_dm_shifts)
+    dm_fac = t_dm_shifts(1.0, nchan, fch1, df)
+
+    # No cand can be a duplicate of one further than this 
+    # in time (plus a sample for rounding)
+    twin = np.abs(dm_fac) * (np.max(dms) - np.min(dms)) + \
+           2 * np.max(wws) + dt
+
+    # Time sorted order to find the cands in the window 
+    tsort = np.argsort(tts, kind='stable')
+    t_sorted = tts[tsort]
+
+    # Go through in SNR order and keep each cand that has 
+    # not been removed as a duplicate of a brighter one
+    alive = np.ones(len(c_snrs), dtype=bool)
+    keep = []
+    for ii in range(len(c_snrs)):
+        if not alive[ii]:
+            continue
+        else: pass
+        keep.append(ii)
 
-        # get dm and time of current candidate 
-        dm0 = c_snrs[0].dm
-        tt0 = c_snrs[0].time
-        ww0 = c_snrs[0].wbins * dt
+        # remaining cands in the time window
+        lo = np.searchsorted(t_sorted, tts[ii] - twin, side='left')
+        hi = np.searchsorted(t_sorted, tts[ii] + twin, side='right')
+        jj = tsort[lo:hi]
+        jj = jj[alive[jj]]
 
         # Calc offsets
-        dts = t_dm_shifts(dms-dm0, nchan, fch1, df)
+        dts = dm_fac * (dms[jj] - dms[ii])
 
         # what cands are within dts?
-        cond_xx = (np.abs(tt0-tts) <= np.abs(dts) + (wws + ww0)) & \
-                  (np.sign(tt0-tts) * np.sign(dts) >= 0) 
-
-        # cands outside are then just the negation
-        yy = np.where( cond_xx == False )[0]
-
-        # Now update the c_snrs array to just keep the 
-        # ones that are NOT duplicates 
-        c_snrs = c_snrs[yy]
+        cond_xx = (np.abs(tts[ii]-tts[jj]) <= np.abs(dts) + (wws[jj] + wws[ii])) & \
+                  (np.sign(tts[ii]-tts[jj]) * np.sign(dts) >= 0) 
 
-        # print the length as a check
-        #print(len(c_snrs))
+        # these are duplicates (including this cand)
+        alive[jj[cond_xx]] = False
 
-    # Convert output to array 
-    c_out = np.array(c_out)
+    c_out = c_snrs[keep]
 
     return c_out
           
@@ -704,9 +733,65 @@ def write_cands(clist, outfile):
 ###  SUMMARY PLOTS  ###
 #######################
 
-def time_summary(csift, clist, title=None, outfile=None, rmax=-1):
+def get_bins(vals, nbins, log=False):
+    """
+    Bin edges for nbins bins covering vals (log 
+    spaced if log, ignoring any vals <= 0)
+    """
+    if log:
+        vals = vals[vals > 0]
+    else: pass
+
+    if len(vals) == 0:
+        lo, hi = 1.0, 10.0
+    else:
+        lo, hi = np.min(vals), np.max(vals)
+    
+    if log:
+        if hi <= lo:
+            hi = 2 * lo
+        return np.geomspace(lo, hi, nbins + 1)
+    else:
+        if hi <= lo:
+            hi = lo + 1
+        return np.linspace(lo, hi, nbins + 1)
+
+
+def density_plot(ax, xx, yy, nbins=(400, 200), xlog=False, ylog=False):
+    """
+    Plot the number of points (xx, yy) in 2D bins as a 
+    (rasterized) grayscale image with a log color scale.
+    This takes about the same time for any number of 
+    points, unlike plotting each one 
+    """
+    xb = get_bins(xx, nbins[0], log=xlog)
+    yb = get_bins(yy, nbins[1], log=ylog)
+    hh, xb, yb = np.histogram2d(xx, yy, bins=(xb, yb))
+    hh = np.ma.masked_equal(hh, 0)
+    ax.pcolormesh(xb, yb, hh.T, cmap='Greys', norm=LogNorm(vmin=1),
+                  rasterized=True)
+    return
+
+
+def top_snr(snrs, ntop):
+    """
+    Indices of the ntop highest snrs (all if 
+    there are fewer)
+    """
+    if len(snrs) <= ntop:
+        return np.arange(len(snrs))
+    else:
+        return np.argpartition(snrs, -ntop)[-ntop:]
+
+
+def time_summary(csift, clist, title=None, outfile=None, rmax=-1,
+                 nmax=20000, ntop=1000):
     """
     Summary plots along time axis
+
+    If there are more than nmax cands, the DM and SNR vs 
+    time panels show their density (see density_plot) with
+    just the ntop highest SNR cands plotted as points 
     """
     if outfile is not None:
         plt.ioff()
@@ -720,10 +805,24 @@ def time_summary(csift, clist, title=None, outfile=None, rmax=-1):
     tt0, snr0, dm0, ww0 = cand_params(clist)
     tt1, snr1, dm1, ww1 = cand_params(csift)
 
+    # Too many cands to plot one by one?
+    dense = len(tt0) > nmax
+    if dense:
+        xx0 = top_snr(snr0, ntop)
+    else:
+        xx0 = np.arange(len(tt0))
+    if len(tt1) > nmax:
+        xx1 = top_snr(snr1, ntop)
+    else:
+        xx1 = np.arange(len(tt1))
+
     # Top Panel is DM vs time with SNR size
-    ax1.scatter(tt0, dm0, s=25*(snr0/10)**2.0, fc='none', 
+    if dense:
+        density_plot(ax1, tt0, dm0, ylog=True)
+    else: pass
+    ax1.scatter(tt0[xx0], dm0[xx0], s=25*(snr0[xx0]/10)**2.0, fc='none', 
                 ec='k', lw=1)
-    ax1.scatter(tt1, dm1, s=25*(snr1/10)**2.0, ec='r', 
+    ax1.scatter(tt1[xx1], dm1[xx1], s=25*(snr1[xx1]/10)**2.0, ec='r', 
                 marker='s', lw=1, fc='none')
 
     ax1.set_yscale('log')
@@ -740,8 +839,11 @@ def time_summary(csift, clist, title=None, outfile=None, rmax=-1):
     ax2.set_ylabel('Hits/min', fontsize=14)
 
     # Bottom plot is snr
-    ax3.plot(tt0, snr0, marker='.', ls='', c='k')
-    ax3.plot(tt1, snr1, marker='o', mfc='none', mec='r', 
+    if dense:
+        density_plot(ax3, tt0, snr0)
+    else: pass
+    ax3.plot(tt0[xx0], snr0[xx0], marker='.', ls='', c='k')
+    ax3.plot(tt1[xx1], snr1[xx1], marker='o', mfc='none', mec='r', 
              ls='')
     ax3.set_ylim(5)
 
@@ -761,9 +863,14 @@ def time_summary(csift, clist, title=None, outfile=None, rmax=-1):
     return
 
 
-def snr_summary(csift, clist, title=None, outfile=None):
+def snr_summary(csift, clist, title=None, outfile=None, nmax=20000,
+                ntop=1000):
     """
     Summary plots along time axis
+
+    If there are more than nmax sifted cands, the bottom 
+    panels show their density (see density_plot) with just
+    the ntop highest SNR cands plotted as points 
     """
     if outfile is not None:
         plt.ioff()
@@ -799,21 +906,31 @@ def snr_summary(csift, clist, title=None, outfile=None):
     ax3.set_xlabel("Width (bins)", fontsize=fs)
     
 
+    # Too many cands to plot one by one?
+    dense = len(dm1) > nmax
+    if dense:
+        xx1 = top_snr(snr1, ntop)
+        density_plot(ax4, dm1, ww1, nbins=(200, 100), xlog=True, ylog=True)
+        density_plot(ax5, dm1, snr1, nbins=(200, 100), xlog=True)
+        density_plot(ax6, ww1, snr1, nbins=(200, 100), xlog=True)
+    else:
+        xx1 = np.arange(len(dm1))
+
     # Bottom Left plot DM vs Width
-    ax4.plot(dm1, ww1, marker='o', ls='', mfc='none')
+    ax4.plot(dm1[xx1], ww1[xx1], marker='o', ls='', mfc='none')
     ax4.set_xscale('log', base=10)
     ax4.set_yscale('log', base=2)
     ax4.set_xlabel('DM (pc/cc)', fontsize=fs)
     ax4.set_ylabel('Width (bins)', fontsize=fs)
 
     # Bottom Middle plot DM vs SNR
-    ax5.plot(dm1, snr1, marker='o', ls='', mfc='none')
+    ax5.plot(dm1[xx1], snr1[xx1], marker='o', ls='', mfc='none')
     ax5.set_xscale('log')
     ax5.set_xlabel('DM (pc/cc)', fontsize=fs)
     ax5.set_ylabel('SNR', fontsize=fs)
 
     # Bottom Right plot width vs SNR
-    ax6.plot(ww1, snr1, marker='o', ls='', mfc='none')
+    ax6.plot(ww1[xx1], snr1[xx1], marker='o', ls='', mfc='none')
     ax6.set_xscale('log', base=2)
     ax6.set_xlabel('Width (bins)', fontsize=fs)
     ax6.set_ylabel('SNR', fontsize=fs)
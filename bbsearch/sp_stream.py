@@ -0,0 +1,385 @@
+import os
+import time
+import numpy as np
+from argparse import ArgumentParser
+import dedisp
+import dat_filter
+import single_pulse_search_w16ms as sps
+import spcands
+
+
+###########################
+##  STREAMING SP SEARCH  ##
+###########################
+
+class SP_STREAM:
+    """
+    Single pulse search of a time series that arrives
+    in consecutive blocks of any size.  Gives the same
+    detrending, normalization, and boxcar search as
+    single_pulse_search_w16ms.py, but only holds about
+    one chunk plus its overlaps at a time.
+
+    The one difference is the bad block statistics.  The
+    file search uses the block stds of the whole series.
+    Here the first nwarm blocks are held back until we
+    have an estimate, and the estimate is updated from
+    all the blocks so far every nwarm blocks after that.
+
+    If multires > 0, downfacts wider than multires are 
+    searched on decimated data (see get_multires_plan in 
+    single_pulse_search_w16ms.py).  The boxcars are done
+    by FFT convolution if engine is 'fft' and from prefix
+    sums if 'cumsum'
+    """
+    def __init__(self, N, dt, DM, threshold=5.0, maxwidth=0.0,
+                 badblocks=True, fast=False, nwarm=256, multires=0,
+                 engine=sps.default_engine):
+        self.dt = dt
+        self.DM = DM
+        self.threshold = threshold
+        self.badblocks = badblocks
+        self.fast = fast
+        self.nwarm = nwarm
+        self.engine = engine
+
+        self.detrendlen, self.fftlen, max_downfact = \
+                          sps.get_search_lengths(dt, maxwidth)
+        self.chunklen = self.detrendlen
+        self.overlap = (self.fftlen - self.chunklen) // 2
+        self.downfacts = sps.get_downfacts(dt, maxwidth, max_downfact)
+        self.multires = multires
+        if multires > 0:
+            self.plan = sps.get_multires_plan(self.downfacts, self.chunklen,
+                                              self.overlap, self.fftlen,
+                                              multires, engine=engine)
+            self.downfacts = sps.get_plan_downfacts(self.plan)
+        elif engine == 'fft':
+            self.fftd_kerns = sps.make_fftd_kerns(self.downfacts, 
+                                                  self.fftlen)
+        else:
+            self.fftd_kerns = None
+
+        self.roundN = N // self.detrendlen * self.detrendlen
+        self.numchunks = self.roundN // self.chunklen
+
+        self.nin = 0                             # Samples taken in
+        self.raw = np.zeros(0, dtype='float32')  # Partial block
+        self.pending = []                        # Detrended blocks
+        self.stds = []                           # All block stds
+        self.nstat = 0                           # Blocks in estimate
+        self.lo_std = -np.inf
+        self.hi_std = np.inf
+        self.median_std = 1.0
+
+        self.nblock = 0                          # Blocks normalized
+        self.bad_mask = np.zeros(self.roundN // self.detrendlen, dtype=bool)
+        self.norm = np.zeros(0, dtype='float32') # Normalized data
+        self.norm0 = 0                           # Sample of norm[0]
+        self.chunknum = 0                        # Next chunk
+
+        self.dm_candlist = []                    # Cands per chunk
+
+    def update_stats(self):
+        # Bad block cuts from all of the block stds so far
+        stds = np.array(self.stds)
+        self.nstat = len(stds)
+        if len(stds) < 8:
+            self.median_std = np.median(stds)
+            return
+        else: pass
+        self.median_std, std_stds = sps.get_block_stats(stds)
+        self.lo_std = self.median_std - 4.0 * std_stds
+        self.hi_std = self.median_std + 4.0 * std_stds
+        return
+
+    def add(self, data):
+        # Add the next block of the time series
+        data = data[: max(self.roundN - self.nin, 0)]
+        self.nin += len(data)
+        self.raw = np.concatenate( (self.raw, data) )
+
+        nblk = len(self.raw) // self.detrendlen
+        if nblk:
+            nn = nblk * self.detrendlen
+            blocks = self.raw[:nn].reshape( (nblk, self.detrendlen) ).copy()
+            self.raw = self.raw[nn:]
+            stds = sps.detrend_blocks(blocks, fast=self.fast)
+            self.pending += list(zip(blocks, stds))
+            self.stds += stds.tolist()
+        else: pass
+
+        self.normalize(final=False)
+        self.search(final=False)
+        return
+
+    def normalize(self, final=False):
+        # Normalize the pending blocks once we have bad
+        # block statistics (or for all blocks if we are
+        # not looking for bad blocks)
+        if self.badblocks:
+            if self.nstat == 0 and len(self.stds) < self.nwarm and not final:
+                return
+            elif len(self.stds) - self.nstat >= self.nwarm or \
+                 self.nstat == 0 or final:
+                self.update_stats()
+            else: pass
+        else: pass
+
+        out = []
+        for block, std in self.pending:
+            if self.badblocks and \
+               (std < self.lo_std or std > self.hi_std):
+                # Bad blocks are zeroed and not searched
+                self.bad_mask[self.nblock] = True
+                out.append( np.zeros(self.detrendlen, dtype='float32') )
+            else:
+                out.append( block / std )
+            self.nblock += 1
+        self.pending = []
+
+        if len(out):
+            self.norm = np.concatenate( [self.norm] + out )
+        else: pass
+        return
+
+    def search(self, final=False):
+        # Search every chunk that has all of its overlap
+        # data (or all remaining chunks if final)
+        nnorm = self.norm0 + len(self.norm)
+        while self.chunknum < self.numchunks:
+            loind = self.chunknum * self.chunklen - self.overlap
+            hiind = (self.chunknum + 1) * self.chunklen + self.overlap
+            if min(hiind, self.roundN) > nnorm and not final:
+                break
+            else: pass
+
+            # Zero pad past the ends of the series
+            chunk = np.zeros(hiind - loind, dtype='float32')
+            lo = max(loind, self.norm0)
+            hi = min(hiind, nnorm)
+            chunk[lo - loind : hi - loind] = \
+                      self.norm[lo - self.norm0 : hi - self.norm0]
+
+            if self.multires > 0:
+                cands = sps.search_chunk_multires(chunk, self.chunknum, 
+                                                  self.chunklen, self.overlap,
+                                                  self.detrendlen,
+                                                  self.bad_mask, self.plan,
+                                                  self.threshold, self.dt,
+                                                  self.DM, engine=self.engine)
+            else:
+                cands = sps.search_chunk(chunk, self.chunknum, self.chunklen,
+                                         self.overlap, self.detrendlen, 
+                                         self.bad_mask, self.downfacts, 
+                                         self.fftd_kerns, self.threshold,
+                                         self.dt, self.DM, engine=self.engine)
+            self.dm_candlist.append(cands)
+            self.chunknum += 1
+
+            # Drop data we no longer need
+            ncut = self.chunknum * self.chunklen - self.overlap - self.norm0
+            if ncut > 0:
+                self.norm = self.norm[ncut:]
+                self.norm0 += ncut
+            else: pass
+        return
+
+    def finish(self):
+        # Search the rest of the data and return the
+        # candidate array (sorted by bin) after removing 
+        # duplicates
+        self.normalize(final=True)
+        self.search(final=True)
+        if self.badblocks:
+            print("    pseudo-median block standard deviation = %.2f" %(\
+                   self.median_std))
+            print("    identified %d bad blocks out of %d" %(\
+                   np.sum(self.bad_mask), self.nblock))
+        else: pass
+        dm_candlist = sps.sort_cands(self.dm_candlist)
+        dm_candlist = sps.prune_related2(dm_candlist, self.downfacts)
+        print("  Found %d pulse candidates" %len(dm_candlist))
+        return dm_candlist
+
+
+def write_singlepulse(spfile, dm_candlist, binary=False, **meta):
+    """
+    Write candidates to a singlepulse file in the same
+    format as single_pulse_search_w16ms.py (and to the
+    binary spcands file if binary, with the meta keywords
+    added to its header)
+    """
+    with open(spfile, 'w') as fout:
+        if len(dm_candlist):
+            fout.write("# DM      Sigma      Time (s)     Sample    Downfact\n")
+            sps.write_cands(fout, dm_candlist)
+        else: pass
+    if binary:
+        spcands.write_spcands(spcands.spcands_name(spfile), dm_candlist,
+                              **meta)
+    else: pass
+    return spfile
+
+
+def stream_search(filfile, dm, outbase, zap_chans=[], zerodm=False,
+                  zaplist=[], threshold=5.0, maxwidth=0.0, badblocks=True,
+                  fast=False, nthread=1, block_mb=16.0, write_dat=False,
+                  multires=0, telescope="Unknown", engine=sps.default_engine,
+                  binary=False):
+    """
+    Dedisperse filfile at dm, apply the harmonic filters
+    in zaplist (f0,nh,w strings as in dat_filter.py), and
+    search for single pulses in one pass.  Blocks of the
+    dedispersed time series go straight from dedisp.py
+    through the filter to the search, so the full time
+    series is never written or held in memory.
+
+    Writes outbase.singlepulse and outbase.inf (plus
+    outbase.dat with the filtered time series if
+    write_dat, and outbase.spcands if binary).  multires and engine ('fft' or 'cumsum'
+    boxcars) are as in SP_STREAM.
+
+    Returns the name of the singlepulse file (or None
+    on error)
+    """
+    tstart = time.time()
+
+    hdr, data, good, delays, nout = dedisp.dedisp_setup(filfile, dm,
+                                                        zap_chans)
+    if data is None:
+        return None
+    else: pass
+    dt = hdr['tsamp']
+
+    print("Streaming search of %s at DM = %.3f" %(filfile, dm))
+    print("  %d/%d channels, max delay = %d samples" %(\
+           np.sum(good), len(good), np.max(delays)))
+
+    blocks = dedisp.dedisp_stream(data, good, delays, nout, zerodm=zerodm,
+                                  nthread=nthread, block_mb=block_mb)
+
+    if len(zaplist):
+        freqs, nharms, widths = dat_filter.parse_zap(zaplist)
+        fcs, sos_list = dat_filter.get_filters(dt, freqs, nharms, widths)
+        nedge = dat_filter.get_edge_len(sos_list)
+        print("  Filtering %d frequencies (%d edge samples)" %(\
+               len(fcs), nedge))
+        blocks = dat_filter.filter_stream(blocks, sos_list, nedge)
+    else: pass
+
+    if write_dat:
+        datfile = "%s.dat" %outbase
+        out = np.memmap(datfile, dtype='float32', mode='w+', shape=(nout,))
+    else: pass
+
+    sp = SP_STREAM(nout, dt, dm, threshold=threshold, maxwidth=maxwidth,
+                   badblocks=badblocks, fast=fast, multires=multires,
+                   engine=engine)
+    istart = 0
+    for blk in blocks:
+        if write_dat:
+            out[istart : istart + len(blk)] = blk
+        else: pass
+        istart += len(blk)
+        sp.add(blk)
+    dm_candlist = sp.finish()
+
+    if write_dat:
+        out.flush()
+        del out
+    else: pass
+
+    dedisp.write_inf(outbase, hdr, nout, dm, telescope=telescope)
+    spfile = write_singlepulse("%s.singlepulse" %outbase, dm_candlist,
+                               binary=binary, DM=dm, dt=dt, N=nout,
+                               threshold=threshold,
+                               source=os.path.basename(filfile))
+
+    tstop = time.time()
+    print("Streaming search -- %.1f sec" %(tstop - tstart))
+
+    return spfile
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Dedisperse, filter, and single pulse search " +\
+                "a filterbank file in one pass"
+    parser = ArgumentParser(description=prog_desc)
+    parser.add_argument('filfile', help='Filterbank file')
+    parser.add_argument('-dm', '--dm', required=True, type=float,
+                        help='Dispersion Measure (pc/cc)')
+    parser.add_argument('-o', '--outbase', required=True,
+                        help='Output base name (writes outbase.singlepulse)')
+    parser.add_argument('-ignorechan', '--ignorechan', default="",
+                        help='Channels to ignore in PRESTO numbering ' +\
+                             '(eg, "0:3,10")', required=False)
+    parser.add_argument('--zerodm', action='store_true',
+                        help='Apply the zero DM filter')
+    parser.add_argument('-z', '--zap', action='append', default=[],
+                        help='Filter f0,nh,w (as in dat_filter.py). ' +\
+                             'Repeat for more frequencies', required=False)
+    parser.add_argument('-t', '--threshold', default=5.0, type=float,
+                        help='SNR threshold (def: 5)', required=False)
+    parser.add_argument('-m', '--maxwidth', default=0.0, type=float,
+                        help='Max boxcar width in sec (def: 0, all)',
+                        required=False)
+    parser.add_argument('-b', '--nobadblocks', action='store_false',
+                        dest='badblocks', help='Do not check for bad blocks')
+    parser.add_argument('-f', '--fast', action='store_true',
+                        help='Remove the median instead of detrending')
+    parser.add_argument('-r', '--multires', default=0, type=int,
+                        help='Search downfacts wider than this on ' +\
+                             'decimated data (def: 0, all full res)',
+                        required=False)
+    parser.add_argument('-nt', '--nthread', default=1, type=int,
+                        help='Number of dedispersion threads (def: 1)',
+                        required=False)
+    parser.add_argument('--engine', default=sps.default_engine,
+                        choices=['fft', 'cumsum'],
+                        help='Do the boxcars by FFT convolution or ' +\
+                             'from prefix sums (def: %s)' %sps.default_engine,
+                        required=False)
+    parser.add_argument('--write_dat', action='store_true',
+                        help='Also write the (filtered) time series ' +\
+                             'to outbase.dat')
+    parser.add_argument('--spcands', action='store_true',
+                        help='Also write the candidates to the binary ' +\
+                             'outbase.spcands')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Run streaming search
+    """
+    args = parse_input()
+
+    hdr, hsize = dedisp.fbk.read_header(args.filfile)
+    zap = dedisp.chans_from_string(args.ignorechan)
+    zap = dedisp.presto_to_file_chans(zap, hdr['nchans'], hdr['foff'])
+
+    stream_search(args.filfile, args.dm, args.outbase, zap_chans=zap,
+                  zerodm=args.zerodm, zaplist=args.zap,
+                  threshold=args.threshold, maxwidth=args.maxwidth,
+                  badblocks=args.badblocks, fast=args.fast,
+                  nthread=args.nthread, write_dat=args.write_dat,
+                  multires=args.multires, engine=args.engine,
+                  binary=args.spcands)
+
+    return
+
+
+debug = 0
+
+if __name__ == "__main__":
+    if debug:
+        pass
+    else:
+        main()
@@ -0,0 +1,201 @@
+import os
+import json
+import struct
+import numpy as np
+from argparse import ArgumentParser
+
+# Binary single pulse candidate files (.spcands)
+#
+# The text singlepulse files have to be parsed line by line
+# every time they are read, which is slow with many cands.
+# A spcands file holds the same columns as a structured
+# numpy array:
+#
+#     magic   8 bytes (b'SPCANDS' + version byte)
+#     hlen    uint32 (little endian) length of the header
+#     header  hlen bytes of JSON (fields, ncands, and 
+#             whatever the writer adds: DM, dt, etc)
+#     cands   the array in .npy format (np.save)
+#
+# It is written next to the singlepulse file (same base
+# name) and the readers use it instead of the text file
+# if it exists and is not older.
+
+SPC_VERSION = 1
+SPC_MAGIC = b'SPCANDS' + bytes([SPC_VERSION])
+
+# Same columns (and order) as the singlepulse files
+cand_dtype = np.dtype([('DM', np.float64), ('sigma', np.float64),
+                       ('time', np.float64), ('bin', np.int64),
+                       ('downfact', np.int64)])
+
+# Line format of the singlepulse files
+cand_fmt = "%7.2f %7.2f %13.6f %16d     %3d\n"
+
+
+###########################
+##  WRITING AND READING  ##
+###########################
+
+def spcands_name(spfile):
+    """
+    Name of the binary candidate file for spfile
+    """
+    if spfile.endswith(".singlepulse"):
+        base = spfile[:spfile.rfind(".singlepulse")]
+    else:
+        base = spfile
+    return "%s.spcands" %base
+
+
+def is_spcands(cfile):
+    """
+    Check if cfile is a binary candidate file
+    """
+    try:
+        with open(cfile, 'rb') as fin:
+            magic = fin.read(len(SPC_MAGIC))
+    except IOError:
+        return False
+    return magic[:-1] == SPC_MAGIC[:-1]
+
+
+def write_spcands(cfile, cands, **meta):
+    """
+    Write the candidate array cands (cand_dtype) to the
+    binary file cfile.  Any keyword arguments (JSON
+    serializable) are added to the header
+    """
+    cands = np.asarray(cands, dtype=cand_dtype)
+    hdr = {'fields' : list(cand_dtype.names),
+           'ncands' : len(cands)}
+    hdr.update(meta)
+    # (numpy scalars as python numbers)
+    hbytes = json.dumps(hdr, default=lambda xx: xx.item()).encode('utf-8')
+
+    with open(cfile, 'wb') as fout:
+        fout.write(SPC_MAGIC)
+        fout.write(struct.pack('<I', len(hbytes)))
+        fout.write(hbytes)
+        np.save(fout, cands, allow_pickle=False)
+
+    return cfile
+
+
+def read_spcands(cfile):
+    """
+    Read a binary candidate file and return the
+    candidate array and the header dict
+    """
+    with open(cfile, 'rb') as fin:
+        magic = fin.read(len(SPC_MAGIC))
+        if magic[:-1] != SPC_MAGIC[:-1]:
+            raise ValueError("Not a spcands file: %s" %cfile)
+        elif magic[-1] > SPC_VERSION:
+            raise ValueError("spcands version %d > %d: %s" %(\
+                              magic[-1], SPC_VERSION, cfile))
+        else: pass
+        hlen = struct.unpack('<I', fin.read(4))[0]
+        hdr = json.loads(fin.read(hlen).decode('utf-8'))
+        cands = np.load(fin, allow_pickle=False)
+
+    return cands, hdr
+
+
+def read_text(spfile):
+    """
+    Read the candidates from a text singlepulse file
+    into a cand_dtype array
+    """
+    with open(spfile, 'r') as fin:
+        lines = [ line for line in fin if line[0] not in ["\n", "#", "i"] ]
+
+    if len(lines):
+        cands = np.loadtxt(lines, dtype=cand_dtype, usecols=(0, 1, 2, 3, 4),
+                           ndmin=1)
+    else:
+        cands = np.zeros(0, dtype=cand_dtype)
+
+    return cands
+
+
+def get_binary(spfile):
+    """
+    Binary candidate file to read for spfile (None if
+    there isn't an up to date one).  spfile can be the
+    binary file itself
+    """
+    if is_spcands(spfile):
+        return spfile
+    else: pass
+
+    cfile = spcands_name(spfile)
+    if not os.path.exists(cfile):
+        return None
+    elif os.path.exists(spfile) and \
+         os.path.getmtime(cfile) < os.path.getmtime(spfile):
+        return None
+    else:
+        return cfile
+
+
+def load_cands(spfile):
+    """
+    Candidate array for spfile, from the binary file if
+    there is one (see get_binary), else from the text
+    """
+    cfile = get_binary(spfile)
+    if cfile is not None:
+        cands, hdr = read_spcands(cfile)
+    else:
+        cands = read_text(spfile)
+
+    return cands
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Convert singlepulse files to binary spcands files " +\
+                "(or back to text with --text)"
+    parser = ArgumentParser(description=prog_desc)
+    parser.add_argument('infiles', nargs='+',
+                        help='singlepulse (or spcands) files')
+    parser.add_argument('--text', action='store_true',
+                        help='Print the candidates of spcands files as text')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Convert files
+    """
+    args = parse_input()
+
+    for infile in args.infiles:
+        if args.text:
+            cands, hdr = read_spcands(infile)
+            print("# %s" %(json.dumps(hdr)))
+            print("# DM      Sigma      Time (s)     Sample    Downfact")
+            for cc in cands:
+                print(cand_fmt.rstrip("\n") %tuple(cc))
+        else:
+            cands = read_text(infile)
+            cfile = write_spcands(spcands_name(infile), cands,
+                                  source=os.path.basename(infile))
+            print("%s: %d cands -> %s" %(infile, len(cands), cfile))
+
+    return
+
+
+debug = 0
+
+if __name__ == "__main__":
+    if debug:
+        pass
+    else:
+        main()
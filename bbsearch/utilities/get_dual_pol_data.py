@@ -19,6 +19,10 @@ import filterbank
 
 import click
 
+# Binary candidate files (spcands.py) are read with the bbsearch module.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import spcands
+
 
 
 """ Read the filterbank file into memory. Store the data in a dynamically
@@ -42,6 +46,13 @@ def readFilterbankHeader(inputFilename):
 """ Read a PRESTO single pulse candidate list. """
 def read_sp_list(sp_fn):
 
+    # Use the binary candidate file if there is an up to date one.
+    binaryFilename = spcands.get_binary(sp_fn)
+    if binaryFilename is not None:
+        cands, binaryHeader = spcands.read_spcands(binaryFilename)
+        return list(cands['DM']), list(cands['sigma']), list(cands['time']), \
+               list(cands['bin'].astype(float)), list(cands['downfact'].astype(float))
+
     readFile = open(sp_fn, "r")
 
     # Read in the header from the data file.
@@ -1,20 +1,17 @@
+import os
+import struct
 import your 
 from your.formats.filwriter import make_sigproc_object
+import sigproc
 
 
-def write_snippet(data, in_yr, outbase, toffset):
+def make_snippet_obj(in_yr, outfile, tstart):
     """
-    Write snippet data filterbank from input your file 
-
-    toffset in seconds from start of file
+    Make the sigproc object for a snippet of the
+    input your file starting at tstart (MJD)
     """
     hdr_in = in_yr.your_header
 
-    outfile = "%s.fil" %outbase
-
-    tstart = hdr_in.tstart + (toffset / (24 * 3600.))
-
-    # Setup output filterbank file
     sig_obj = make_sigproc_object(
             rawdatafile   = outfile,
             source_name   = hdr_in.source_name,
@@ -37,6 +34,24 @@ def write_snippet(data, in_yr, outbase, toffset):
             az_start      = in_yr.az_start,
             za_start      = in_yr.za_start)
 
+    return sig_obj
+
+
+def write_snippet(data, in_yr, outbase, toffset):
+    """
+    Write snippet data filterbank from input your file 
+
+    toffset in seconds from start of file
+    """
+    hdr_in = in_yr.your_header
+
+    outfile = "%s.fil" %outbase
+
+    tstart = hdr_in.tstart + (toffset / (24 * 3600.))
+
+    # Setup output filterbank file
+    sig_obj = make_snippet_obj(in_yr, outfile, tstart)
+
     # Write header
     sig_obj.write_header(outfile)
 
@@ -44,3 +59,77 @@ def write_snippet(data, in_yr, outbase, toffset):
     sig_obj.append_spectra(data, outfile)
 
     return 
+
+
+def snippet_template(in_yr, tmpbase):
+    """
+    Write the snippet header for the input your file
+    once (to tmpbase.fil, which is removed) and split
+    it around the values that change from snippet to
+    snippet (tstart and rawdatafile).  Returns the
+    template for write_snippet_fast:
+
+        (parts, names, tstart0)
+    """
+    tmpfile = "%s.fil" %tmpbase
+    tstart0 = in_yr.your_header.tstart
+
+    sig_obj = make_snippet_obj(in_yr, tmpfile, tstart0)
+    sig_obj.write_header(tmpfile)
+    with open(tmpfile, 'rb') as fin:
+        hdr = fin.read()
+    os.remove(tmpfile)
+
+    # (start, end, name) of the values in hdr
+    slots = []
+    key = sigproc.prep_string("tstart")
+    ii = hdr.index(key) + len(key)
+    slots.append((ii, ii + 8, "tstart"))
+
+    key = sigproc.prep_string("rawdatafile")
+    if key in hdr:
+        ii = hdr.index(key) + len(key)
+        nlen = struct.unpack('i', hdr[ii:ii+4])[0]
+        slots.append((ii, ii + 4 + nlen, "rawdatafile"))
+    else: pass
+
+    slots.sort()
+    parts = []
+    names = []
+    last = 0
+    for ii, jj, name in slots:
+        parts.append(hdr[last:ii])
+        names.append(name)
+        last = jj
+    parts.append(hdr[last:])
+
+    return parts, names, tstart0
+
+
+def write_snippet_fast(data, template, outbase, toffset):
+    """
+    Same as write_snippet, but the header is filled in
+    from a template (see snippet_template) and data
+    are written as they are (so should have the dtype
+    of the input file)
+
+    toffset in seconds from start of file
+    """
+    parts, names, tstart0 = template
+
+    outfile = "%s.fil" %outbase
+
+    tstart = tstart0 + (toffset / (24 * 3600.))
+
+    vals = {"tstart"      : struct.pack('d', tstart),
+            "rawdatafile" : sigproc.prep_string(outfile)}
+
+    hdr = parts[0]
+    for name, part in zip(names, parts[1:]):
+        hdr += vals[name] + part
+
+    with open(outfile, 'wb') as fout:
+        fout.write(hdr)
+        data.tofile(fout)
+
+    return
@@ -1,11 +1,11 @@
-import matplotlib
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
 import copy
 import time
 import os
-import your 
+
+# matplotlib and your are slow to import, so they are 
+# imported in the functions that use them.  This keeps 
+# the start up of bb_proc.py (and its -h) fast
 
 
 def get_win_num(nchans, nsub, wfrac=0.2, 
@@ -37,6 +37,7 @@ def get_chan_info(data_file):
     """
     Get channel info
     """
+    import your
     yr = your.Your(data_file)
     foff = yr.your_header.foff
     fch1 = yr.your_header.fch1
@@ -50,6 +51,7 @@ def get_time_info(data_file):
     """
     Get time info
     """
+    import your
     yr = your.Your(data_file)
     dt   = yr.your_header.tsamp
     nsamps = yr.your_header.nspectra
@@ -83,6 +85,7 @@ def calc_bp_stats(infile, med_bp=False):
     get channel means (bandpass) and standard 
     deviations using your
     """
+    import your
     yr = your.Your(infile)
     nspec = yr.your_header.nspectra 
     
@@ -216,6 +219,8 @@ def plot_bp(freqs, bp, mask_chans, diff_thresh=None,
     """
     Plot bandpass with masked chans indicated
     """
+    import matplotlib.pyplot as plt
+
     chans = np.arange(0, len(freqs), 1)
     good_chans = np.setdiff1d(chans, mask_chans)
 
@@ -398,6 +403,7 @@ def calc_bp_stats_chunk(infile, tchunk):
     deviations over chunks of duration tchunk
     using the your package
     """
+    import your
     yr = your.Your(infile)
     nspec = yr.your_header.nspectra
     nchans, fch1, foff, dt = get_chan_info(infile)
@@ -431,6 +437,9 @@ def make_plot(tt, ff, bp, outfile=None, bpass=True):
     """
     Make 3 panel plot
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.gridspec import GridSpec
+
     if outfile is not None:
         plt.ioff()
     else: pass
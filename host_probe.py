@@ -0,0 +1,215 @@
+import os
+import time
+import shutil
+import tempfile
+
+##########################
+##  HOST CAPABILITIES   ##
+##########################
+
+def get_ncpu():
+    """
+    Number of CPUs this process is allowed to run on
+    """
+    try:
+        ncpu = len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncpu = os.cpu_count() or 1
+    return ncpu
+
+
+def get_mem_gb(key='MemAvailable'):
+    """
+    Get memory in GB from /proc/meminfo.  By default this
+    is the memory available for new processes without
+    swapping.  Use key='MemTotal' for the total.
+
+    Falls back on total physical memory from sysconf
+    if /proc/meminfo is not available
+    """
+    try:
+        with open("/proc/meminfo", 'r') as fin:
+            for line in fin:
+                if line.startswith(key + ":"):
+                    # Value is in kB
+                    return int(line.split()[1]) / 1024.**2
+    except (OSError, ValueError, IndexError):
+        pass
+
+    npages = os.sysconf('SC_PHYS_PAGES')
+    psize = os.sysconf('SC_PAGE_SIZE')
+    return npages * psize / 1024.**3
+
+
+def get_disk_free_gb(path):
+    """
+    Free space (GB) on the file system holding path
+    """
+    return shutil.disk_usage(path).free / 1024.**3
+
+
+def get_fs_id(path):
+    """
+    Get an id for the file system holding path so
+    that we can add up the disk use of jobs writing
+    to the same place
+    """
+    return os.stat(path).st_dev
+
+
+##########################
+##  STORAGE THROUGHPUT  ##
+##########################
+
+def read_throughput_mbs(path, nbytes=256*1024**2, bsize=4*1024**2, 
+                        tmax=2.0):
+    """
+    Estimate read throughput (MB/s) of the storage holding 
+    path by reading up to nbytes (or for tmax seconds) from 
+    the largest file in path (or path itself if it is a file).
+
+    We ask the kernel to drop the sampled range from the 
+    page cache first so we measure the storage, not memory.
+
+    Returns -1 if there is nothing to read
+    """
+    if os.path.isdir(path):
+        flist = [ os.path.join(path, ff) for ff in os.listdir(path) ]
+        flist = [ ff for ff in flist if os.path.isfile(ff) ]
+        if len(flist) == 0:
+            return -1
+        infile = max(flist, key=os.path.getsize)
+    else:
+        infile = path
+
+    nread = 0
+    fd = os.open(infile, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, nbytes, os.POSIX_FADV_DONTNEED)
+        t0 = time.time()
+        while nread < nbytes and time.time() - t0 < tmax:
+            buf = os.read(fd, bsize)
+            if len(buf) == 0:
+                break
+            nread += len(buf)
+        dt = time.time() - t0
+    finally:
+        os.close(fd)
+
+    if nread == 0 or dt <= 0:
+        return -1
+
+    return nread / dt / 1e6
+
+
+def write_throughput_mbs(path, nbytes=128*1024**2, bsize=4*1024**2):
+    """
+    Estimate write throughput (MB/s) of the storage holding 
+    directory path by writing (and syncing) a temporary file 
+    of nbytes.  The file is removed afterwards.
+
+    Returns -1 if we cannot write to path
+    """
+    buf = os.urandom(bsize)
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=path, suffix=".probe")
+    except OSError:
+        return -1
+
+    try:
+        t0 = time.time()
+        nwrite = 0
+        while nwrite < nbytes:
+            nwrite += os.write(fd, buf)
+        os.fsync(fd)
+        dt = time.time() - t0
+    finally:
+        os.close(fd)
+        os.remove(tmpfile)
+
+    if dt <= 0:
+        return -1
+
+    return nwrite / dt / 1e6
+
+
+##########################
+##  AUTO TUNING         ##
+##########################
+
+def auto_tune(csdir, outdir, mem_frac=0.75, tchunk=20.0, 
+              min_chunk_mb=256, probe=True):
+    """
+    Pick processing parameters from the host capabilities:
+
+      nthread:  digifil threads -- all CPUs but one, which 
+                is left for the background RFI plots
+
+      memlim:   DADA conversion memory limit (GB) -- mem_frac 
+                of the currently available memory
+
+      chunk_mb: DADA conversion read size (MB) -- enough to 
+                keep the slower of csdir (read) and outdir 
+                (write) busy for about tchunk seconds, at least 
+                min_chunk_mb, and no more than memlim allows
+
+      rfi_bkgd: make the RFI plots in a background worker 
+                (only if we have a spare CPU)
+
+    If probe=False, skip the storage throughput tests and 
+    let memlim set the chunk size.
+
+    Returns a dict with the choices and the probe results 
+    so they can be recorded with the run metrics
+    """
+    ncpu = get_ncpu()
+    mem_gb = get_mem_gb()
+
+    if probe:
+        read_mbs = read_throughput_mbs(csdir)
+        write_mbs = write_throughput_mbs(outdir)
+    else:
+        read_mbs = write_mbs = -1
+
+    nthread = max(ncpu - 1, 1)
+    memlim = max(mem_frac * mem_gb, 1.0)
+
+    # cs2dada_multipass holds about two copies of each 
+    # chunk (read + reordered), and uses 3/4 of memlim
+    chunk_max_mb = 0.5 * 0.75 * memlim * 1e3
+    rates = [ rr for rr in [read_mbs, write_mbs] if rr > 0 ]
+    if len(rates):
+        chunk_mb = max(tchunk * min(rates), min_chunk_mb)
+        chunk_mb = min(chunk_mb, chunk_max_mb)
+    else:
+        chunk_mb = chunk_max_mb
+
+    tune = {'ncpu'         : ncpu, 
+            'mem_avail_gb' : mem_gb, 
+            'read_mbs'     : read_mbs, 
+            'write_mbs'    : write_mbs, 
+            'nthread'      : nthread, 
+            'memlim'       : memlim, 
+            'chunk_mb'     : int(chunk_mb), 
+            'rfi_bkgd'     : ncpu > 1}
+
+    return tune
+
+
+def check_free_space(path, nbytes, label="", margin=1.05):
+    """
+    Check that the file system holding path has room 
+    for nbytes (times a small safety margin) before we 
+    start a stage that writes that much.  Prints a 
+    message and returns False if it does not
+    """
+    free_gb = get_disk_free_gb(path)
+    need_gb = margin * nbytes / 1024.**3
+    if need_gb > free_gb:
+        print("  Not enough free space for %s in %s" %(label, path))
+        print("  Need %.1f GB, have %.1f GB" %(need_gb, free_gb))
+        return False
+    else: pass
+
+    return True
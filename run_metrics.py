@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import subprocess
+from contextlib import contextmanager
+
+##########################
+##  STAGE TELEMETRY     ##
+##########################
+
+# Records for all stages run in this interpreter.  The
+# stages run as separate scripts dump their records to
+# a file that the calling script then merges in.
+_records = []
+
+
+def _proc_io():
+    """
+    Get I/O counters for this process from /proc/self/io
+
+    rchar/wchar are the bytes asked for by read/write calls
+    (works for network file systems), read_bytes/write_bytes
+    are the bytes that actually went to the storage layer.
+    The kernel adds the counters of waited-for children to
+    the parent, so this also covers subprocesses.
+
+    Returns zeros if /proc is not available
+    """
+    vals = {'rchar': 0, 'wchar': 0, 'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open("/proc/self/io", 'r') as fin:
+            for line in fin:
+                key, val = line.split(':')
+                if key in vals:
+                    vals[key] = int(val)
+    except (OSError, ValueError):
+        pass
+    return vals
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS (VmHWM) of this process so that
+    the next reading only covers the current stage.
+    Needs Linux >= 4.0, otherwise the peak will be since
+    the start of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", 'w') as fout:
+            fout.write("5")
+    except OSError:
+        pass
+    return
+
+
+def _peak_rss_mb():
+    """
+    Peak RSS of this process in MB.  Use VmHWM if we
+    have it, otherwise fall back on ru_maxrss
+    """
+    try:
+        with open("/proc/self/status", 'r') as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _cpu_times():
+    """
+    Get user and sys CPU time of this process and
+    its waited-for children
+    """
+    ru_s = resource.getrusage(resource.RUSAGE_SELF)
+    ru_c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    utime = ru_s.ru_utime + ru_c.ru_utime
+    stime = ru_s.ru_stime + ru_c.ru_stime
+    return utime, stime
+
+
+def _io_delta(io0, io1):
+    """
+    Difference in I/O counters as record entries
+    """
+    rec = {}
+    rec['read_bytes'] = io1['rchar'] - io0['rchar']
+    rec['write_bytes'] = io1['wchar'] - io0['wchar']
+    rec['disk_read_bytes'] = io1['read_bytes'] - io0['read_bytes']
+    rec['disk_write_bytes'] = io1['write_bytes'] - io0['write_bytes']
+    return rec
+
+
+def add_record(rec):
+    """
+    Add a stage record to the list
+    """
+    _records.append(rec)
+    return rec
+
+
+def get_records():
+    """
+    Return list of all stage records so far
+    """
+    return list(_records)
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Record wall time, CPU time, peak RSS and bytes
+    read/written for code run inside the block:
+
+        with stage("bandpass"):
+            ...
+
+    Any extra keywords are stored with the record
+    """
+    rec = {'stage': name}
+    rec.update(info)
+
+    _reset_peak_rss()
+    io0 = _proc_io()
+    ut0, st0 = _cpu_times()
+    rec['start'] = time.time()
+    try:
+        yield rec
+    finally:
+        tstop = time.time()
+        ut1, st1 = _cpu_times()
+        io1 = _proc_io()
+
+        rec['wall_s'] = tstop - rec['start']
+        rec['cpu_user_s'] = ut1 - ut0
+        rec['cpu_sys_s'] = st1 - st0
+        rec['peak_rss_mb'] = _peak_rss_mb()
+        rec.update(_io_delta(io0, io1))
+        add_record(rec)
+
+
+def run_cmd(cmd, name, **info):
+    """
+    Run shell command cmd (like call(cmd, shell=True))
+    and record its resource use as stage "name".  The
+    CPU time and peak RSS come from wait4 on the command,
+    so they cover the command and everything it ran.
+
+    Returns the exit code of the command
+    """
+    rec = {'stage': name, 'cmd': cmd}
+    rec.update(info)
+
+    io0 = _proc_io()
+    rec['start'] = time.time()
+
+    proc = subprocess.Popen(cmd, shell=True)
+    _, status, ru = os.wait4(proc.pid, 0)
+    retcode = os.waitstatus_to_exitcode(status)
+    proc.returncode = retcode
+
+    tstop = time.time()
+    io1 = _proc_io()
+
+    rec['wall_s'] = tstop - rec['start']
+    rec['cpu_user_s'] = ru.ru_utime
+    rec['cpu_sys_s'] = ru.ru_stime
+    # ru_maxrss is in kB on Linux
+    rec['peak_rss_mb'] = ru.ru_maxrss / 1024.
+    rec.update(_io_delta(io0, io1))
+    rec['returncode'] = retcode
+    add_record(rec)
+
+    return retcode
+
+
+def dump_records(outfile):
+    """
+    Write the records from this interpreter to outfile
+    so that the calling script can merge them
+    """
+    with open(outfile, 'w') as fout:
+        json.dump(_records, fout, indent=1)
+    return
+
+
+def merge_records(infile, parent=None, remove=True):
+    """
+    Read records dumped by a child script and add them
+    to ours, tagged with the parent stage name.  The
+    file is deleted after reading if remove=True
+    """
+    if not os.path.exists(infile):
+        return []
+
+    with open(infile, 'r') as fin:
+        recs = json.load(fin)
+
+    for rec in recs:
+        if parent is not None:
+            rec['parent'] = parent
+        add_record(rec)
+
+    if remove:
+        os.remove(infile)
+
+    return recs
+
+
+def write_metrics(outfile, tstart, **meta):
+    """
+    Write all stage records and run info to the
+    machine-readable run metrics file (JSON)
+    """
+    tstop = time.time()
+    ut, st = _cpu_times()
+    recs = get_records()
+    peaks = [ rec.get('peak_rss_mb', 0) for rec in recs ]
+
+    out = {}
+    out['host'] = socket.gethostname()
+    out['start'] = tstart
+    out['start_utc'] = time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.gmtime(tstart))
+    out['wall_s'] = tstop - tstart
+    out['cpu_user_s'] = ut
+    out['cpu_sys_s'] = st
+    out['peak_rss_mb'] = max(peaks + [_peak_rss_mb()])
+    out['argv'] = sys.argv
+    out.update(meta)
+    out['stages'] = recs
+
+    with open(outfile, 'w') as fout:
+        json.dump(out, fout, indent=1)
+
+    print("Wrote run metrics: %s" %outfile)
+    return
@@ -0,0 +1,76 @@
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+# The entry points import matplotlib, astropy and your only
+# in the functions that use them, so starting a stage (or
+# just asking for -h) stays fast.  These tests run each one
+# with -h under 'python -X importtime' and fail if any of
+# the slow packages shows up in the imports.
+
+srcdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+entry_points = ["bb_proc.py",
+                "bb_batch.py",
+                "bbsearch/bbsearch.py",
+                "bb2fil/bb2fil_chunk.py"]
+
+slow_modules = ["matplotlib", "astropy", "your"]
+
+
+def get_imports(script):
+    """
+    Run script -h and return (returncode, set of the top
+    level packages imported, stderr)
+    """
+    cmd = [sys.executable, "-X", "importtime",
+           os.path.join(srcdir, script), "-h"]
+    res = subprocess.run(cmd, cwd=srcdir, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    # lines are "import time: self [us] | cumulative | module"
+    mods = set()
+    for line in res.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            mod = line.rsplit("|", 1)[1].strip()
+            mods.add(mod.split(".")[0])
+        else: pass
+    return res.returncode, mods, res.stderr
+
+
+def missing_module(stderr):
+    """
+    Name of the module a failed run could not import (if any)
+    """
+    mm = re.search(r"No module named '([^']+)'", stderr)
+    if mm:
+        return mm.group(1).split(".")[0]
+    else:
+        return None
+
+
+class TestStartupImports(unittest.TestCase):
+
+    def test_no_slow_imports(self):
+        for script in entry_points:
+            with self.subTest(script=script):
+                rc, mods, stderr = get_imports(script)
+                slow = sorted(set(slow_modules) & mods)
+                self.assertEqual(slow, [],
+                    "%s -h imports %s" %(script, ", ".join(slow)))
+
+                if rc:
+                    # Other dependencies (eg, click) may not be
+                    # installed where the tests run.  Missing
+                    # slow modules mean they were imported
+                    missing = missing_module(stderr)
+                    if missing is None or missing in slow_modules:
+                        self.fail("%s -h failed:\n%s" %(script, stderr))
+                    else:
+                        self.skipTest("%s needs %s" %(script, missing))
+                else: pass
+
+
+if __name__ == "__main__":
+    unittest.main()